@@ -1,7 +1,9 @@
 import logging
+
 import jobserver.db as jdb
-from jobserver.build import get_session_labels
-from .dispatch import do_dispatch
+from jobserver.context import worker_context
+from jobserver.agent import get_free
+from .matcher import request_match
 
 
 class AgentAvailable(object):
@@ -9,25 +11,13 @@ class AgentAvailable(object):
 
     @staticmethod
     def perform(agent_id):
-        db = jdb.conn()
-        matched = None
-        agent_labels = set(db.hget(jdb.KEY_AGENT % agent_id, 'labels').split(','))
-        queued = db.zrange(jdb.KEY_QUEUED_SESSIONS, 0, -1)
-        if queued:
-            logging.info("Agent %s available - matching against "
-                         "%d queued sessions" % (agent_id, len(queued)))
-            for session_id in queued:
-                labels = get_session_labels(db, session_id)
-                if labels.issubset(agent_labels):
-                    matched = session_id
-                    break
-            db.zrem(jdb.KEY_QUEUED_SESSIONS, matched)
-            logging.debug("Matched against %s" % matched)
-        else:
-            logging.info("Agent %s available - nothing queued." % agent_id)
-
-        if matched:
-            agent_info = db.hgetall(jdb.KEY_AGENT % agent_id)
-            do_dispatch(db, agent_id, agent_info, matched)
-        else:
+        ctx = worker_context()
+        db = ctx.db
+        if db.zscore(jdb.KEY_TRIPPED, agent_id) is not None:
+            logging.info("Agent %s is cooling down - ignoring" % agent_id)
+            return
+        state = db.hget(jdb.KEY_AGENT % agent_id, 'state')
+        if state == jdb.AGENT_STATE_AVAIL and get_free(db, agent_id)['slots'] > 0:
+            logging.info("Agent %s available" % agent_id)
             db.sadd(jdb.KEY_AVAILABLE, agent_id)
+            request_match(db)
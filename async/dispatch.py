@@ -1,13 +1,140 @@
+import collections
+import httplib
 import json
-from sci.http_client import HttpClient
+import logging
+import Queue
+import socket
+import threading
+import time
+
+from sci.http_client import HttpClient, HttpError
+import jobserver.db as jdb
+from jobserver.agent import AGENT_MODE_PULL
 from jobserver.build import set_session_to_agent
+from jobserver.lease import grant, requeue, record_success, record_failure
+from .events import post
 
+# Agents are notified on a pool of threads, so that a slow agent only
+# holds up its own sessions
+NOTIFY_THREADS = 32
+# Notifications in flight to a single agent
+NOTIFY_PER_AGENT = 4
+NOTIFY_TIMEOUT = 10
+NOTIFY_RETRIES = 2
+NOTIFY_RETRY_DELAY = 0.5
 
-def do_dispatch(db, agent_id, agent_info, session_id):
-    agent_url = "http://%s:%s" % (agent_info["ip"], agent_info["port"])
-    print("DISPATCH TO AGENT, URL: '%s'" % agent_url)
 
-    set_session_to_agent(db, session_id, agent_id)
+class Notifier(object):
+    """Bounded pool of threads posting /dispatch to the agents"""
+
+    def __init__(self, threads = NOTIFY_THREADS, per_agent = NOTIFY_PER_AGENT):
+        self.threads = threads
+        self.per_agent = per_agent
+        self.tasks = Queue.Queue()
+        self.lock = threading.Lock()
+        self.in_flight = collections.defaultdict(int)
+        self.backlog = collections.defaultdict(collections.deque)
+        self.pending = 0
+        self.idle = threading.Condition(self.lock)
+        self.workers = []
+
+    def _start(self):
+        for _ in range(self.threads - len(self.workers)):
+            worker = threading.Thread(target = self._work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, agent_id, func, *args):
+        with self.lock:
+            if not self.workers:
+                self._start()
+            self.pending += 1
+            if self.in_flight[agent_id] >= self.per_agent:
+                self.backlog[agent_id].append((func, args))
+                return
+            self.in_flight[agent_id] += 1
+        self.tasks.put((agent_id, func, args))
+
+    def _work(self):
+        while True:
+            agent_id, func, args = self.tasks.get()
+            try:
+                func(*args)
+            except Exception:
+                logging.exception("Notifying %s failed" % agent_id)
+            self._done(agent_id)
+
+    def _done(self, agent_id):
+        with self.lock:
+            self.pending -= 1
+            if self.backlog[agent_id]:
+                func, args = self.backlog[agent_id].popleft()
+                self.tasks.put((agent_id, func, args))
+            else:
+                del self.backlog[agent_id]
+                self.in_flight[agent_id] -= 1
+                if not self.in_flight[agent_id]:
+                    del self.in_flight[agent_id]
+            if not self.pending:
+                self.idle.notify_all()
+
+    def drain(self):
+        """Waits for all submitted notifications to finish"""
+        with self.lock:
+            while self.pending:
+                self.idle.wait()
+
+
+notifier = Notifier()
+
+
+def notify(db, agent_id, agent_url, session_id):
     input = dict(session_id = session_id)
-    client = HttpClient(agent_url)
-    client.call('/dispatch', input = json.dumps(input))
+    client = HttpClient(agent_url, timeout = NOTIFY_TIMEOUT)
+    error = None
+    for attempt in range(NOTIFY_RETRIES + 1):
+        try:
+            client.call('/dispatch', input = json.dumps(input))
+            error = None
+            break
+        except (HttpError, httplib.HTTPException, socket.error) as e:
+            logging.warning("Dispatching %s to %s failed: %r" %
+                            (session_id, agent_id, e))
+            error = e
+            # The agent refused the session - no point in insisting
+            if isinstance(e, HttpError) and 400 <= e.code < 500:
+                break
+            if attempt < NOTIFY_RETRIES:
+                time.sleep(NOTIFY_RETRY_DELAY * 2 ** attempt)
+
+    if error is not None:
+        if requeue(db, session_id) and \
+                record_failure(db, agent_id, session_id):
+            from .agent_available import AgentAvailable
+            post(db, AgentAvailable, agent_id)
+        return False
+    record_success(db, agent_id)
+    return True
+
+
+def do_dispatch(db, agent_id, agent_info, session_id):
+    """Hands the session to the agent. Pull-mode agents find it in their
+    inbox, others are notified in the background. Either way, the lease
+    makes sure the session comes back if the agent never gets it.
+    """
+    pull = agent_info.get('mode') == AGENT_MODE_PULL
+    with db.pipeline() as pipe:
+        set_session_to_agent(pipe, session_id, agent_id)
+        grant(pipe, session_id)
+        if pull:
+            pipe.rpush(jdb.KEY_AGENT_INBOX % agent_id, session_id)
+        pipe.execute()
+    if pull:
+        logging.info("Dispatched %s to the inbox of %s" % (session_id,
+                                                         agent_id))
+        return
+
+    agent_url = "http://%s:%s" % (agent_info["ip"], agent_info["port"])
+    logging.info("Dispatching %s to '%s'" % (session_id, agent_url))
+    notifier.submit(agent_id, notify, db, agent_id, agent_url, session_id)
@@ -1,76 +1,105 @@
-import logging, time
+import json
+import logging
 
 import redis
 
-from sci.utils import random_sha1
-from jobserver.build import get_session
-from jobserver.build import set_session_queued
 import jobserver.db as jdb
-from .dispatch import do_dispatch
-
-SEEN_EXPIRY_TTL = 2 * 60
+from jobserver.agent import can_satisfy, can_fit
+from jobserver.build import Build, get_session_caches, get_session_labels
+from jobserver.build import get_session_needs
+from jobserver.build import set_session_done, set_session_state, RESULT_ERROR
+from jobserver.build import SESSION_STATE_TO_BACKEND, SESSION_STATE_DONE
+from jobserver.build import KEY_SESSION
+from jobserver.slog import add_slog
+from jobserver.context import worker_context
+from jobserver.utils import get_ts
+from jobserver import affinity, deps
+from . import scheduler
+from .events import post
+from .matcher import request_match
 
 
 class DispatchSession(object):
     queue = 'queue'
 
     @staticmethod
-    def allocate(pipe, agent_id, session_id):
-        """Starts multi, doesn't exec"""
-        # The agent may become inactive
-        pipe.watch(jdb.KEY_AGENT % agent_id)
-        info = pipe.hgetall(jdb.KEY_AGENT % agent_id)
-        info['seen'] = int(info['seen'])
-
-        pipe.multi()
-        pipe.srem(jdb.KEY_AVAILABLE, agent_id)
-        if info['state'] != jdb.AGENT_STATE_AVAIL:
-            return None
+    def fail(ctx, session_id, reason):
+        """Finishes a session that can't be run with an error"""
+        logging.warning("Failing %s: %s" % (session_id, reason))
+        build_id, num = session_id.split('-')
+        with ctx.db.pipeline() as pipe:
+            set_session_done(pipe, session_id, RESULT_ERROR,
+                             dict(error = reason), '')
+            if int(num) == 0:
+                Build.set_done(build_id, RESULT_ERROR, pipe = pipe)
+            add_slog(ctx, session_id,
+                     json.dumps(dict(type = 'session-done',
+                                     params = dict(result = RESULT_ERROR))),
+                     pipe = pipe)
+            pipe.execute()
+        DispatchSession.release_dependents(ctx, session_id)
 
-        # verify the 'seen' so that it's not too old
-        if info['seen'] + SEEN_EXPIRY_TTL < int(time.time()):
-            pipe.hset(jdb.KEY_AGENT % agent_id, 'state', jdb.AGENT_STATE_INACTIVE)
-            return None
+    @staticmethod
+    def release_dependents(ctx, session_id):
+        """Dispatches the sessions that were waiting for the session, now
+        that it's done, unless some other dependency of theirs failed"""
+        for dependent in deps.finished(ctx.db, session_id):
+            DispatchSession.deps_done(ctx, dependent)
 
-        pipe.hmset(jdb.KEY_AGENT % agent_id, {'state': jdb.AGENT_STATE_PENDING,
-                                              'session': session_id})
-        return info
+    @staticmethod
+    def deps_done(ctx, session_id):
+        """Dispatches a session whose dependencies are all done, or fails
+        it if any of them didn't succeed"""
+        failed = deps.failed_deps(ctx.db, session_id)
+        if failed:
+            DispatchSession.fail(ctx, session_id,
+                                 "Depends on %s, which didn't succeed" %
+                                 ", ".join(failed))
+            return
+        logging.debug("%s has no more dependencies" % session_id)
+        set_session_state(ctx.db, session_id, SESSION_STATE_TO_BACKEND)
+        post(ctx.db, DispatchSession, session_id)
 
     @staticmethod
     def perform(session_id):
-        db = jdb.conn()
-        session = get_session(db, session_id)
-        lkeys = [jdb.KEY_LABEL % label for label in session['labels']]
-        lkeys.append(jdb.KEY_AVAILABLE)
-        ts = float(time.time() * 1000)
-        alloc_key = jdb.KEY_ALLOCATION % random_sha1()
+        ctx = worker_context()
+        db = ctx.db
+        labels = get_session_labels(db, session_id)
+        if not can_satisfy(db, labels):
+            # Would otherwise sit in the queue forever
+            DispatchSession.fail(ctx, session_id,
+                                 "No agent has the labels %s" %
+                                 ", ".join(sorted(labels)))
+            return
+        needs = get_session_needs(db, session_id)
+        if not can_fit(db, labels, needs):
+            DispatchSession.fail(ctx, session_id,
+                                 "No agent has the capacity for %s" %
+                                 ", ".join("%s=%s" % i
+                                           for i in sorted(needs.items())))
+            return
+
+        wait_until = None
+        if get_session_caches(db, session_id):
+            wait_until = affinity.wait_until(db, session_id)
 
         while True:
             with db.pipeline() as pipe:
                 try:
-                    pipe.watch(jdb.KEY_AVAILABLE)
-                    pipe.sinterstore(alloc_key, lkeys)
-                    agent_id = pipe.spop(alloc_key)
-                    if not agent_id:
-                        pipe.multi()
-                        set_session_queued(pipe, session_id)
-                        pipe.zadd(jdb.KEY_QUEUED_SESSIONS, ts, session_id)
-                        pipe.delete(alloc_key)
-                        pipe.execute()
-                        logging.debug("No agent available - queuing")
-                    else:
-                        agent_info = DispatchSession.allocate(pipe,
-                                                              agent_id,
-                                                              session_id)
-                        pipe.delete(alloc_key)
-                        pipe.execute()
-
-                        if not agent_info:
-                            logging.debug("Tried to allocate %s. Bummer" % agent_id)
-                            continue
-
-                        logging.debug("Dispatching to %s" % agent_id)
-                        do_dispatch(db, agent_id, agent_info, session_id)
-                    return
+                    # It may have been aborted meanwhile
+                    pipe.watch(KEY_SESSION % session_id)
+                    if pipe.hget(KEY_SESSION % session_id,
+                                 'state') == SESSION_STATE_DONE:
+                        return
+                    tag = scheduler.tag(pipe, session_id)
+                    pipe.multi()
+                    scheduler.push(pipe, session_id, tag)
+                    if wait_until and wait_until > get_ts():
+                        # Match again once it's done waiting for a warm agent
+                        pipe.zadd(jdb.KEY_AFFINITY, wait_until, session_id)
+                    pipe.execute()
+                    break
                 except redis.WatchError:
                     continue
+        logging.debug("Queued %s" % session_id)
+        request_match(db)
@@ -0,0 +1,30 @@
+"""Events handled by the dispatcher daemon.
+
+Agent check-ins and sessions to dispatch used to be resque jobs, each
+forked off by the pyres worker. They are now pushed as small events on
+KEY_EVENTS, which dispatcher.py pops with BLPOP and runs on a pool of
+threads sharing one connection pool. An event names the class whose
+perform() handles it, so they can still be run by pyres instead, by
+setting DISPATCH_VIA to 'pyres'.
+"""
+import json
+import time
+
+from pyres import ResQ
+
+import jobserver.db as jdb
+from jobserver.context import load_config
+
+
+def post(db, handler, *args):
+    """Asks the dispatcher to run handler.perform(*args)"""
+    if load_config().get('DISPATCH_VIA', 'events') == 'pyres':
+        ResQ().enqueue(handler, *args)
+        return
+    event = dict(type = handler.__name__, args = args, ts = time.time())
+    db.rpush(jdb.KEY_EVENTS, json.dumps(event))
+
+
+def parse(data):
+    event = json.loads(data)
+    return event['type'], event.get('args', []), event.get('ts')
@@ -0,0 +1,203 @@
+import json
+import logging
+
+import redis
+
+import jobserver.db as jdb
+from jobserver.agent import parse_free, best_fit, take, set_capacity_state
+from jobserver.agent import get_labels, AGENT_EXPIRY_TTL
+from jobserver.build import KEY_SESSION, set_session_to_agent
+from jobserver.context import worker_context, load_config
+from jobserver.utils import get_ts
+from jobserver import affinity, limits
+from .dispatch import do_dispatch, notifier
+from .events import post
+from .scheduler import served
+
+# A pass that was asked for but never ran is given up on after this long
+MATCH_PENDING_TTL = 60
+# Passes that keep losing the race against agents and sessions coming
+# and going hand over to a new pass after this many attempts
+MATCH_ATTEMPTS = 5
+
+
+def request_match(db):
+    """Asks for a matching pass. Requests made before a pass has started
+    are served by that same pass.
+    """
+    if db.setnx(jdb.KEY_MATCH_PENDING, get_ts()):
+        db.expire(jdb.KEY_MATCH_PENDING, MATCH_PENDING_TTL)
+        post(db, MatchQueue)
+
+
+def _snapshot_agents(db, agent_ids, now):
+    agent_ids = sorted(agent_ids)
+    with db.pipeline(transaction = False) as pipe:
+        for agent_id in agent_ids:
+            pipe.hgetall(jdb.KEY_AGENT % agent_id)
+            pipe.hgetall(jdb.KEY_AGENT_FREE % agent_id)
+            pipe.smembers(jdb.KEY_AGENT_CACHES % agent_id)
+            pipe.zscore(jdb.KEY_SEEN, agent_id)
+            pipe.zscore(jdb.KEY_TRIPPED, agent_id)
+        result = pipe.execute()
+
+    agents, gone, expired = {}, [], []
+    for i, agent_id in enumerate(agent_ids):
+        info, free, caches, seen, tripped = result[i * 5:i * 5 + 5]
+        if info.get('state') != jdb.AGENT_STATE_AVAIL or tripped is not None:
+            gone.append(agent_id)
+        elif seen is None or seen + AGENT_EXPIRY_TTL < now:
+            expired.append(agent_id)
+        else:
+            info['labels'] = set(get_labels(info))
+            info['free'] = parse_free(free)
+            info['caches'] = caches
+            agents[agent_id] = info
+    return agents, gone, expired
+
+
+def _snapshot_sessions(db, queued):
+    with db.pipeline(transaction = False) as pipe:
+        for session_id, score in queued:
+            pipe.hmget(KEY_SESSION % session_id,
+                       ('labels', 'resources', 'caches', 'created'))
+        result = pipe.execute()
+
+    sessions = []
+    for (session_id, score), fields in zip(queued, result):
+        labels, resources, caches, created = fields
+        needs = json.loads(resources or '{}')
+        needs.setdefault('slots', 1)
+        sessions.append((session_id, score,
+                         set(l for l in (labels or '').split(',') if l),
+                         needs,
+                         [c for c in (caches or '').split(',') if c],
+                         int(created or 0) + affinity.AFFINITY_WAIT))
+    return sessions
+
+
+def _assign(db, agents, sessions, now, builds, counts):
+    """Greedily assigns the sessions, in queue order, to the agent they
+    fit best. Sessions with caches go to a warm agent if one is free, and
+    otherwise hold out for one until their wait is over. Sessions whose
+    job or build has as many sessions running as it may are held back.
+
+    Returns the assignments, and the reason each held back session was.
+    """
+    assignments = []
+    limited = {}
+    for session_id, score, labels, needs, caches, wait_until in sessions:
+        if not [a for a in agents.itervalues() if a['free']['slots'] > 0]:
+            break
+        session_limits = limits.get_limits(builds, session_id)
+        full = ['%s limit of %d' % (name, limit)
+                for key, limit, name in session_limits
+                if counts[key] >= limit]
+        if full:
+            limited[session_id] = ', '.join(full)
+            continue
+        frees = dict((agent_id, a['free']) for agent_id, a in agents.iteritems()
+                     if labels.issubset(a['labels']))
+        if caches:
+            warm = dict((agent_id, free) for agent_id, free in frees.iteritems()
+                        if agents[agent_id]['caches'].intersection(caches))
+            agent_id = best_fit(warm, needs)
+            if not agent_id and now < wait_until and affinity.warm_agents(
+                    db, caches, [jdb.KEY_LABEL % l for l in labels]):
+                continue
+        if not caches or not agent_id:
+            agent_id = best_fit(frees, needs)
+        if not agent_id:
+            continue
+        assignments.append((agent_id, session_id, score, needs,
+                            bool(agents[agent_id]['caches'].intersection(caches))
+                            if caches else None))
+        for name, amount in needs.iteritems():
+            agents[agent_id]['free'][name] -= amount
+        for key, limit, name in session_limits:
+            counts[key] += 1
+    return assignments, limited
+
+
+def match(db, now = None):
+    """Matches the queued sessions against the free agents in one pass,
+    and commits all of the resulting allocations in a single transaction.
+
+    Returns a list of (agent id, agent info, session id, score, warm),
+    where warm is None for sessions that don't ask for a cache.
+    """
+    now = now or get_ts()
+    with db.pipeline() as pipe:
+        pipe.watch(jdb.KEY_QUEUED_SESSIONS, jdb.KEY_AVAILABLE)
+        queued = pipe.zrange(jdb.KEY_QUEUED_SESSIONS, 0, -1, withscores = True)
+        agent_ids = pipe.smembers(jdb.KEY_AVAILABLE)
+        if not queued:
+            db.delete(jdb.KEY_LIMITED)
+        if not queued or not agent_ids:
+            return []
+        for agent_id in agent_ids:
+            pipe.watch(jdb.KEY_AGENT % agent_id, jdb.KEY_AGENT_FREE % agent_id)
+
+        agents, gone, expired = _snapshot_agents(db, agent_ids, now)
+        # Keep the free capacity as it was before this pass
+        frees = dict((agent_id, dict(a['free']))
+                     for agent_id, a in agents.iteritems())
+        builds, counts = limits.snapshot(db, [s for s, score in queued])
+        assignments, limited = _assign(db, agents,
+                                       _snapshot_sessions(db, queued), now,
+                                       builds, counts)
+
+        pipe.multi()
+        for agent_id in gone + expired:
+            pipe.srem(jdb.KEY_AVAILABLE, agent_id)
+        for agent_id in expired:
+            pipe.hset(jdb.KEY_AGENT % agent_id, 'state',
+                      jdb.AGENT_STATE_INACTIVE)
+        for agent_id, session_id, score, needs, warm in assignments:
+            pipe.zrem(jdb.KEY_QUEUED_SESSIONS, session_id)
+            take(pipe, agent_id, session_id, needs, frees[agent_id])
+            # Counts against the limits from here on
+            set_session_to_agent(pipe, session_id, agent_id)
+            for key, limit, name in limits.get_limits(builds, session_id):
+                pipe.sadd(key, session_id)
+        pipe.delete(jdb.KEY_LIMITED)
+        if limited:
+            pipe.hmset(jdb.KEY_LIMITED, limited)
+        for agent_id in set(a[0] for a in assignments):
+            set_capacity_state(pipe, agent_id, frees[agent_id])
+        pipe.execute()
+    return [(agent_id, agents[agent_id], session_id, score, warm)
+            for agent_id, session_id, score, needs, warm in assignments]
+
+
+class MatchQueue(object):
+    queue = 'queue'
+
+    @staticmethod
+    def perform():
+        ctx = worker_context()
+        db = ctx.db
+        # Anything that changes from here on needs another pass
+        db.delete(jdb.KEY_MATCH_PENDING)
+        for attempt in xrange(MATCH_ATTEMPTS):
+            try:
+                assignments = match(db)
+                break
+            except redis.WatchError:
+                continue
+        else:
+            logging.info("Matching pass kept getting raced - retrying")
+            request_match(db)
+            return
+
+        logging.info("Matching pass assigned %d sessions" % len(assignments))
+        for agent_id, agent_info, session_id, score, warm in assignments:
+            served(db, session_id, score)
+            if warm is not None:
+                affinity.record(db, warm)
+            logging.debug("Dispatching %s to %s" % (session_id, agent_id))
+            do_dispatch(db, agent_id, agent_info, session_id)
+        # A resque job's process exits when it returns, while the
+        # dispatcher daemon keeps the notifications going in the background
+        if load_config().get('DISPATCH_VIA', 'events') == 'pyres':
+            notifier.drain()
@@ -0,0 +1,21 @@
+import logging
+
+from jobserver.context import worker_context
+from jobserver.rebuild import rebuild, RebuildInProgress
+
+
+class RebuildCaches(object):
+    """Runs /admin/rebuild_caches in the pyres worker. It forks a process
+    of its own for the job, so the rebuild may use a process pool, which
+    a request thread of the threaded jobserver must not."""
+    queue = 'queue'
+
+    @staticmethod
+    def perform(full):
+        try:
+            status = rebuild(worker_context(), full = full)
+        except RebuildInProgress:
+            logging.info("A cache rebuild is already running")
+            return
+        logging.info("Rebuilt caches: %d updated, %d removed, %d errors" %
+                     (status['updated'], status['removed'], status['errors']))
@@ -0,0 +1,122 @@
+"""Start-time fair queuing of the sessions waiting for an agent.
+
+Queued sessions are kept in KEY_QUEUED_SESSIONS so that agents can match
+them in score order. The score is the priority class of the build,
+followed by a virtual start time within that class:
+
+    score = rank * CLASS_SPAN + start
+
+Every job is a flow within its class. A session queued for a job starts
+at max(V, F), where V is the virtual clock of the class (the start tag
+of the last session handed to an agent) and F is the finish tag of the
+job's previous session. The session's own finish tag is start + 1/share.
+Sessions of a matrix build thus get spread out between the sessions of
+every other job, instead of all being in front of them.
+
+A session is charged to its flow once. When it is queued again, e.g.
+after a failed dispatch, it keeps the start tag it got the first time.
+"""
+import jobserver.db as jdb
+from jobserver.build import KEY_BUILD, KEY_SESSION
+from jobserver.build import PRIORITIES, PRIORITY_NORMAL
+from jobserver.build import set_session_queued
+from jobserver.utils import get_ts
+
+CLASS_SPAN = 10 ** 12
+
+
+def start_tag(vclock, finish, share = 1):
+    """Returns the (start, finish) tags of the next session of a flow"""
+    start = max(vclock, finish)
+    return start, start + 1.0 / share
+
+
+def get_rank(priority):
+    if priority not in PRIORITIES:
+        priority = PRIORITY_NORMAL
+    return PRIORITIES.index(priority)
+
+
+def split_score(score):
+    """Returns the (priority, start tag) of a score in the queue"""
+    rank = min(int(score // CLASS_SPAN), len(PRIORITIES) - 1)
+    return PRIORITIES[rank], score - rank * CLASS_SPAN
+
+
+def tag(pipe, session_id):
+    """Works out where `session_id` goes in the queue. The pipe must not
+    be in multi yet, the state that is read is watched.
+
+    Returns a tag to hand to push().
+    """
+    build_id = session_id.split('-')[0]
+    priority, flow, share = pipe.hmget(KEY_BUILD % build_id,
+                                       ('priority', 'job_name', 'share'))
+    priority = PRIORITIES[get_rank(priority)]
+    start = pipe.hget(KEY_SESSION % session_id, 'sched_start')
+    if start is not None:
+        # Queued before, and charged for then
+        return priority, flow, float(start), None
+    finish_key = jdb.KEY_SCHED_FINISH % priority
+    pipe.watch(jdb.KEY_SCHED_VCLOCK, finish_key)
+    vclock = float(pipe.hget(jdb.KEY_SCHED_VCLOCK, priority) or 0)
+    finish = float(pipe.hget(finish_key, flow) or 0)
+    start, finish = start_tag(vclock, finish, int(share or 1))
+    return priority, flow, start, finish
+
+
+def push(pipe, session_id, tag):
+    """Queues the session, given a tag from tag(). Use within multi."""
+    priority, flow, start, finish = tag
+    score = get_rank(priority) * CLASS_SPAN + start
+    set_session_queued(pipe, session_id)
+    pipe.hset(KEY_SESSION % session_id, 'queued', get_ts())
+    if finish is not None:
+        pipe.hset(KEY_SESSION % session_id, 'sched_start', repr(start))
+        pipe.hset(jdb.KEY_SCHED_FINISH % priority, flow, repr(finish))
+    # repr, as str() would round the score to 12 digits
+    pipe.zadd(jdb.KEY_QUEUED_SESSIONS, repr(score), session_id)
+    pipe.hincrby(jdb.KEY_SCHED_STATS, 'queued:%s' % priority, 1)
+
+
+def served(db, session_id, score):
+    """Advances the virtual clock of the class, now that the queued
+    session scored `score` has been taken by an agent.
+    """
+    priority, start = split_score(score)
+
+    def advance(pipe):
+        vclock = float(pipe.hget(jdb.KEY_SCHED_VCLOCK, priority) or 0)
+        pipe.multi()
+        if start > vclock:
+            pipe.hset(jdb.KEY_SCHED_VCLOCK, priority, repr(start))
+
+    db.transaction(advance, jdb.KEY_SCHED_VCLOCK)
+    queued = int(db.hget(KEY_SESSION % session_id, 'queued') or 0)
+    with db.pipeline() as pipe:
+        pipe.hincrby(jdb.KEY_SCHED_STATS, 'served:%s' % priority, 1)
+        if queued:
+            pipe.hincrby(jdb.KEY_SCHED_STATS, 'wait:%s' % priority,
+                         max(get_ts() - queued, 0))
+        pipe.execute()
+
+
+def queue_stats(db):
+    """Returns the queue depth and wait times of every priority class"""
+    with db.pipeline(transaction = False) as pipe:
+        for rank in range(len(PRIORITIES)):
+            pipe.zcount(jdb.KEY_QUEUED_SESSIONS, rank * CLASS_SPAN,
+                        '(%d' % ((rank + 1) * CLASS_SPAN))
+        pipe.hgetall(jdb.KEY_SCHED_STATS)
+        result = pipe.execute()
+    depths, stats = result[:-1], result[-1]
+
+    classes = {}
+    for priority, depth in zip(PRIORITIES, depths):
+        served = int(stats.get('served:%s' % priority, 0))
+        wait = int(stats.get('wait:%s' % priority, 0))
+        classes[priority] = dict(depth = depth,
+                                 queued = int(stats.get('queued:%s' % priority, 0)),
+                                 served = served,
+                                 avg_wait = float(wait) / served if served else 0)
+    return classes
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+    sci.bench_dispatch
+    ~~~~~~~~~~~~~~~~~~
+
+    Measures the end-to-end dispatch latency: from a session being handed
+    to the backend until a (fake) agent receives it. Depending on
+    DISPATCH_VIA, sessions go through the dispatcher daemon or through
+    resque and backend.py, so one of those has to be running. Compare
+    the two by running it once with each setting.
+
+    Registers its own agents, so only run it against a test redis.
+
+    :copyright: (c) 2012 by Victor Boivie
+    :license: Apache License 2.0
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from optparse import OptionParser
+import json
+import sys
+import threading
+import time
+
+import jobserver.db as jdb
+from jobserver.agent import touch, reset_capacity, set_labels
+from jobserver.build import KEY_BUILD, KEY_SESSION, create_session
+from jobserver.context import load_config
+from sci.utils import random_sha1
+from async.dispatch_session import DispatchSession
+from async.events import post
+
+received = {}
+done = threading.Event()
+
+
+class AgentHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        received[json.loads(data)['session_id']] = time.time()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write('{}')
+        if len(received) >= self.server.expected:
+            done.set()
+
+    def log_message(self, *args):
+        pass
+
+
+class AgentServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def register_agents(db, count, port, slots, label):
+    agent_ids = ['bench-%s' % random_sha1()[:8] for _ in range(count)]
+    with db.pipeline() as pipe:
+        for agent_id in agent_ids:
+            pipe.hmset(jdb.KEY_AGENT % agent_id,
+                       {'ip': '127.0.0.1', 'port': port, 'nick': agent_id,
+                        'state': jdb.AGENT_STATE_AVAIL, 'labels': label,
+                        'slots': slots, 'resources': '{}'})
+            pipe.sadd(jdb.KEY_ALL, agent_id)
+            # As /agent/register does, so DispatchSession finds them
+            set_labels(pipe, agent_id, [], [label])
+            pipe.sadd(jdb.KEY_AVAILABLE, agent_id)
+            reset_capacity(pipe, agent_id, {'slots': slots})
+            touch(pipe, agent_id)
+        pipe.execute()
+    return agent_ids
+
+
+def create_sessions(db, count, label):
+    build_id = 'Bbench%s' % random_sha1()[:8]
+    db.hmset(KEY_BUILD % build_id, {'job_name': 'bench', 'priority': 'normal',
+                                    'share': 1, 'next_sess_id': 0})
+    return build_id, ['%s-%d' % (build_id, create_session(db, build_id,
+                                                          labels = [label]))
+                      for _ in range(count)]
+
+
+def cleanup(db, agent_ids, build_id, session_ids, label):
+    with db.pipeline() as pipe:
+        for agent_id in agent_ids:
+            pipe.delete(jdb.KEY_AGENT % agent_id, jdb.KEY_AGENT_FREE % agent_id,
+                        jdb.KEY_AGENT_SESSIONS % agent_id)
+            pipe.srem(jdb.KEY_ALL, agent_id)
+            pipe.srem(jdb.KEY_AVAILABLE, agent_id)
+            pipe.zrem(jdb.KEY_SEEN, agent_id)
+        for session_id in session_ids:
+            pipe.delete(KEY_SESSION % session_id)
+            pipe.zrem(jdb.KEY_LEASES, session_id)
+            pipe.zrem(jdb.KEY_QUEUED_SESSIONS, session_id)
+        pipe.delete(KEY_BUILD % build_id, jdb.KEY_LABEL % label,
+                    jdb.KEY_LABEL_REGISTERED % label)
+        pipe.srem(jdb.KEY_LABELS, label)
+        pipe.execute()
+
+
+def percentile(values, p):
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--agents", type = "int", default = 10)
+    parser.add_option("--sessions", type = "int", default = 200)
+    parser.add_option("--interval", type = "float", default = 5,
+                      help = "ms between sessions")
+    parser.add_option("--port", type = "int", default = 6750)
+    parser.add_option("--timeout", type = "int", default = 60)
+    opts, args = parser.parse_args()
+
+    server = AgentServer(('127.0.0.1', opts.port), AgentHandler)
+    server.expected = opts.sessions
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    db = jdb.conn()
+    label = 'bench-%s' % random_sha1()[:8]
+    # Enough slots that no agent ever needs to check back in
+    slots = opts.sessions / opts.agents + 1
+    agent_ids = register_agents(db, opts.agents, opts.port, slots, label)
+    build_id, session_ids = create_sessions(db, opts.sessions, label)
+
+    sent = {}
+    try:
+        for session_id in session_ids:
+            sent[session_id] = time.time()
+            post(db, DispatchSession, session_id)
+            time.sleep(opts.interval / 1000.0)
+        done.wait(opts.timeout)
+    finally:
+        cleanup(db, agent_ids, build_id, session_ids, label)
+        server.shutdown()
+
+    latencies = sorted((received[s] - sent[s]) * 1000 for s in received)
+    print("%s: %d of %d sessions dispatched" %
+          (load_config().get('DISPATCH_VIA', 'events'), len(latencies),
+           opts.sessions))
+    if latencies:
+        print("latency (ms): p50 %.1f  p90 %.1f  p99 %.1f  max %.1f" %
+              (percentile(latencies, 50), percentile(latencies, 90),
+               percentile(latencies, 99), latencies[-1]))
+    if len(latencies) < opts.sessions:
+        # The numbers would only cover whatever made it through
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
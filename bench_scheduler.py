@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+    sci.bench_scheduler
+    ~~~~~~~~~~~~~~~~~~~
+
+    Simulates a pool of agents working off a large matrix build while
+    small jobs keep arriving, and prints the wait-time distribution per
+    job with plain FIFO queuing and with the fair queuing done by
+    async.scheduler.
+
+    :copyright: (c) 2012 by Victor Boivie
+    :license: Apache License 2.0
+"""
+from optparse import OptionParser
+import heapq
+import random
+
+from async.scheduler import start_tag, get_rank, CLASS_SPAN
+
+
+def make_workload(rnd, matrix_size, small_jobs, duration):
+    """Returns (arrival, job, priority, share, run time) tuples"""
+    sessions = [(0, 'matrix', 'normal', 1, rnd.randint(60, 600))
+                for _ in xrange(matrix_size)]
+    for i in xrange(small_jobs):
+        arrival = rnd.randint(0, duration)
+        job = 'small-%d' % (i % 5)
+        priority = 'high' if i % 10 == 0 else 'normal'
+        for _ in xrange(rnd.randint(1, 4)):
+            sessions.append((arrival, job, priority, 1,
+                             rnd.randint(30, 300)))
+    sessions.sort()
+    return sessions
+
+
+class Fifo(object):
+    def __init__(self):
+        self.heap = []
+
+    def push(self, arrival, seq, job, priority, share):
+        heapq.heappush(self.heap, (arrival, seq))
+
+    def pop(self):
+        return heapq.heappop(self.heap)[1]
+
+
+class Fair(object):
+    def __init__(self):
+        self.heap = []
+        self.vclock = {}
+        self.finish = {}
+
+    def push(self, arrival, seq, job, priority, share):
+        start, finish = start_tag(self.vclock.get(priority, 0),
+                                  self.finish.get((priority, job), 0), share)
+        self.finish[(priority, job)] = finish
+        score = get_rank(priority) * CLASS_SPAN + start
+        heapq.heappush(self.heap, (score, seq, priority, start))
+
+    def pop(self):
+        score, seq, priority, start = heapq.heappop(self.heap)
+        self.vclock[priority] = max(self.vclock.get(priority, 0), start)
+        return seq
+
+
+def simulate(sessions, queue, agents):
+    waits = [None] * len(sessions)
+    free = [0] * agents
+    pending = 0
+    for seq, (arrival, job, priority, share, run) in enumerate(sessions):
+        # Hand out queued sessions to agents freed up before this arrival
+        while pending and free[0] <= arrival:
+            now = heapq.heappop(free)
+            n = queue.pop()
+            pending -= 1
+            waits[n] = now - sessions[n][0]
+            heapq.heappush(free, now + sessions[n][4])
+        queue.push(arrival, seq, job, priority, share)
+        pending += 1
+        if free[0] <= arrival:
+            heapq.heappop(free)
+            n = queue.pop()
+            pending -= 1
+            waits[n] = arrival - sessions[n][0]
+            heapq.heappush(free, arrival + sessions[n][4])
+    while pending:
+        now = heapq.heappop(free)
+        n = queue.pop()
+        pending -= 1
+        waits[n] = now - sessions[n][0]
+        heapq.heappush(free, now + sessions[n][4])
+    return waits
+
+
+def percentile(values, p):
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def report(name, sessions, waits):
+    print("%s:" % name)
+    print("  %-16s %6s %8s %8s %8s %8s" % ('job', 'count', 'p50', 'p90',
+                                           'p99', 'max'))
+    groups = {}
+    for (arrival, job, priority, share, run), wait in zip(sessions, waits):
+        key = job if priority == 'normal' else '%s (%s)' % (job, priority)
+        groups.setdefault(key, []).append(wait)
+    for key in sorted(groups):
+        w = sorted(groups[key])
+        print("  %-16s %6d %8d %8d %8d %8d" % (key, len(w), percentile(w, 50),
+                                               percentile(w, 90),
+                                               percentile(w, 99), w[-1]))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--agents", type = "int", default = 20)
+    parser.add_option("--matrix", type = "int", default = 800)
+    parser.add_option("--small", type = "int", default = 200,
+                      help = "number of small builds")
+    parser.add_option("--duration", type = "int", default = 4 * 3600,
+                      help = "time span (s) the small builds arrive over")
+    parser.add_option("--seed", type = "int", default = 1)
+    opts, args = parser.parse_args()
+
+    sessions = make_workload(random.Random(opts.seed), opts.matrix,
+                             opts.small, opts.duration)
+    report("FIFO", sessions, simulate(sessions, Fifo(), opts.agents))
+    report("Fair share", sessions, simulate(sessions, Fair(), opts.agents))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+    sci.dispatcher
+    ~~~~~~~~~~~~~~
+
+    Handles agent check-ins and sessions to dispatch, as posted on the
+    event list by the jobserver, on a pool of threads
+
+    :copyright: (c) 2012 by Victor Boivie
+    :license: Apache License 2.0
+"""
+import logging
+import Queue
+import signal
+import threading
+import time
+
+import redis
+
+import jobserver.db as jdb
+from async.agent_available import AgentAvailable
+from async.dispatch_session import DispatchSession
+from async.matcher import MatchQueue
+from async.events import parse
+
+__version__ = "0.1"
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+HANDLERS = dict((h.__name__, h) for h in (AgentAvailable, DispatchSession,
+                                          MatchQueue))
+THREADS = 8
+# Seconds BLPOP blocks, i.e. how long a shutdown may take to notice
+POLL_TIMEOUT = 1
+
+
+class Dispatcher(object):
+    def __init__(self, threads = THREADS):
+        self.db = jdb.conn()
+        self.threads = threads
+        self.events = Queue.Queue(threads * 2)
+        self._shutdown = False
+
+    def status(self, s):
+        setproctitle('sci-dispatcher-%s: %s' % (__version__, s))
+
+    def run(self):
+        self.status("Starting")
+        self.register_signal_handlers()
+        workers = [threading.Thread(target = self.handle_events)
+                   for _ in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        self.work()
+        for worker in workers:
+            self.events.put(None)
+        for worker in workers:
+            worker.join()
+
+    def register_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self.schedule_shutdown)
+        signal.signal(signal.SIGINT, self.schedule_shutdown)
+        signal.signal(signal.SIGQUIT, self.schedule_shutdown)
+
+    def schedule_shutdown(self, signum, frame):
+        logger.info("Shutdown scheduled")
+        self._shutdown = True
+
+    def work(self):
+        self.status("Waiting for events")
+        while not self._shutdown:
+            try:
+                item = self.db.blpop(jdb.KEY_EVENTS, timeout = POLL_TIMEOUT)
+            except redis.exceptions.ConnectionError:
+                logger.warning("Connection to redis lost - retrying in 2")
+                time.sleep(2)
+                continue
+            if item:
+                # Blocks when all threads are busy, which leaves the
+                # backlog in redis
+                self.events.put(item[1])
+
+    def handle_events(self):
+        while True:
+            data = self.events.get()
+            if data is None:
+                return
+            try:
+                self.handle(data)
+            except Exception:
+                logger.exception("Failed to handle %s" % data)
+
+    def handle(self, data):
+        type, args, ts = parse(data)
+        handler = HANDLERS.get(type)
+        if not handler:
+            logger.error("Unknown event: %s" % data)
+            return
+        if ts:
+            logger.debug("%s%r waited %.1f ms" % (type, tuple(args),
+                                                   (time.time() - ts) * 1000))
+        handler.perform(*args)
+
+
+try:
+    from setproctitle import setproctitle
+    setproctitle  # workaround https://github.com/kevinw/pyflakes/issues/13
+except ImportError:
+    def setproctitle(name):
+        pass
+
+if __name__ == '__main__':
+    Dispatcher().run()
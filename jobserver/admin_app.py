@@ -1,53 +1,47 @@
-from flask import Blueprint, g
-import json
+from flask import Blueprint, Response, request, abort, jsonify, g
+from pyres import ResQ
 
-from jobserver.db import KEY_RECIPES, KEY_JOBS, KEY_TAG
-from jobserver.db import KEY_JOB, KEY_RECIPE
-from jobserver.job import Job
-from jobserver.recipe import Recipe
+from jobserver.rebuild import get_status, is_running
+import jobserver.bulk as bulk
+from async.rebuild_caches import RebuildCaches
 
 app = Blueprint('admin', __name__)
 
 
 @app.route('/rebuild_caches', methods=['POST'])
 def rebuild_caches():
-    tag_keys = g.db.keys(KEY_TAG % "*")
-    with g.db.pipeline() as pipe:
-        pipe.delete(KEY_RECIPES)
-        pipe.delete(KEY_JOBS)
-        for k in g.db.keys(KEY_TAG % "*"):
-            pipe.delete(k)
-
-        for tag_key in tag_keys:
-            pipe.delete(tag_key)
-
-        jobs = [r[16:] for r in g.repo.refs.keys()
-                if r.startswith('refs/heads/jobs')]
-        for name in jobs:
-            yaml_str, dbref = Job._get_from_archive(name)
-            job = Job.parse(name, yaml_str, dbref)
-            for tag in job.tags:
-                pipe.sadd(KEY_TAG % tag, 'j' + name)
-            pipe.hset(KEY_JOB % name, 'yaml', yaml_str)
-            pipe.hset(KEY_JOB % name, 'json', json.dumps(job._obj))
-            pipe.hset(KEY_JOB % name, 'description', job.description)
-            pipe.hset(KEY_JOB % name, 'tags', ",".join(job.tags))
-            pipe.hset(KEY_JOB % name, 'sha1', dbref)
-            pipe.sadd(KEY_JOBS, name)
-
-        recipes = [r[19:] for r in g.repo.refs.keys()
-                   if r.startswith('refs/heads/recipes')]
-        for name in recipes:
-            contents, dbref = Recipe._get_from_archive(name)
-            recipe = Recipe.parse(name, contents, dbref)
-            for tag in recipe.tags:
-                pipe.sadd(KEY_TAG % tag, 'r' + name)
-            pipe.hset(KEY_RECIPE % name, 'contents', recipe.contents)
-            pipe.hset(KEY_RECIPE % name, 'json', json.dumps(recipe.metadata))
-            pipe.hset(KEY_RECIPE % name, 'description', recipe.description)
-            pipe.hset(KEY_RECIPE % name, 'tags', ",".join(recipe.tags))
-            pipe.hset(KEY_RECIPE % name, 'sha1', dbref)
-            pipe.sadd(KEY_RECIPES, name)
-
-        pipe.execute()
-    return "done\n"
+    """Starts rebuilding the caches in the background. Poll
+    /rebuild_caches/status for how it goes."""
+    if is_running(g.ctx):
+        abort(409)
+    ResQ().enqueue(RebuildCaches, bool(request.args.get('full')))
+    resp = jsonify(**get_status(g.ctx))
+    resp.status_code = 202
+    return resp
+
+
+@app.route('/rebuild_caches/status', methods=['GET'])
+def rebuild_caches_status():
+    return jsonify(**get_status(g.ctx))
+
+
+@app.route('/import', methods=['POST'])
+def do_import():
+    message = request.args.get('message') or "Bulk import"
+    try:
+        if request.mimetype in ('application/x-tar', 'application/x-gzip',
+                                'application/gzip'):
+            docs = bulk.read_tar(request.stream)
+        else:
+            docs = bulk.read_yaml(request.data)
+        result = bulk.import_items(g.ctx, docs, message)
+    except bulk.BulkImportError as e:
+        abort(400, str(e))
+    return jsonify(**result)
+
+
+@app.route('/export', methods=['GET'])
+def do_export():
+    if request.args.get('format') == 'tar':
+        return Response(bulk.export_tar(g.ctx), mimetype='application/x-gzip')
+    return Response(bulk.export_yaml(g.ctx), mimetype='application/x-yaml')
@@ -0,0 +1,64 @@
+"""Cache affinity between sessions and agents.
+
+Agents advertise the caches they have warm, e.g. a checkout of a certain
+repo and branch, as opaque keys. Sessions name the keys they would like
+to find. Dispatch prefers a warm agent, and lets a session wait up to
+AFFINITY_WAIT seconds (from when it was created) for one to become
+available, rather than running it on a cold agent right away.
+"""
+import jobserver.db as jdb
+from jobserver.build import KEY_SESSION
+from jobserver.utils import get_hit_stats
+
+# How long a session waits for a warm agent, if there is one
+AFFINITY_WAIT = 60
+
+
+def parse_caches(caches):
+    if not isinstance(caches, (list, tuple)):
+        raise ValueError("caches must be a list")
+    caches = [unicode(c).strip() for c in caches]
+    if [c for c in caches if ',' in c]:
+        raise ValueError("cache keys can't contain ','")
+    return [c for c in caches if c]
+
+
+def set_caches(db, agent_id, caches):
+    """Replaces the caches advertised by the agent"""
+    key = jdb.KEY_AGENT_CACHES % agent_id
+    old = db.smembers(key)
+    new = set(caches)
+    with db.pipeline() as pipe:
+        for cache in old - new:
+            pipe.srem(jdb.KEY_CACHE_AGENTS % cache, agent_id)
+            pipe.srem(key, cache)
+        for cache in new - old:
+            pipe.sadd(jdb.KEY_CACHE_AGENTS % cache, agent_id)
+            pipe.sadd(key, cache)
+        pipe.execute()
+
+
+def warm_agents(db, caches, label_keys):
+    """Returns the live agents with the given labels that have any of
+    `caches` warm.
+    """
+    if not caches:
+        return set()
+    warm = db.sunion([jdb.KEY_CACHE_AGENTS % c for c in caches])
+    if label_keys:
+        warm &= db.sinter(label_keys)
+    return set(a for a in warm if db.zscore(jdb.KEY_SEEN, a) is not None)
+
+
+def wait_until(db, session_id):
+    """Returns the time the session stops waiting for a warm agent"""
+    created = db.hget(KEY_SESSION % session_id, 'created')
+    return int(created or 0) + AFFINITY_WAIT
+
+
+def record(db, hit):
+    db.hincrby(jdb.KEY_AFFINITY_STATS, 'hits' if hit else 'misses', 1)
+
+
+def get_stats(db):
+    return get_hit_stats(db, jdb.KEY_AFFINITY_STATS)
@@ -0,0 +1,283 @@
+import json
+
+import redis
+
+import jobserver.db as jdb
+from jobserver.build import set_session_queued
+from jobserver.build import KEY_SESSION
+from jobserver.build import SESSION_STATE_TO_AGENT, SESSION_STATE_RUNNING
+from jobserver.utils import get_ts
+
+# Agents that haven't been seen for this long are considered dead
+AGENT_EXPIRY_TTL = 2 * 60
+
+# Sessions are pushed to the agent's ip:port
+AGENT_MODE_PUSH = 'push'
+# The agent long-polls /agent/next for sessions
+AGENT_MODE_PULL = 'pull'
+
+
+def get_labels(info):
+    return [l for l in info.get('labels', '').split(',') if l]
+
+
+def set_labels(pipe, agent_id, old, new):
+    """Moves the agent from the label sets of `old` to those of `new`"""
+    for label in set(old) - set(new):
+        pipe.srem(jdb.KEY_LABEL % label, agent_id)
+        pipe.srem(jdb.KEY_LABEL_REGISTERED % label, agent_id)
+    for label in new:
+        pipe.sadd(jdb.KEY_LABEL % label, agent_id)
+        pipe.sadd(jdb.KEY_LABEL_REGISTERED % label, agent_id)
+        pipe.sadd(jdb.KEY_LABELS, label)
+
+
+def get_registered(db, labels):
+    """Returns the registered agents, live or not, that have all of
+    `labels`"""
+    if not labels:
+        return db.smembers(jdb.KEY_ALL)
+    agents = db.sinter([jdb.KEY_LABEL_REGISTERED % l for l in labels])
+    # Agents that haven't registered since labels were tracked
+    return agents | db.sinter([jdb.KEY_LABEL % l for l in labels])
+
+
+def can_satisfy(db, labels):
+    """Tells if any registered agent, live or not, has all of `labels`"""
+    if not labels:
+        return True
+    return bool(get_registered(db, labels))
+
+
+def can_fit(db, labels, needs):
+    """Tells if any registered agent with all of `labels` could run a
+    session that needs `needs` once it's idle. True if there are no such
+    agents yet, to compare with.
+    """
+    agents = sorted(get_registered(db, labels))
+    if not agents:
+        return True
+    with db.pipeline(transaction = False) as pipe:
+        for agent_id in agents:
+            pipe.hgetall(jdb.KEY_AGENT % agent_id)
+        infos = pipe.execute()
+    return any(fits(get_capacity(info), needs) for info in infos if info)
+
+
+def get_label_stats(db):
+    """Returns the number of registered, live and available agents of
+    every label.
+    """
+    labels = sorted(db.smembers(jdb.KEY_LABELS))
+    with db.pipeline(transaction = False) as pipe:
+        for label in labels:
+            pipe.scard(jdb.KEY_LABEL_REGISTERED % label)
+            pipe.scard(jdb.KEY_LABEL % label)
+            pipe.sinter(jdb.KEY_LABEL % label, jdb.KEY_AVAILABLE)
+        result = pipe.execute()
+    stats = {}
+    for i, label in enumerate(labels):
+        registered, live, available = result[i * 3:i * 3 + 3]
+        if registered or live:
+            stats[label] = dict(registered = registered, live = live,
+                                available = len(available))
+    return stats
+
+
+def parse_resources(resources):
+    """Validates a {name: amount} dict of resources, as advertised by
+    agents and declared by sessions.
+    """
+    if not isinstance(resources, dict):
+        raise ValueError("resources must be a mapping")
+    parsed = {}
+    for name, amount in resources.iteritems():
+        if not isinstance(amount, (int, long)) or amount < 0:
+            raise ValueError("invalid amount of %s: %r" % (name, amount))
+        parsed[str(name)] = amount
+    return parsed
+
+
+def get_capacity(info):
+    """Returns the total capacity of an agent from its info"""
+    capacity = json.loads(info.get('resources') or '{}')
+    capacity['slots'] = int(info.get('slots') or 1)
+    return capacity
+
+
+def get_free(db, agent_id):
+    return parse_free(db.hgetall(jdb.KEY_AGENT_FREE % agent_id))
+
+
+def parse_free(free):
+    if not free:
+        # Registered before agents had slots
+        return {'slots': 1}
+    return dict((name, int(amount)) for name, amount in free.iteritems())
+
+
+def fits(free, needs):
+    return all(free.get(name, 0) >= amount
+               for name, amount in needs.iteritems())
+
+
+def best_fit(frees, needs):
+    """Picks the agent that `needs` fits the tightest, i.e. the one left
+    with the least free capacity, so that agents with much room are kept
+    for sessions that need it. `frees` maps agent id -> free capacity.
+    Returns None if it fits none of them.
+    """
+    best, best_left = None, None
+    for agent_id in sorted(frees):
+        free = frees[agent_id]
+        if not fits(free, needs):
+            continue
+        left = (free['slots'] - needs['slots'],
+                sum(free.get(name, 0) - amount
+                    for name, amount in needs.iteritems() if name != 'slots'))
+        if best_left is None or left < best_left:
+            best, best_left = agent_id, left
+    return best
+
+
+def reset_capacity(pipe, agent_id, capacity):
+    pipe.delete(jdb.KEY_AGENT_FREE % agent_id,
+                jdb.KEY_AGENT_SESSIONS % agent_id,
+                jdb.KEY_AGENT_INBOX % agent_id)
+    pipe.hmset(jdb.KEY_AGENT_FREE % agent_id, capacity)
+
+
+def set_capacity_state(pipe, agent_id, free):
+    """Marks the agent available or busy depending on its free slots"""
+    if free['slots'] > 0:
+        pipe.hset(jdb.KEY_AGENT % agent_id, 'state', jdb.AGENT_STATE_AVAIL)
+        pipe.sadd(jdb.KEY_AVAILABLE, agent_id)
+    else:
+        pipe.hset(jdb.KEY_AGENT % agent_id, 'state', jdb.AGENT_STATE_BUSY)
+        pipe.srem(jdb.KEY_AVAILABLE, agent_id)
+
+
+def take(pipe, agent_id, session_id, needs, free):
+    """Takes the capacity `session_id` needs from the agent, and from
+    `free`. Use within multi.
+    """
+    for name, amount in needs.iteritems():
+        pipe.hincrby(jdb.KEY_AGENT_FREE % agent_id, name, -amount)
+        free[name] -= amount
+    pipe.sadd(jdb.KEY_AGENT_SESSIONS % agent_id, session_id)
+
+
+def watch_capacity(pipe, agent_id, session_id):
+    """Watches the capacity bookkeeping of the agent. Returns its state,
+    free capacity, and whether it holds `session_id`.
+    """
+    pipe.watch(jdb.KEY_AGENT % agent_id, jdb.KEY_AGENT_FREE % agent_id,
+               jdb.KEY_AGENT_SESSIONS % agent_id)
+    state = pipe.hget(jdb.KEY_AGENT % agent_id, 'state')
+    held = pipe.sismember(jdb.KEY_AGENT_SESSIONS % agent_id, session_id)
+    return state, get_free(pipe, agent_id), held
+
+
+def release(pipe, agent_id, session_id, needs, free):
+    """Gives the capacity held for `session_id` back to the agent, and
+    adds it to `free`. Use within multi.
+    """
+    pipe.srem(jdb.KEY_AGENT_SESSIONS % agent_id, session_id)
+    for name, amount in needs.iteritems():
+        pipe.hincrby(jdb.KEY_AGENT_FREE % agent_id, name, amount)
+        free[name] = free.get(name, 0) + amount
+
+
+def touch(db, agent_id, ts = None):
+    """Records a heartbeat. Returns True if the agent had no heartbeat
+    recorded, i.e. it is new or it has been reaped.
+    """
+    return bool(db.zadd(jdb.KEY_SEEN, ts or get_ts(), agent_id))
+
+
+def get_seen(db, agent_id):
+    seen = db.zscore(jdb.KEY_SEEN, agent_id)
+    if seen is None:
+        # Reaped agents keep their last heartbeat in the hash
+        seen = db.hget(jdb.KEY_AGENT % agent_id, 'seen')
+    return int(seen or 0)
+
+
+def get_all_seen(db):
+    return dict((agent_id, int(seen)) for agent_id, seen in
+                db.zrange(jdb.KEY_SEEN, 0, -1, withscores = True))
+
+
+def revive(db, agent_id):
+    """Restores a reaped agent that has started to check in again.
+
+    Returns True if it was idle when reaped, and is now available again.
+    Agents that were running sessions stay inactive until they report
+    back as available.
+    """
+    info = db.hgetall(jdb.KEY_AGENT % agent_id)
+    if not info or info['state'] != jdb.AGENT_STATE_INACTIVE:
+        return False
+    was_idle = info.get('reaped_state') == jdb.AGENT_STATE_AVAIL
+    with db.pipeline() as pipe:
+        for label in get_labels(info):
+            pipe.sadd(jdb.KEY_LABEL % label, agent_id)
+        if was_idle:
+            pipe.hset(jdb.KEY_AGENT % agent_id, 'state', jdb.AGENT_STATE_AVAIL)
+        pipe.execute()
+    return was_idle
+
+
+def reap_agents(db, now = None):
+    """Expires all agents whose last heartbeat is older than
+    AGENT_EXPIRY_TTL in a single transaction.
+
+    Expired agents are marked inactive and removed from the available
+    and label sets, and get their full capacity back. Sessions they had
+    been given or were running are put back in the queued state, and
+    their ids are returned so that the caller can schedule them again.
+    """
+    deadline = (now or get_ts()) - AGENT_EXPIRY_TTL
+    while True:
+        with db.pipeline() as pipe:
+            try:
+                pipe.watch(jdb.KEY_SEEN)
+                dead = pipe.zrangebyscore(jdb.KEY_SEEN, '-inf', deadline,
+                                          withscores = True)
+                if not dead:
+                    return []
+                for agent_id, seen in dead:
+                    pipe.watch(jdb.KEY_AGENT % agent_id,
+                               jdb.KEY_AGENT_SESSIONS % agent_id)
+                infos = [pipe.hgetall(jdb.KEY_AGENT % a) for a, seen in dead]
+                held = [pipe.smembers(jdb.KEY_AGENT_SESSIONS % a)
+                        for a, seen in dead]
+                requeue = []
+                for session_id in set().union(*held):
+                    state = pipe.hget(KEY_SESSION % session_id, 'state')
+                    if state in (SESSION_STATE_TO_AGENT,
+                                 SESSION_STATE_RUNNING):
+                        requeue.append(session_id)
+
+                pipe.multi()
+                for (agent_id, seen), info, sessions in zip(dead, infos,
+                                                            held):
+                    pipe.zrem(jdb.KEY_SEEN, agent_id)
+                    pipe.srem(jdb.KEY_AVAILABLE, agent_id)
+                    for label in get_labels(info):
+                        pipe.srem(jdb.KEY_LABEL % label, agent_id)
+                    if info:
+                        state = info.get('state', '')
+                        if sessions:
+                            state = jdb.AGENT_STATE_BUSY
+                        reset_capacity(pipe, agent_id, get_capacity(info))
+                        pipe.hmset(jdb.KEY_AGENT % agent_id,
+                                   {'state': jdb.AGENT_STATE_INACTIVE,
+                                    'reaped_state': state,
+                                    'seen': int(seen)})
+                for session_id in requeue:
+                    set_session_queued(pipe, session_id)
+                pipe.execute()
+                return requeue
+            except redis.WatchError:
+                continue
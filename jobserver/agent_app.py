@@ -2,24 +2,45 @@ import json
 import time
 
 from flask import Blueprint, request, abort, jsonify, current_app, g
-from pyres import ResQ
 
-from jobserver.utils import get_ts
 import jobserver.db as jdb
 from jobserver.build import create_session, get_session, Build
 from jobserver.build import set_session_done, set_session_running
-from jobserver.build import get_session_title
+from jobserver.build import get_session_title, get_session_labels
+from jobserver.build import get_session_needs, get_session_caches
 from jobserver.build import SESSION_STATE_TO_BACKEND, SESSION_STATE_DONE
+from jobserver.build import SESSION_STATE_TO_AGENT, SESSION_STATE_WAITING
+from jobserver.build import KEY_SESSION, RESULT_SUCCESS
+from jobserver.build_cache import store as store_result
+from jobserver import memo
+from jobserver.limits import get_limited, release_parent
+from jobserver.deps import parse_deps, add_deps
 from jobserver.job import Job
 from jobserver.recipe import Recipe
 from jobserver.slog import add_slog
+from jobserver.agent import touch, revive, get_seen, get_all_seen, get_labels
+from jobserver.agent import parse_resources, get_capacity, get_free
+from jobserver.agent import reset_capacity, set_capacity_state
+from jobserver.agent import watch_capacity, release
+from jobserver.agent import AGENT_MODE_PUSH, AGENT_MODE_PULL
+from jobserver.agent import set_labels, get_label_stats
+from jobserver.affinity import parse_caches, set_caches
+from jobserver.affinity import get_stats as get_affinity_stats
+from jobserver.lease import ack
 from async.agent_available import AgentAvailable
 from async.dispatch_session import DispatchSession
+from async.events import post
+from async.scheduler import split_score, queue_stats
 from jobserver.utils import chunks
 
 app = Blueprint('agents', __name__)
 
 AGENT_HISTORY_LIMIT = 100
+# Seconds /next waits for a session by default, and at most. Waiting
+# counts as a heartbeat, so keep it well below AGENT_EXPIRY_TTL
+NEXT_TIMEOUT = 30
+NEXT_TIMEOUT_MAX = 60
+QUEUE_LIST_LIMIT = 100
 
 
 class LogItem(object):
@@ -60,24 +81,43 @@ def add_to_history(pipe, agent_id, session_id):
 @app.route('/register', methods=['POST'])
 def do_register():
     agent_id = request.json['id']
+    try:
+        slots = int(request.json.get('slots', 1))
+        resources = parse_resources(request.json.get('resources', {}))
+        caches = parse_caches(request.json.get('caches', []))
+    except (TypeError, ValueError) as e:
+        abort(400, str(e))
+    if slots < 1:
+        abort(400, "slots must be at least 1")
+    if request.json.get("mode", AGENT_MODE_PUSH) not in (AGENT_MODE_PUSH,
+                                                          AGENT_MODE_PULL):
+        abort(400, "mode must be 'push' or 'pull'")
 
     info = {"ip": request.remote_addr,
             'nick': request.json.get('nick', ''),
-            "port": request.json["port"],
+            "port": request.json.get("port", ''),
+            "mode": request.json.get("mode", AGENT_MODE_PUSH),
             "state": jdb.AGENT_STATE_AVAIL,
-            "seen": get_ts(),
-            "labels": ",".join(request.json["labels"])}
+            "labels": ",".join(l for l in request.json["labels"] if l),
+            "slots": slots,
+            "resources": json.dumps(resources)}
 
-    with g.db.pipeline() as pipe:
+    labels = [l for l in request.json["labels"] if l]
+
+    def update(pipe):
+        old = get_labels(pipe.hgetall(jdb.KEY_AGENT % agent_id))
+        pipe.multi()
         pipe.hmset(jdb.KEY_AGENT % agent_id, info)
         pipe.sadd(jdb.KEY_ALL, agent_id)
+        # A (re)started agent runs nothing
+        reset_capacity(pipe, agent_id, get_capacity(info))
+        touch(pipe, agent_id)
+        set_labels(pipe, agent_id, old, labels)
 
-        for label in request.json["labels"]:
-            pipe.sadd(jdb.KEY_LABEL % label, agent_id)
-        pipe.execute()
+    g.db.transaction(update, jdb.KEY_AGENT % agent_id)
+    set_caches(g.db, agent_id, caches)
 
-    r = ResQ()
-    r.enqueue(AgentAvailable, agent_id)
+    post(g.db, AgentAvailable, agent_id)
     return jsonify()
 
 
@@ -85,20 +125,37 @@ def do_register():
 def check_in_available(agent_id):
     session_id = request.json['session_id']
     build_id, num = session_id.split('-')
-    with g.db.pipeline() as pipe:
+    # The agent may have been reaped while running a long session
+    labels = get_labels(g.db.hgetall(jdb.KEY_AGENT % agent_id))
+    needs = get_session_needs(g.db, session_id)
+
+    def update(pipe):
+        state, free, held = watch_capacity(pipe, agent_id, session_id)
+        pipe.multi()
         set_session_done(pipe, session_id, request.json['result'],
                          request.json['output'], request.json['log_file'])
         if int(num) == 0:
             Build.set_done(build_id, request.json['result'], pipe=pipe)
 
-        add_slog(pipe, session_id, SessionDone(request.json['result']))
+        add_slog(g.ctx, session_id, SessionDone(request.json['result']),
+                 pipe = pipe)
 
-        pipe.hmset(jdb.KEY_AGENT % agent_id, dict(state = jdb.AGENT_STATE_AVAIL,
-                                                  seen = get_ts()))
-        pipe.execute()
+        if held:
+            release(pipe, agent_id, session_id, needs, free)
+        if state != jdb.AGENT_STATE_TRIPPED:
+            set_capacity_state(pipe, agent_id, free)
+        for label in labels:
+            pipe.sadd(jdb.KEY_LABEL % label, agent_id)
+        touch(pipe, agent_id)
 
-    r = ResQ()
-    r.enqueue(AgentAvailable, agent_id)
+    g.db.transaction(update, jdb.KEY_AGENT % agent_id)
+
+    if int(num) == 0 and request.json['result'] == RESULT_SUCCESS:
+        store_result(g.ctx, build_id, request.json['output'])
+    if request.json['result'] == RESULT_SUCCESS:
+        memo.store(g.db, session_id, request.json['output'])
+    DispatchSession.release_dependents(g.ctx, session_id)
+    post(g.db, AgentAvailable, agent_id)
     return jsonify()
 
 
@@ -107,37 +164,77 @@ def check_in_busy(agent_id):
     with g.db.pipeline() as pipe:
         session_id = request.json['session_id']
         set_session_running(pipe, session_id)
-        add_slog(pipe, session_id, SessionStarted())
+        ack(pipe, session_id)
+        add_slog(g.ctx, session_id, SessionStarted(), pipe = pipe)
         add_to_history(pipe, agent_id, session_id)
-
-        pipe.hmset(jdb.KEY_AGENT % agent_id, dict(state = jdb.AGENT_STATE_BUSY,
-                                                  seen = get_ts()))
         pipe.execute()
+    # A reaped agent gets its labels back, and stays inactive until it
+    # reports as available
+    if touch(g.db, agent_id):
+        revive(g.db, agent_id)
     return jsonify()
 
 
 @app.route('/ping/<agent_id>', methods=['POST'])
 def ping(agent_id):
-    g.db.hset(jdb.KEY_AGENT % agent_id, 'seen', get_ts())
+    input = request.json or {}
+    if 'caches' in input:
+        try:
+            set_caches(g.db, agent_id, parse_caches(input['caches']))
+        except ValueError as e:
+            abort(400, str(e))
+    if touch(g.db, agent_id) and revive(g.db, agent_id):
+        post(g.db, AgentAvailable, agent_id)
     return jsonify()
 
 
 @app.route('/dispatch', methods=['POST'])
 def dispatch():
     input = request.json
+    try:
+        resources = parse_resources(input.get('resources', {}))
+        if 'caches' in input:
+            caches = parse_caches(input['caches'])
+        else:
+            caches = get_session_caches(g.db, input['parent'])
+        deps = parse_deps(g.db, input['build_id'], input['parent'],
+                          input.get('after', []))
+        memo_key = None
+        # Sessions that depend on others are run for real
+        if input.get('memo') and not deps:
+            inputs = input['memo'] if input['memo'] is not True else {}
+            memo_key = memo.memo_key(g.db, input['build_id'],
+                                     input['run_info'], inputs)
+    except ValueError as e:
+        abort(400, str(e))
+    state = SESSION_STATE_WAITING if deps else SESSION_STATE_TO_BACKEND
     session_no = create_session(g.db, input['build_id'],
                                 parent = input['parent'],
                                 labels = input['labels'],
                                 run_info = input['run_info'],
-                                state = SESSION_STATE_TO_BACKEND)
+                                state = state,
+                                resources = resources,
+                                caches = caches)
     session_id = '%s-%s' % (input['build_id'], session_no)
+    # The parent waits for it, without holding a place under the limits
+    release_parent(g.db, input['parent'])
     ri = input['run_info'] or {}
     args = ", ".join(ri.get('args', []))
     title = "%s(%s)" % (ri.get('step_name', 'main'), args)
     item = RunAsync(session_no, title)
-    add_slog(g.db, input['parent'], item)
-    r = ResQ()
-    r.enqueue(DispatchSession, session_id)
+    add_slog(g.ctx, input['parent'], item)
+    if memo_key:
+        entry = None if input.get('rerun') else memo.lookup(g.db, memo_key)
+        if entry:
+            memo.apply(g.ctx, session_id, entry)
+            return jsonify(session_id = session_id,
+                           memo_from = entry['session'])
+        g.db.hset(KEY_SESSION % session_id, 'memo_key', memo_key)
+    if not deps:
+        post(g.db, DispatchSession, session_id)
+    elif not add_deps(g.db, session_id, deps):
+        # Everything it runs after is done already
+        DispatchSession.deps_done(g.ctx, session_id)
     return jsonify(session_id = session_id)
 
 
@@ -153,13 +250,13 @@ def get_session_result(session_id):
         return jsonify(state = info['state'])
 
 
-@app.route('/session/<session_id>')
-def get_session_info(session_id):
+def session_manifest(session_id):
+    """Returns everything an agent needs to run the session"""
     session = get_session(g.db, session_id)
     build_uuid = session_id.split('-')[0]
-    build = Build.load(build_uuid)
-    recipe = Recipe.load(build.recipe, build.recipe_ref)
-    job = Job.load(build.job_name, build.job_ref)
+    build = Build.load(g.ctx, build_uuid)
+    recipe = Recipe.load(g.ctx, build.recipe, build.recipe_ref)
+    job = Job.load(g.ctx, build.job_name, build.job_ref)
 
     # Calculate the actual parameters - setting defaults if static value.
     # (parameters that have a function as default value will have them
@@ -172,36 +269,83 @@ def get_session_info(session_id):
         if 'default' in param and not name in parameters:
             parameters[name] = param['default']
 
-    return jsonify(run_info = session['run_info'] or {},
-                   build_uuid = build_uuid,
-                   build_name = "%s-%d" % (build.job_name, build.number),
-                   recipe = recipe.contents,
-                   ss_token = build.ss_token,
-                   ss_url = current_app.config['SS_URL'],
-                   parameters = parameters)
+    return dict(run_info = session['run_info'] or {},
+                build_uuid = build_uuid,
+                build_name = "%s-%d" % (build.job_name, build.number),
+                recipe = recipe.contents,
+                ss_token = build.ss_token,
+                ss_url = current_app.config['SS_URL'],
+                parameters = parameters)
+
+
+@app.route('/session/<session_id>')
+def get_session_info(session_id):
+    return jsonify(**session_manifest(session_id))
+
+
+@app.route('/next/<agent_id>', methods=['POST'])
+def next_session(agent_id):
+    """Long-polls for the next session dispatched to a pull-mode agent.
+    Returns the session id along with its manifest, or nothing if none
+    came within the timeout.
+    """
+    timeout = min(request.args.get('timeout', NEXT_TIMEOUT, type = int),
+                  NEXT_TIMEOUT_MAX)
+    deadline = time.time() + timeout
+    while True:
+        if touch(g.db, agent_id) and revive(g.db, agent_id):
+            post(g.db, AgentAvailable, agent_id)
+        remaining = int(deadline - time.time())
+        if remaining < 1:
+            return jsonify()
+        item = g.db.blpop(jdb.KEY_AGENT_INBOX % agent_id, timeout = remaining)
+        if not item:
+            return jsonify()
+        session_id = item[1]
+        # Skip sessions that went elsewhere after their lease ran out
+        state, agent = g.db.hmget(KEY_SESSION % session_id, ('state', 'agent'))
+        if state == SESSION_STATE_TO_AGENT and agent == agent_id:
+            return jsonify(session_id = session_id,
+                           **session_manifest(session_id))
 
 
 @app.route('/list')
 def list_agents():
     fields = ('#', 'agent:info:*->nick', 'agent:info:*->state',
-              'agent:info:*->seen', 'agent:info:*->labels')
-    all = [{'id': d[0], 'nick': d[1], 'state': d[2], 'seen': int(d[3]),
-            'labels': [t for t in d[4].split(',') if t]}
-            for d in chunks(g.db.sort(jdb.KEY_ALL, get=fields), 5)]
+              'agent:info:*->seen', 'agent:info:*->labels',
+              'agent:info:*->slots', 'agent:free:*->slots')
+    seen = get_all_seen(g.db)
+    all = [{'id': d[0], 'nick': d[1], 'state': d[2],
+            'seen': seen.get(d[0], int(d[3] or 0)),
+            'labels': [t for t in d[4].split(',') if t],
+            'slots': int(d[5] or 1),
+            'free_slots': int(d[6] or 0)}
+            for d in chunks(g.db.sort(jdb.KEY_ALL, get=fields), 7)]
     return jsonify(agent_no = len(all),
                    agents = all)
 
 
+@app.route('/labels')
+def list_labels():
+    return jsonify(labels = get_label_stats(g.db))
+
+
 @app.route('/queue')
 def list_queue():
+    limit = request.args.get('limit', QUEUE_LIST_LIMIT, type = int)
     queue = []
-    for did in g.db.zrange(jdb.KEY_QUEUE, 0, -1):
-        info = g.db.get(jdb.KEY_DISPATCH_INFO % did)
-        if info:
-            info = json.loads(info)
-            queue.append({"id": did,
-                          "labels": info["labels"]})
-    return jsonify(queue = queue)
+    limited = get_limited(g.db)
+    for session_id, score in g.db.zrange(jdb.KEY_QUEUED_SESSIONS, 0, limit - 1,
+                                         withscores = True):
+        priority, start = split_score(score)
+        queue.append({"id": session_id,
+                      "priority": priority,
+                      "labels": sorted(get_session_labels(g.db, session_id)),
+                      "limited": limited.get(session_id)})
+    return jsonify(queue = queue,
+                   classes = queue_stats(g.db),
+                   affinity = get_affinity_stats(g.db),
+                   memo = memo.get_stats(g.db))
 
 
 @app.route('/details/<agent_id>')
@@ -212,7 +356,7 @@ def agent_details(agent_id):
     history = []
     for session_id in g.db.lrange(jdb.KEY_AGENT_HISTORY % agent_id, 0, 19):
         build_uuid = session_id.split('-')[0]
-        build = Build.load(build_uuid)
+        build = Build.load(g.ctx, build_uuid)
         session = get_session(g.db, session_id)
         history.append({'session_id': session_id,
                         'build_id': build.build_id,
@@ -226,6 +370,12 @@ def agent_details(agent_id):
     return jsonify(id = agent_id,
                    nick = info.get('nick', ''),
                    state = info["state"],
-                   seen = int(info["seen"]),
-                   labels = info["labels"].split(","),
+                   seen = get_seen(g.db, agent_id),
+                   labels = get_labels(info),
+                   capacity = get_capacity(info),
+                   free = get_free(g.db, agent_id),
+                   caches = sorted(g.db.smembers(jdb.KEY_AGENT_CACHES %
+                                                 agent_id)),
+                   sessions = sorted(g.db.smembers(jdb.KEY_AGENT_SESSIONS %
+                                                   agent_id)),
                    history = history)
@@ -7,7 +7,7 @@ from jobserver.recipe_app import app as recipe_app
 from jobserver.agent_app import app as agent_app
 from jobserver.search_app import app as search_app
 from jobserver.admin_app import app as admin_app
-from jobserver.gitdb import config
+from jobserver.context import Context
 from jobserver.db import conn
 
 app = Flask(__name__)
@@ -27,8 +27,8 @@ def getinfo():
 
 @app.before_request
 def before_request():
-    g.repo = config(app.config['JS_PATH'])
-    g.db = conn()
+    g.ctx = Context(conn(), app.config['JS_PATH'])
+    g.db = g.ctx.db
 
 
 @app.after_request
@@ -1,6 +1,6 @@
+import collections
 import json
-
-from flask import g
+import zlib
 
 from sci.utils import random_sha1
 from jobserver.utils import get_ts
@@ -10,11 +10,28 @@ from jobserver.db import BUILD_HISTORY
 KEY_JOB_BUILDS = 'job:builds:%s'
 KEY_BUILD = 'build:%s'
 KEY_BUILD_SESSIONS = 'sessions:%s'
+# Artifacts of the build, in the order they were added
+KEY_BUILD_ARTIFACTS = 'artifacts:%s'
 
 KEY_SESSION = 'session:%s'
+# Large values of a session, compressed, kept out of its hash
+KEY_SESSION_BLOB = 'session:%s:%s'
+# Artifacts added by a memoized session, see memo.py
+KEY_SESSION_ARTIFACTS = 'session:artifacts:%s'
+
+# Values (as JSON) larger than this are kept in a blob of their own
+SESSION_BLOB_THRESHOLD = 8 * 1024
+# Stands in for a value kept in a blob; JSON never starts with '@'
+BLOB_MARKER = '@zlib'
+# Results with more output (as JSON) or artifacts than this aren't reused,
+# see build_cache.py and memo.py
+REUSE_MAX_OUTPUT = 64 * 1024
+REUSE_MAX_ARTIFACTS = 1000
 
 # The session is created, but not yet scheduled to run
 SESSION_STATE_NEW = 'new'
+# The session waits for sessions it depends on to finish, see deps.py
+SESSION_STATE_WAITING = 'waiting'
 # The session is scheduled to be handled by the backend
 SESSION_STATE_TO_BACKEND = 'to-backend'
 # No agent can processed the session, so it's queued and awaiting an agent
@@ -32,12 +49,22 @@ RESULT_FAILED = 'failed'
 RESULT_ERROR = 'error'
 RESULT_ABORTED = 'aborted'
 
+# Scheduling classes. Queued sessions of a higher class are always
+# dispatched first; within a class the jobs share the agents fairly.
+PRIORITY_HIGH = 'high'
+PRIORITY_NORMAL = 'normal'
+PRIORITY_LOW = 'low'
+PRIORITIES = (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+
 BUILD_HISTORY_LIMIT = 100
+# Artifacts included with the build; the rest are fetched page by page
+ARTIFACTS_PAGE = 100
 
 
 class Build(object):
 
-    def __init__(self, build_uuid, **kwargs):
+    def __init__(self, ctx, build_uuid, **kwargs):
+        self._ctx         = ctx
         self._uuid        = build_uuid
         self.job_name     = kwargs['job_name']
         self.job_ref      = kwargs['job_ref']
@@ -50,9 +77,23 @@ class Build(object):
         self.next_sess_id = kwargs.get('next_sess_id', 0)
         self.ss_token     = kwargs.get('ss_token', 'SS' + build_uuid)
         self.parameters   = kwargs.get('parameters', {})
-        self.artifacts    = kwargs.get('artifacts', [])
+        self.artifact_count = int(kwargs.get('artifact_count', 0))
+        self._artifacts   = kwargs.get('artifacts')
+        # Of those, the ones kept in the build from before artifacts got a
+        # list of their own, and come first
+        self._legacy_count = int(kwargs.get('legacy_count', 0))
         self.state        = kwargs.get('state', SESSION_STATE_NEW)
         self.result       = kwargs.get('result', RESULT_UNKNOWN)
+        self.priority     = kwargs.get('priority', PRIORITY_NORMAL)
+        self.share        = int(kwargs.get('share', 1))
+        # Key and ttl of the result in the job's cache, see build_cache.py,
+        # and the build the result came from, if it came from the cache
+        self.cache_key    = kwargs.get('cache_key', '')
+        self.cache_ttl    = int(kwargs.get('cache_ttl', 0))
+        self.cached_from  = kwargs.get('cached_from', '')
+        # Sessions of the job, and of this build, that may run at a time
+        self.max_sessions = int(kwargs.get('max_sessions', 0))
+        self.max_build_sessions = int(kwargs.get('max_build_sessions', 0))
 
     def as_dict(self):
         return dict(job_name = self.job_name,
@@ -67,25 +108,39 @@ class Build(object):
                     ss_token = self.ss_token,
                     parameters = self.parameters,
                     artifacts = self.artifacts,
+                    artifact_count = self.artifact_count,
                     state = self.state,
-                    result = self.result)
+                    result = self.result,
+                    priority = self.priority,
+                    share = self.share,
+                    cache_key = self.cache_key,
+                    cache_ttl = self.cache_ttl,
+                    cached_from = self.cached_from,
+                    max_sessions = self.max_sessions,
+                    max_build_sessions = self.max_build_sessions)
+
+    @property
+    def artifacts(self):
+        """The first ARTIFACTS_PAGE artifacts, see get_artifacts"""
+        if self._artifacts is None:
+            self._artifacts = Build.get_artifacts(self._ctx, self.uuid, 0,
+                                                  ARTIFACTS_PAGE)
+        return self._artifacts
 
     def save(self):
         build = self.as_dict()
+        del build['artifacts']
+        # The counter only covers the list
+        build['artifact_count'] -= self._legacy_count
         build['parameters'] = json.dumps(self.parameters)
-        build['artifacts'] = json.dumps(self.artifacts)
-        g.db.hmset(KEY_BUILD % self.uuid, build)
+        self._ctx.db.hmset(KEY_BUILD % self.uuid, build)
 
     @classmethod
-    def set_description(self, build_uuid, description, pipe = None):
-        if not pipe:
-            pipe = g.db
+    def set_description(self, build_uuid, description, pipe):
         pipe.hset(KEY_BUILD % build_uuid, 'description', description)
 
     @classmethod
-    def set_build_id(self, build_uuid, build_id, pipe = None):
-        if not pipe:
-            pipe = g.db
+    def set_build_id(self, build_uuid, build_id, pipe):
         pipe.hset(KEY_BUILD % build_uuid, 'build_id', build_id)
 
     @classmethod
@@ -101,61 +156,95 @@ class Build(object):
         pipe.hmset(KEY_BUILD % build_uuid, {'state': state})
 
     @classmethod
-    def get_job_name(self, build_uuid):
-        return g.db.hget(KEY_BUILD % build_uuid, 'job_name')
+    def get_job_name(self, ctx, build_uuid):
+        return ctx.db.hget(KEY_BUILD % build_uuid, 'job_name')
 
     @property
     def uuid(self):
         return self._uuid
 
     @classmethod
-    def create(cls, job, parameters = {}, description = ''):
+    def create(cls, ctx, job, parameters = {}, description = '',
+               priority = None, inputs = None, build_uuid = None):
+        if priority not in PRIORITIES:
+            priority = job.priority
         recipe_ref = job.recipe_ref
         if not recipe_ref:
-            recipe_ref = Recipe.load(job.recipe).ref
-
-        build_uuid = 'B%s' % random_sha1()
-
-        build = Build(build_uuid,
+            recipe_ref = Recipe.load(ctx, job.recipe).ref
+        cache_key, cache_ttl = '', 0
+        if job.cache:
+            # build_cache needs Build
+            from jobserver.build_cache import cache_key as get_cache_key
+            cache_key = get_cache_key(job, recipe_ref, parameters,
+                                      inputs) or ''
+            cache_ttl = job.cache['ttl']
+
+        build_uuid = build_uuid or new_build_uuid()
+
+        build = Build(ctx, build_uuid,
                       job_name = job.name, job_ref = job.ref,
                       recipe = job.recipe, recipe_ref = recipe_ref,
-                      parameters = parameters, description = description)
+                      parameters = parameters, description = description,
+                      priority = priority, share = job.share,
+                      artifacts = [], cache_key = cache_key,
+                      cache_ttl = cache_ttl,
+                      max_sessions = job.max_sessions,
+                      max_build_sessions = job.max_build_sessions)
         build.save()
         # Create the main session
-        create_session(g.db, build.uuid)
+        create_session(ctx.db, build.uuid, resources = job.resources,
+                       caches = job.caches)
 
-        number = g.db.rpush(KEY_JOB_BUILDS % job.name, build.uuid)
+        number = ctx.db.rpush(KEY_JOB_BUILDS % job.name, build.uuid)
         build.number = number
         build.build_id = '%s-%d' % (job.name, number)
-        g.db.hmset(KEY_BUILD % build.uuid, {'number': build.number,
-                                            'build_id': build.build_id})
+        ctx.db.hmset(KEY_BUILD % build.uuid, {'number': build.number,
+                                              'build_id': build.build_id})
         return build
 
     @classmethod
-    def add_artifact(cls, build_uuid, entry):
-        key = KEY_BUILD % build_uuid
+    def add_artifact(cls, build_uuid, entry, pipe):
+        pipe.rpush(KEY_BUILD_ARTIFACTS % build_uuid, json.dumps(entry))
+        pipe.hincrby(KEY_BUILD % build_uuid, 'artifact_count', 1)
 
-        def update(pipe):
-            files = json.loads(pipe.hget(key, 'artifacts'))
-            files.append(entry)
-            pipe.multi()
-            pipe.hset(key, 'artifacts', json.dumps(files))
-
-        g.db.transaction(update, key)
+    @classmethod
+    def get_artifacts(cls, ctx, build_uuid, start = 0, num = ARTIFACTS_PAGE):
+        # Builds from before artifacts got a list of their own have the
+        # first ones in the build
+        legacy = json.loads(ctx.db.hget(KEY_BUILD % build_uuid,
+                                        'artifacts') or '[]')
+        artifacts = legacy[start:start + num]
+        start = max(start - len(legacy), 0)
+        num -= len(artifacts)
+        if num > 0:
+            entries = ctx.db.lrange(KEY_BUILD_ARTIFACTS % build_uuid,
+                                    start, start + num - 1)
+            artifacts += [json.loads(e) for e in entries]
+        return artifacts
 
     @classmethod
-    def load(cls, build_uuid):
-        build = g.db.hgetall(KEY_BUILD % build_uuid)
+    def load(cls, ctx, build_uuid):
+        build = ctx.db.hgetall(KEY_BUILD % build_uuid)
         if not build:
             return None
         build['number'] = int(build['number'])
         build['parameters'] = json.loads(build['parameters'])
-        build['artifacts'] = json.loads(build['artifacts'])
-        return Build(build_uuid, **build)
+        # Builds from before artifacts got a list of their own, and that
+        # may have added to the list since
+        if 'artifacts' in build:
+            build['legacy_count'] = len(json.loads(build.pop('artifacts')))
+            build['artifact_count'] = build['legacy_count'] + \
+                int(build.get('artifact_count', 0))
+        return Build(ctx, build_uuid, **build)
+
+
+def new_build_uuid():
+    return 'B%s' % random_sha1()
 
 
 def create_session(db, build_id, parent = None, labels = [],
-                   run_info = None, state = SESSION_STATE_NEW):
+                   run_info = None, state = SESSION_STATE_NEW,
+                   resources = None, caches = None):
     ri = run_info or {}
     args = ", ".join(ri.get('args', []))
     title = "%s(%s)" % (ri.get('step_name', 'main'), args)
@@ -165,8 +254,9 @@ def create_session(db, build_id, parent = None, labels = [],
                    result = RESULT_UNKNOWN,
                    parent = parent,
                    labels = ",".join(labels),
+                   resources = json.dumps(resources or {}),
+                   caches = ",".join(caches or []),
                    agent = '',
-                   run_info = json.dumps(run_info),
                    log_file = '',
                    created = get_ts(),
                    started = 0,
@@ -174,10 +264,70 @@ def create_session(db, build_id, parent = None, labels = [],
                    output = json.dumps(None))
     session_no = db.hincrby(KEY_BUILD % build_id, 'next_sess_id', 1) - 1
     session_id = '%s-%s' % (build_id, session_no)
-    db.hmset(KEY_SESSION % session_id, session)
+    with db.pipeline() as pipe:
+        session['run_info'] = _dump_value(pipe, session_id, 'run_info',
+                                          run_info)
+        pipe.hmset(KEY_SESSION % session_id, session)
+        pipe.execute()
     return session_no
 
 
+def _dump_value(pipe, session_id, name, value):
+    """Returns what to store in the session hash for the value, and puts
+    it in a blob if it's large"""
+    data = json.dumps(value)
+    if len(data) <= SESSION_BLOB_THRESHOLD:
+        pipe.delete(KEY_SESSION_BLOB % (session_id, name))
+        return data
+    pipe.set(KEY_SESSION_BLOB % (session_id, name), zlib.compress(data))
+    return BLOB_MARKER
+
+
+def _load_value(db, session_id, name, data):
+    if data == BLOB_MARKER:
+        data = zlib.decompress(db.get(KEY_SESSION_BLOB % (session_id, name)))
+    return json.loads(data)
+
+
+class LazySession(collections.Mapping):
+    """A session as returned by get_session. Its output and run_info are
+    only decoded, and fetched if kept in a blob, when first looked up, be
+    it by [], get or converting it to a dict."""
+    LAZY = ('output', 'run_info')
+
+    def __init__(self, db, session_id, session):
+        self._db = db
+        self._session_id = session_id
+        self._raw = dict((name, session.pop(name, None))
+                         for name in self.LAZY)
+        self._session = session
+
+    def __getitem__(self, name):
+        if name not in self._session:
+            if name not in self.LAZY:
+                raise KeyError(name)
+            data = self._raw[name]
+            if data is None:
+                value = {} if name == 'run_info' else None
+            else:
+                value = _load_value(self._db, self._session_id, name, data)
+            self._session[name] = value
+        return self._session[name]
+
+    def __setitem__(self, name, value):
+        self._session[name] = value
+
+    def __contains__(self, name):
+        # Without loading it
+        return name in self._session or name in self.LAZY
+
+    def __iter__(self):
+        return iter(set(self._session) | set(self.LAZY))
+
+    def __len__(self):
+        return len(set(self._session) | set(self.LAZY))
+
+
 def get_session_title(session):
     return session.get('title', '')
 
@@ -193,24 +343,33 @@ def get_session(db, session_id):
     session = db.hgetall(KEY_SESSION % session_id)
     if not session:
         return None
-    session['labels'] = set(session['labels'].split(','))
-    session['labels'].remove('')  # if labels is empty
-    session['run_info'] = json.loads(session.get('run_info', '{}'))
-    session['output'] = json.loads(session['output'])
+    session['labels'] = set(l for l in session['labels'].split(',') if l)
+    session['resources'] = json.loads(session.get('resources', '{}'))
+    session['caches'] = [c for c in session.get('caches', '').split(',') if c]
     session['created'] = int(session.get('created', '0'))
     session['started'] = int(session.get('started', '0'))
     session['ended'] = int(session.get('ended', '0'))
-    return session
+    return LazySession(db, session_id, session)
 
 
 def set_session_done(pipe, session_id, result, output, log_file):
     set_session_state(pipe, session_id, SESSION_STATE_DONE)
+    output = _dump_value(pipe, session_id, 'output', output)
     pipe.hmset(KEY_SESSION % session_id, {'result': result,
-                                          'output': json.dumps(output),
+                                          'output': output,
                                           'log_file': log_file,
                                           'ended': get_ts()})
 
 
+def add_session_artifact(pipe, session_id, entry):
+    pipe.rpush(KEY_SESSION_ARTIFACTS % session_id, json.dumps(entry))
+
+
+def get_session_artifacts(db, session_id, num):
+    return [json.loads(e) for e in
+            db.lrange(KEY_SESSION_ARTIFACTS % session_id, 0, num - 1)]
+
+
 def set_session_queued(pipe, session_id):
     set_session_state(pipe, session_id, SESSION_STATE_QUEUED)
 
@@ -226,6 +385,19 @@ def set_session_running(pipe, session_id):
 
 
 def get_session_labels(db, session_id):
-    labels = set(db.hget(KEY_SESSION % session_id, 'labels').split(','))
-    labels.remove('')
-    return labels
+    labels = db.hget(KEY_SESSION % session_id, 'labels') or ''
+    return set(l for l in labels.split(',') if l)
+
+
+def get_session_needs(db, session_id):
+    """Returns the agent capacity the session takes up: the resources it
+    has declared, and one slot unless it says otherwise.
+    """
+    needs = json.loads(db.hget(KEY_SESSION % session_id, 'resources') or '{}')
+    needs.setdefault('slots', 1)
+    return needs
+
+
+def get_session_caches(db, session_id):
+    caches = db.hget(KEY_SESSION % session_id, 'caches') or ''
+    return [c for c in caches.split(',') if c]
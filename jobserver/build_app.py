@@ -1,15 +1,17 @@
-import json
 from flask import Blueprint, request, abort, jsonify, g
-from pyres import ResQ
 
-from jobserver.slog import KEY_SLOG
+from jobserver.slog import get_slog, next_id
 from jobserver.db import KEY_AGENT, BUILD_HISTORY
-from jobserver.job import Job
-from jobserver.build import Build, set_session_running
+from jobserver.job import Job, COALESCE_QUEUED
+from jobserver.build import Build, set_session_running, ARTIFACTS_PAGE
+from jobserver.build import new_build_uuid
 from jobserver.build import set_session_done, get_session, get_session_title
 from jobserver.build import KEY_JOB_BUILDS, set_session_queued, SESSION_STATE_DONE
-from jobserver.utils import chunks
+from jobserver.utils import chunks, get_ts
+from jobserver.deps import get_graph, analyze
+from jobserver import build_cache, coalesce
 from async.dispatch_session import DispatchSession
+from async.events import post
 
 app = Blueprint('build', __name__)
 
@@ -18,8 +20,8 @@ app = Blueprint('build', __name__)
 def do_create_build(job_name):
     input = request.json
 
-    job = Job.load(job_name, input.get('job_ref'))
-    build = Build.create(job,
+    job = Job.load(g.ctx, job_name, input.get('job_ref'))
+    build = Build.create(g.ctx, job,
                          parameters = input.get('parameters', {}),
                          description = input.get('description', ''))
 
@@ -30,14 +32,41 @@ def do_create_build(job_name):
 def do_start_build(job_name):
     input = request.json
 
-    job = Job.load(job_name, input.get('job_ref'))
-    build = Build.create(job,
-                         parameters = input.get('parameters', {}),
-                         description = input.get('description', ''))
+    job = Job.load(g.ctx, job_name, input.get('job_ref'))
+    parameters = input.get('parameters', {})
+    build_uuid = new_build_uuid()
+    superseded = None
+    if job.coalesce:
+        fp = coalesce.fingerprint(job.ref, parameters)
+        while True:
+            prev = coalesce.claim(g.db, job, fp, build_uuid)
+            if not prev or job.coalesce != COALESCE_QUEUED:
+                superseded = prev
+                break
+            build = coalesce.wait_for_build(g.ctx, prev)
+            if build:
+                return jsonify(**build.as_dict())
+            # Whoever was creating it went away; this build takes its
+            # place, unless yet another one did so first
+            if coalesce.replace(g.db, job, fp, prev, build_uuid):
+                break
+
+    build = Build.create(g.ctx, job,
+                         parameters = parameters,
+                         description = input.get('description', ''),
+                         priority = input.get('priority'),
+                         inputs = input.get('inputs'),
+                         build_uuid = build_uuid)
+    if superseded:
+        coalesce.supersede(g.ctx, superseded, build.uuid)
+    if build.cache_key and not input.get('nocache'):
+        entry = build_cache.lookup(g.db, job_name, build.cache_key)
+        if entry:
+            build_cache.apply(g.ctx, build, entry)
+            return jsonify(**Build.load(g.ctx, build.uuid).as_dict())
     session_id = '%s-0' % build.uuid
     set_session_queued(g.db, session_id)
-    r = ResQ()
-    r.enqueue(DispatchSession, session_id)
+    post(g.db, DispatchSession, session_id)
     return jsonify(**build.as_dict())
 
 
@@ -60,12 +89,11 @@ def get_build2(job_name, number):
     build_uuid = g.db.lindex(KEY_JOB_BUILDS % job_name, number - 1)
     if build_uuid is None:
         abort(404, 'Not Found')
-    build = Build.load(build_uuid)
+    build = Build.load(g.ctx, build_uuid)
     if not build:
         abort(404, 'Invalid Build ID')
 
-    log = g.db.lrange(KEY_SLOG % build_uuid, 0, 1000)
-    log = [json.loads(l) for l in log]
+    log = get_slog(g.db, build_uuid)
     # Fetch information about all sessions
     sessions = []
     for i in range(int(build.next_sess_id)):
@@ -95,13 +123,11 @@ def get_build2(job_name, number):
 
 @app.route('/<build_uuid>/progress', methods=['GET'])
 def get_log(build_uuid):
-    start = int(request.args.get('start', 0))
+    # Continues from the 'next' id of the previous call
+    start = request.args.get('start', '-')
     nmax = int(request.args.get('max', 1000))
-    log = g.db.lrange(KEY_SLOG % build_uuid, start=start, end=start + nmax - 1)
-    log = [json.loads(l) for l in log]
-
-    for idx in xrange(len(log)):
-        log[idx]['id'] = idx + start
+    log = get_slog(g.db, build_uuid, start, nmax)
+    next = next_id(log[-1]['id']) if log else start
 
     filtered = []
     for l in log:
@@ -110,7 +136,31 @@ def get_log(build_uuid):
                          'session-done', 'job-error'):
             filtered.append(l)
 
-    return jsonify(log = filtered)
+    return jsonify(log = filtered, next = next)
+
+
+@app.route('/<build_uuid>/artifacts', methods=['GET'])
+def get_artifacts(build_uuid):
+    start = int(request.args.get('start', 0))
+    nmax = int(request.args.get('max', ARTIFACTS_PAGE))
+    build = Build.load(g.ctx, build_uuid)
+    if not build:
+        abort(404, 'Invalid Build ID')
+    return jsonify(artifacts = Build.get_artifacts(g.ctx, build_uuid,
+                                                   start, nmax),
+                   count = build.artifact_count)
+
+
+@app.route('/<build_uuid>/dag', methods=['GET'])
+def get_dag(build_uuid):
+    """Returns the dependencies between the sessions, the sessions free to
+    run and the critical path"""
+    nodes = get_graph(g.db, build_uuid)
+    if not nodes:
+        abort(404, 'Invalid Build ID')
+    ready, path, length = analyze(nodes, get_ts())
+    return jsonify(sessions = nodes, ready = ready,
+                   critical_path = path, critical_length = length)
 
 
 @app.route('/recent/done', methods=['GET'])
@@ -0,0 +1,128 @@
+"""Caching of build results.
+
+A job that declares `cache` in its YAML has its successful builds
+remembered, by a key made from the recipe ref, the job ref, the
+parameters (with the defaults filled in) and, optionally, hashes of
+inputs the one starting the build passes along. A later build with the
+same key is finished right away with the output and artifacts of the
+cached one, instead of taking up an agent.
+
+Each job keeps the CACHE_MAX_ENTRIES most recently used results.
+
+    cache:
+      ttl: 86400           # seconds to remember a result
+      inputs: [manifest]   # input hashes required for a build to be cached
+
+or just `cache: true`, see Job.parse.
+"""
+import hashlib
+import json
+
+import jobserver.db as jdb
+from jobserver.build import Build, KEY_BUILD, RESULT_SUCCESS
+from jobserver.build import REUSE_MAX_OUTPUT, REUSE_MAX_ARTIFACTS
+from jobserver.build import set_session_done
+from jobserver.slog import add_slog
+from jobserver.utils import get_ts, get_hit_stats
+
+CACHE_MAX_ENTRIES = 1000
+
+
+def resolve_parameters(job, parameters):
+    """Fills in the static defaults of the parameters, the way the agent
+    gets them"""
+    resolved = dict(parameters)
+    for name, param in job.get_merged_params().iteritems():
+        if 'default' in param and name not in resolved:
+            resolved[name] = param['default']
+    return resolved
+
+
+def cache_key(job, recipe_ref, parameters, inputs):
+    """Returns the key for a build, or None if it can't be cached because
+    some of the declared inputs weren't given"""
+    inputs = inputs or {}
+    if [i for i in job.cache['inputs'] if i not in inputs]:
+        return None
+    key = [recipe_ref, job.ref, resolve_parameters(job, parameters),
+           dict((i, inputs[i]) for i in job.cache['inputs'])]
+    return hashlib.sha1(json.dumps(key, sort_keys = True)).hexdigest()
+
+
+def lookup(db, job_name, key):
+    """Returns the cached result for the key, if any, and counts the
+    hit or miss"""
+    entry = db.hgetall(jdb.KEY_BUILD_CACHE % (job_name, key))
+    with db.pipeline() as pipe:
+        if entry:
+            pipe.zadd(jdb.KEY_BUILD_CACHE_LRU % job_name, get_ts(), key)
+        pipe.hincrby(jdb.KEY_BUILD_CACHE_STATS % job_name,
+                     'hits' if entry else 'misses', 1)
+        pipe.execute()
+    return entry or None
+
+
+def store(ctx, build_uuid, output):
+    """Remembers the result of a successful build, if its job is cached"""
+    job_name, key, ttl, artifacts = ctx.db.hmget(
+        KEY_BUILD % build_uuid,
+        ('job_name', 'cache_key', 'cache_ttl', 'artifact_count'))
+    if not key:
+        return False
+    output = json.dumps(output)
+    if len(output) > REUSE_MAX_OUTPUT or \
+            int(artifacts or 0) > REUSE_MAX_ARTIFACTS:
+        return False
+    cache_key = jdb.KEY_BUILD_CACHE % (job_name, key)
+    lru_key = jdb.KEY_BUILD_CACHE_LRU % job_name
+    now = get_ts()
+    with ctx.db.pipeline() as pipe:
+        pipe.hmset(cache_key, {'build': build_uuid, 'output': output,
+                               'stored': now})
+        pipe.expire(cache_key, int(ttl))
+        pipe.zadd(lru_key, now, key)
+        # Entries stored this long ago have expired by themselves
+        pipe.zremrangebyscore(lru_key, '-inf', now - int(ttl))
+        pipe.execute()
+    evict(ctx.db, job_name)
+    return True
+
+
+def evict(db, job_name):
+    """Drops the least recently used results of the job beyond
+    CACHE_MAX_ENTRIES"""
+    lru_key = jdb.KEY_BUILD_CACHE_LRU % job_name
+    excess = db.zcard(lru_key) - CACHE_MAX_ENTRIES
+    if excess <= 0:
+        return
+    with db.pipeline() as pipe:
+        for key in db.zrange(lru_key, 0, excess - 1):
+            pipe.delete(jdb.KEY_BUILD_CACHE % (job_name, key))
+            pipe.zrem(lru_key, key)
+        pipe.execute()
+
+
+def apply(ctx, build, entry):
+    """Finishes the build with the cached result"""
+    session_id = '%s-0' % build.uuid
+    artifacts = Build.get_artifacts(ctx, entry['build'], 0,
+                                    REUSE_MAX_ARTIFACTS)
+    with ctx.db.pipeline() as pipe:
+        set_session_done(pipe, session_id, RESULT_SUCCESS,
+                         json.loads(entry['output']), '')
+        Build.set_done(build.uuid, RESULT_SUCCESS, pipe = pipe)
+        pipe.hset(KEY_BUILD % build.uuid, 'cached_from', entry['build'])
+        for artifact in artifacts:
+            Build.add_artifact(build.uuid, artifact, pipe = pipe)
+        add_slog(ctx, session_id,
+                 json.dumps(dict(type = 'session-done',
+                                 params = dict(result = RESULT_SUCCESS,
+                                               cached_from = entry['build']))),
+                 pipe = pipe)
+        add_slog(ctx, session_id, json.dumps(dict(type = 'job-done')),
+                 pipe = pipe)
+        pipe.execute()
+
+
+def get_stats(db, job_name):
+    return get_hit_stats(db, jdb.KEY_BUILD_CACHE_STATS % job_name)
@@ -0,0 +1,206 @@
+from cStringIO import StringIO
+import posixpath
+import tarfile
+
+import yaml
+
+from jobserver.db import KEY_JOB, KEY_RECIPE
+from jobserver.gitdb import build_commit, update_head
+from jobserver.gitdb import NoChangesException, CommitException
+from jobserver.job import Job
+from jobserver.recipe import Recipe
+from jobserver.utils import get_ts
+import jobserver.timers as timers
+
+JOB_BRANCH = 'refs/heads/jobs/%s'
+RECIPE_BRANCH = 'refs/heads/recipes/%s'
+
+
+class BulkImportError(Exception):
+    pass
+
+
+def read_yaml(data):
+    """Reads a multi-document YAML stream. Every document is either
+    {job: <name>, yaml: <job yaml>} or {recipe: <name>, contents: <recipe>},
+    optionally with 'old' set to the ref it is expected to replace.
+    """
+    try:
+        return [d for d in yaml.safe_load_all(data) if d]
+    except yaml.YAMLError as e:
+        raise BulkImportError(e)
+
+
+def read_tar(fileobj):
+    """Reads a (possibly compressed) tarball with jobs/<name>.yaml and
+    recipes/<name>.py members.
+    """
+    docs = []
+    try:
+        tar = tarfile.open(fileobj = fileobj, mode = 'r|*')
+        for member in tar:
+            if not member.isfile():
+                continue
+            dirname, fname = posixpath.split(member.name)
+            kind = posixpath.basename(dirname)
+            if kind == 'jobs' and fname.endswith('.yaml'):
+                docs.append({'job': fname[:-5],
+                             'yaml': tar.extractfile(member).read()})
+            elif kind == 'recipes' and fname.endswith('.py'):
+                docs.append({'recipe': fname[:-3],
+                             'contents': tar.extractfile(member).read()})
+        tar.close()
+    except tarfile.TarError as e:
+        raise BulkImportError(e)
+    return docs
+
+
+def _parse(ctx, doc):
+    if not isinstance(doc, dict):
+        raise BulkImportError("Unknown document: %r" % doc)
+    try:
+        if 'job' in doc:
+            item = Job.parse(ctx, doc['job'], doc['yaml'])
+            return JOB_BRANCH % item.name, 'job.yaml', item.yaml, item
+        elif 'recipe' in doc:
+            item = Recipe.parse(ctx, doc['recipe'], doc['contents'])
+            return RECIPE_BRANCH % item.name, 'build.py', item.contents, item
+    except Exception as e:
+        raise BulkImportError("Invalid document %r: %s" % (doc, e))
+    raise BulkImportError("Unknown document: %r" % doc)
+
+
+def import_items(ctx, docs, message = "Bulk import"):
+    """Commits all jobs and recipes in `docs`, writing the objects as a
+    single pack. Refs are updated with compare-and-swap, and the redis
+    caches of everything that changed are refreshed in one pipeline.
+    """
+    repo = ctx.repo
+    parsed = [_parse(ctx, doc) + (doc.get('old'),) for doc in docs]
+
+    objects = []
+    pending = []
+    unchanged = []
+    conflicts = []
+    for branch, fname, data, item, old in parsed:
+        if old is None:
+            try:
+                old = repo.refs[branch]
+            except KeyError:
+                pass
+        try:
+            commit, objs = build_commit(repo, [(fname, 0100644, data)],
+                                        parent = old, message = message)
+        except NoChangesException:
+            unchanged.append(branch[11:])
+            continue
+        except KeyError:
+            # Expected to replace a ref this repo doesn't have, e.g. one
+            # exported from another server
+            conflicts.append(branch[11:])
+            continue
+        item._ref = commit.id
+        objects.extend(objs)
+        pending.append((branch, old, item))
+    repo.add_objects(objects)
+
+    applied = []
+    for branch, old, item in pending:
+        try:
+            update_head(repo, branch, old, item.ref)
+            applied.append(item)
+        except CommitException:
+            conflicts.append(branch[11:])
+
+    write_caches(ctx, applied)
+    return dict(jobs = dict((i.name, i.ref) for i in applied
+                            if isinstance(i, Job)),
+                recipes = dict((i.name, i.ref) for i in applied
+                               if isinstance(i, Recipe)),
+                unchanged = unchanged,
+                conflicts = conflicts)
+
+
+def write_caches(ctx, items, fresh_tags = False):
+    """Writes the redis caches of `items` in one transaction, watching the
+    cached tags and timers it replaces. With `fresh_tags`, the tag sets
+    are taken to have been dropped already.
+    """
+    if not items:
+        return
+    jobs = [item for item in items if isinstance(item, Job)]
+    new_timers = timers.allocate(ctx.db, sum(len(j.schedules) for j in jobs))
+    keys = [(KEY_JOB if isinstance(item, Job) else KEY_RECIPE) % item.name
+            for item in items]
+
+    def update(pipe):
+        with ctx.db.pipeline(transaction = False) as reads:
+            for key in keys:
+                reads.hmget(key, ('tags', 'timers'))
+            prev = reads.execute()
+        timer_ids = new_timers
+        pipe.multi()
+        for item, (tags, cur_timers) in zip(items, prev):
+            prev_tags = set(t for t in (tags or '').split(',')
+                            if t and not fresh_tags)
+            if isinstance(item, Job):
+                cur_timers = [t for t in (cur_timers or '').split(',') if t]
+                count = len(item.schedules)
+                item._write_cache(pipe, prev_tags, cur_timers,
+                                  timer_ids[:count])
+                timer_ids = timer_ids[count:]
+            else:
+                item._write_cache(pipe, prev_tags)
+
+    ctx.db.transaction(update, *keys)
+
+
+def export_items(ctx):
+    """Yields one document per job and recipe, in the format read_yaml
+    accepts.
+    """
+    for ref in sorted(ctx.repo.refs.keys()):
+        if ref.startswith('refs/heads/jobs/'):
+            name = ref[16:]
+            data, sha1 = Job._get_from_archive(ctx, name)
+            yield {'job': name, 'old': sha1, 'yaml': data}
+        elif ref.startswith('refs/heads/recipes/'):
+            name = ref[19:]
+            data, sha1 = Recipe._get_from_archive(ctx, name)
+            yield {'recipe': name, 'old': sha1, 'contents': data}
+
+
+def export_yaml(ctx):
+    for doc in export_items(ctx):
+        yield yaml.safe_dump(doc, explicit_start = True,
+                             default_flow_style = False)
+
+
+class _ChunkWriter(object):
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def drain(self):
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def export_tar(ctx):
+    out = _ChunkWriter()
+    tar = tarfile.open(fileobj = out, mode = 'w|gz')
+    for doc in export_items(ctx):
+        if 'job' in doc:
+            name, data = 'jobs/%s.yaml' % doc['job'], doc['yaml']
+        else:
+            name, data = 'recipes/%s.py' % doc['recipe'], doc['contents']
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = get_ts()
+        tar.addfile(info, StringIO(data))
+        yield out.drain()
+    tar.close()
+    yield out.drain()
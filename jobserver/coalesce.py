@@ -0,0 +1,133 @@
+"""Coalescing of builds started with the same parameters.
+
+A job that declares `coalesce` keeps track of its builds that haven't
+started yet, by their parameters. Starting another one with the same
+parameters then either returns the build that is already waiting
+(COALESCE_QUEUED), or aborts that build in favour of the new one
+(COALESCE_SUPERSEDE). The check and the update happen in one
+transaction, so triggers firing at the same time can't both get a build
+of their own.
+"""
+import hashlib
+import json
+import logging
+import time
+
+import jobserver.db as jdb
+from jobserver.build import Build, KEY_SESSION, RESULT_ABORTED
+from jobserver.build import SESSION_STATE_NEW, SESSION_STATE_TO_BACKEND
+from jobserver.build import SESSION_STATE_QUEUED, set_session_done
+from jobserver.job import COALESCE_QUEUED
+from jobserver.slog import add_slog
+
+# How long to wait for a build that is being created by someone else
+CREATE_WAIT = 5
+CREATE_POLL = 0.1
+
+
+def fingerprint(job_ref, parameters):
+    key = [job_ref or '', parameters]
+    return hashlib.sha1(json.dumps(key, sort_keys = True)).hexdigest()
+
+
+def _is_pending(state):
+    # No state yet means the build is still being created
+    return state in (None, SESSION_STATE_NEW, SESSION_STATE_TO_BACKEND,
+                     SESSION_STATE_QUEUED)
+
+
+def claim(db, job, fp, build_uuid):
+    """Registers build_uuid as the pending build with the fingerprint,
+    unless the job returns the pending build there is. Returns the
+    identical build that hadn't started, if any. Builds of the job that
+    have started since are dropped on the way."""
+    key = jdb.KEY_JOB_PENDING % job.name
+    prev = []
+
+    def update(pipe):
+        pending = pipe.hgetall(key)
+        session_keys = [KEY_SESSION % ('%s-0' % uuid)
+                        for uuid in pending.values()]
+        if session_keys:
+            # Changes to the state abort the transaction
+            pipe.watch(*session_keys)
+        stale = [f for f, uuid in pending.iteritems()
+                 if not _is_pending(pipe.hget(KEY_SESSION % ('%s-0' % uuid),
+                                              'state'))]
+        cur = pending.get(fp) if fp not in stale else None
+        prev[:] = [cur]
+        if cur and job.coalesce == COALESCE_QUEUED and not stale:
+            return
+        pipe.multi()
+        if stale:
+            pipe.hdel(key, *stale)
+        if not cur or job.coalesce != COALESCE_QUEUED:
+            pipe.hset(key, fp, build_uuid)
+
+    db.transaction(update, key)
+    return prev[0]
+
+
+def replace(db, job, fp, old_uuid, new_uuid):
+    """Registers new_uuid as the pending build with the fingerprint in
+    place of old_uuid, which never got created. False if the fingerprint
+    has moved on meanwhile."""
+    key = jdb.KEY_JOB_PENDING % job.name
+    replaced = []
+
+    def update(pipe):
+        replaced[:] = []
+        if pipe.hget(key, fp) != old_uuid:
+            return
+        replaced.append(new_uuid)
+        pipe.multi()
+        pipe.hset(key, fp, new_uuid)
+
+    db.transaction(update, key)
+    return bool(replaced)
+
+
+def wait_for_build(ctx, build_uuid):
+    """Returns the build, waiting a while if it's still being created.
+    None if it isn't done being created by then."""
+    end = time.time() + CREATE_WAIT
+    while True:
+        build = Build.load(ctx, build_uuid)
+        if build and build.number:
+            return build
+        if time.time() > end:
+            return None
+        time.sleep(CREATE_POLL)
+
+
+def supersede(ctx, build_uuid, new_uuid):
+    """Aborts the build, if it still hasn't started"""
+    session_id = '%s-0' % build_uuid
+    key = KEY_SESSION % session_id
+    aborted = []
+
+    def update(pipe):
+        state = pipe.hget(key, 'state')
+        aborted[:] = []
+        # A build that is still being created is left alone, to not race
+        # with it being queued
+        if state not in (SESSION_STATE_TO_BACKEND, SESSION_STATE_QUEUED):
+            return
+        aborted.append(session_id)
+        pipe.multi()
+        pipe.zrem(jdb.KEY_QUEUED_SESSIONS, session_id)
+        set_session_done(pipe, session_id, RESULT_ABORTED,
+                         dict(superseded_by = new_uuid), '')
+        Build.set_done(build_uuid, RESULT_ABORTED, pipe = pipe)
+        add_slog(ctx, session_id,
+                 json.dumps(dict(type = 'session-done',
+                                 params = dict(result = RESULT_ABORTED,
+                                               superseded_by = new_uuid))),
+                 pipe = pipe)
+
+    # The matcher and DispatchSession WATCH these too, so the session is
+    # either dispatched before this, or never
+    ctx.db.transaction(update, key, jdb.KEY_QUEUED_SESSIONS)
+    if aborted:
+        logging.info("Build %s superseded by %s" % (build_uuid, new_uuid))
+    return bool(aborted)
@@ -0,0 +1,43 @@
+import os
+
+from jobserver.db import conn
+from jobserver.gitdb import config
+
+_worker_config = None
+
+
+class Context(object):
+    """Data access context handed to the model layer.
+
+    Bundles the redis connection and the config repository, so that
+    `Build`, `Job` and `Recipe` can be used from the jobserver as well as
+    from the resque workers, crond and batch tools. The repository is
+    only opened when first needed.
+    """
+    def __init__(self, db = None, path = None, repo = None):
+        self.db = db or conn()
+        self._path = path
+        self._repo = repo
+
+    @property
+    def repo(self):
+        if self._repo is None:
+            self._repo = config(self._path)
+        return self._repo
+
+
+def load_config():
+    """Loads the same configuration as the jobserver does"""
+    global _worker_config
+    if _worker_config is None:
+        from flask import Config
+        cfg = Config(os.path.dirname(os.path.dirname(__file__)))
+        cfg.from_object('sci_config')
+        cfg.from_envvar('SCI_SETTINGS', silent=True)
+        _worker_config = cfg
+    return _worker_config
+
+
+def worker_context():
+    """Creates a context for code running outside of a request"""
+    return Context(conn(), load_config()['JS_PATH'])
@@ -2,24 +2,66 @@ import redis
 
 pool = redis.ConnectionPool(host='localhost', port=6379, db=0)
 
+# Live agents with a certain label
 KEY_LABEL = 'ahq:label:%s'
+# All registered agents with a certain label, live or not, and all
+# labels ever registered
+KEY_LABEL_REGISTERED = 'ahq:reglabel:%s'
+KEY_LABELS = 'ahq:labels'
 KEY_AGENT = 'agent:info:%s'
 KEY_QUEUED_SESSIONS = 'sessionq'
+# Fair queuing state: the virtual clock of every priority class, the
+# finish tag of every job within a class, and enqueue/wait counters
+KEY_SCHED_VCLOCK = 'sessionq:vclock'
+KEY_SCHED_FINISH = 'sessionq:finish:%s'
+KEY_SCHED_STATS = 'sessionq:stats'
 
 KEY_ALL = 'agents:all'
 KEY_AVAILABLE = 'agents:avail'
+# Capacity left on an agent: 'slots' and any resources it advertised
+KEY_AGENT_FREE = 'agent:free:%s'
+# Sessions an agent has been given and not yet reported back on
+KEY_AGENT_SESSIONS = 'agent:sessions:%s'
+# Sessions dispatched to a pull-mode agent, not yet fetched by it
+KEY_AGENT_INBOX = 'agent:inbox:%s'
+# Warm caches (e.g. a repo checkout) an agent has advertised, and the
+# agents that have a certain cache
+KEY_AGENT_CACHES = 'agent:caches:%s'
+KEY_CACHE_AGENTS = 'cache:agents:%s'
+# Heartbeats: agent id scored by the time it was last seen
+KEY_SEEN = 'agents:seen'
 
 KEY_QUEUE = 'js:queue'
 KEY_ALLOCATION = "ahq:alloc:%s"
 
+# Dispatched sessions scored by the time the agent must have ack'ed them
+KEY_LEASES = 'dispatch:leases'
+# Sessions whose dispatch failed, scored by when to try again
+KEY_RETRY = 'dispatch:retry'
+# Events for the dispatcher daemon, see async/events.py
+KEY_EVENTS = 'dispatch:events'
+# Set while a matching pass of queued sessions and free agents is due
+KEY_MATCH_PENDING = 'dispatch:match'
+# Sessions queued to wait for an agent with a warm cache, scored by
+# when to stop waiting; and the cache hit/miss counters
+KEY_AFFINITY = 'dispatch:affinity'
+KEY_AFFINITY_STATS = 'dispatch:affinity:stats'
+# Agents taken out of rotation, scored by when to let them back
+KEY_TRIPPED = 'agents:tripped'
+# Sessions dispatched per build and per job with concurrency limits, and
+# the queued sessions held back by a limit in the last matching pass
+KEY_BUILD_RUNNING = 'limits:build:%s'
+KEY_JOB_RUNNING = 'limits:job:%s'
+KEY_LIMITED = 'dispatch:limited'
+
 # Agent has not checked in for a long time
 AGENT_STATE_INACTIVE = "inactive"
-# Agent is online and idle
+# Agent is online and has free slots
 AGENT_STATE_AVAIL = "available"
-# A session has been dispatched to the agent
-AGENT_STATE_PENDING = "pending"
-# The agent has acknowledged the session and is now busy
+# All slots of the agent are taken
 AGENT_STATE_BUSY = "busy"
+# Dispatching to the agent keeps failing - it's cooling down
+AGENT_STATE_TRIPPED = "tripped"
 
 # Session history for a certain slave
 KEY_AGENT_HISTORY = 'agent:history:%s'
@@ -27,14 +69,38 @@ KEY_AGENT_HISTORY = 'agent:history:%s'
 KEY_JOB = "job:%s"  # 'json', 'yaml', 'sha1',
                     # 'success', 'tags', 'description'
 KEY_JOBS = "jobs"
+# Builds of a coalescing job that haven't started, by parameters, see
+# coalesce.py
+KEY_JOB_PENDING = 'job:pending:%s'
 
 KEY_RECIPE = 'recipe:%s'  # hash: 'contents', 'sha1'
 KEY_RECIPES = 'recipes'
 
 KEY_TAG = 'tag:%s'
 
+# Edit history of a branch, e.g. 'jobs/<name>'. A list of json entries
+# (oldest first) and a hash mapping commit id -> position in that list.
+KEY_HISTORY = 'history:%s'
+KEY_HISTORY_IDX = 'history:idx:%s'
+
 BUILD_HISTORY = 'build-history'
 
+# Results of successful builds of a job, by cache key (see build_cache.py),
+# when each was last used, and the hit/miss counters of the job's cache
+KEY_BUILD_CACHE = 'buildcache:%s:%s'
+KEY_BUILD_CACHE_LRU = 'buildcache:lru:%s'
+KEY_BUILD_CACHE_STATS = 'buildcache:stats:%s'
+
+# Memoized session results (see memo.py), when each was last used, and
+# the hit/miss counters
+KEY_MEMO = 'memo:%s'
+KEY_MEMO_LRU = 'memo:lru'
+KEY_MEMO_STATS = 'memo:stats'
+
+# Progress of /admin/rebuild_caches, and the lock preventing concurrent runs
+KEY_REBUILD_STATUS = 'admin:rebuild'
+KEY_REBUILD_LOCK = 'admin:rebuild:lock'
+
 
 KEY_TIMERS_MAX = 'timers_max'
 KEY_TIMERS = 'timers'
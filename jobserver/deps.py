@@ -0,0 +1,139 @@
+"""Dependencies between the sessions of a build.
+
+A session dispatched with `after` names sibling sessions, with the same
+parent, that have to finish first. It waits on the jobserver, in
+SESSION_STATE_WAITING, rather than having an agent wait for the results,
+and is dispatched once the last of them is done. If any of them didn't
+succeed, it's failed without running.
+
+A session can only depend on sessions that already exist, i.e. that have
+lower numbers, so the graph never has cycles and the session numbers are
+a topological order.
+"""
+from jobserver.build import KEY_BUILD, KEY_SESSION
+from jobserver.build import SESSION_STATE_DONE, RESULT_SUCCESS
+
+# The sessions a session runs after, and the sessions waiting for it
+KEY_SESSION_DEPS = 'session:deps:%s'
+KEY_SESSION_DEPENDENTS = 'session:dependents:%s'
+
+
+def parse_deps(db, build_id, parent, after):
+    """Returns the session ids of `after`, a list of session numbers or
+    ids of siblings of a session to be created under `parent`"""
+    if not isinstance(after, (list, tuple)):
+        raise ValueError("after must be a list")
+    deps = []
+    for dep in after:
+        dep = unicode(dep)
+        if '-' not in dep:
+            dep = '%s-%s' % (build_id, dep)
+        if dep.split('-')[0] != build_id:
+            raise ValueError("%s is not in build %s" % (dep, build_id))
+        dep_parent = db.hget(KEY_SESSION % dep, 'parent')
+        if dep_parent is None:
+            raise ValueError("No such session: %s" % dep)
+        if dep_parent != parent:
+            raise ValueError("%s is not a sibling" % dep)
+        if dep not in deps:
+            deps.append(dep)
+    return deps
+
+
+def add_deps(db, session_id, deps):
+    """Records that the session runs after `deps`. Returns how many of them
+    it has to wait for."""
+    keys = [KEY_SESSION % dep for dep in deps]
+    waiting = []
+
+    def update(pipe):
+        states = [pipe.hget(key, 'state') for key in keys]
+        waiting[:] = [dep for dep, state in zip(deps, states)
+                      if state != SESSION_STATE_DONE]
+        pipe.multi()
+        for dep in deps:
+            pipe.sadd(KEY_SESSION_DEPS % session_id, dep)
+        for dep in waiting:
+            pipe.sadd(KEY_SESSION_DEPENDENTS % dep, session_id)
+        pipe.hset(KEY_SESSION % session_id, 'waiting', len(waiting))
+
+    # A dependency finishing meanwhile changes its state
+    db.transaction(update, *keys)
+    return len(waiting)
+
+
+def finished(db, session_id):
+    """Called when the session is done. Returns the sessions waiting for
+    it that have nothing more to wait for."""
+    ready = []
+    key = KEY_SESSION_DEPENDENTS % session_id
+    for dependent in db.smembers(key):
+        # Only the one removing it counts it, should this be called twice
+        if db.srem(key, dependent) and \
+                db.hincrby(KEY_SESSION % dependent, 'waiting', -1) == 0:
+            ready.append(dependent)
+    return ready
+
+
+def failed_deps(db, session_id):
+    """Returns the dependencies of the session that didn't succeed"""
+    deps = sorted(db.smembers(KEY_SESSION_DEPS % session_id))
+    with db.pipeline(transaction = False) as pipe:
+        for dep in deps:
+            pipe.hget(KEY_SESSION % dep, 'result')
+        results = pipe.execute()
+    return [dep for dep, result in zip(deps, results)
+            if result != RESULT_SUCCESS]
+
+
+def get_graph(db, build_id):
+    """Returns the sessions of the build, in session number order, with
+    their state, timing and dependencies"""
+    count = int(db.hget(KEY_BUILD % build_id, 'next_sess_id') or 0)
+    session_ids = ['%s-%d' % (build_id, i) for i in xrange(count)]
+    with db.pipeline(transaction = False) as pipe:
+        for session_id in session_ids:
+            pipe.hmget(KEY_SESSION % session_id,
+                       ('state', 'result', 'started', 'ended', 'waiting'))
+            pipe.smembers(KEY_SESSION_DEPS % session_id)
+        result = pipe.execute()
+    nodes = []
+    for i, session_id in enumerate(session_ids):
+        (state, res, started, ended, waiting), deps = result[i * 2:i * 2 + 2]
+        nodes.append(dict(id = session_id, state = state, result = res,
+                          started = int(started or 0), ended = int(ended or 0),
+                          waiting = int(waiting or 0),
+                          deps = sorted(deps)))
+    return nodes
+
+
+def analyze(nodes, now):
+    """Finds the sessions that are free to run but haven't finished, and
+    the critical path: the chain of dependencies taking the longest, by
+    how long each session ran (or has run so far). Linear in the number
+    of sessions and dependencies, as `nodes` is in topological order.
+    """
+    done = dict((n['id'], n['state'] == SESSION_STATE_DONE) for n in nodes)
+    finish = {}
+    prev = {}
+    ready = []
+    for n in nodes:
+        if not done[n['id']] and all(done.get(d) for d in n['deps']):
+            ready.append(n['id'])
+        if n['ended']:
+            duration = n['ended'] - n['started']
+        elif n['started']:
+            duration = now - n['started']
+        else:
+            duration = 0
+        before = max([(finish.get(d, 0), d) for d in n['deps']] or [(0, None)])
+        finish[n['id']] = before[0] + duration
+        prev[n['id']] = before[1]
+
+    path = []
+    node = max(finish, key = finish.get) if finish else None
+    while node:
+        path.append(node)
+        node = prev[node]
+    path.reverse()
+    return ready, path, max(finish.values() or [0])
@@ -1,13 +1,23 @@
 import os
+import threading
+import time
 
 from dulwich.repo import Repo
 from dulwich.objects import Blob, Tree, Commit, parse_timezone
 
-from jobserver.utils import get_ts
+from jobserver.utils import get_ts, LRUCache
 
 GIT_CONFIG = 'config.git'
 AUTHOR = 'SCI <sci@example.com>'
 
+# Number of decoded commits, trees and blobs kept per repository
+OBJECT_CACHE_SIZE = 4096
+# How often (seconds) to check whether the repository needs re-opening
+STAMP_INTERVAL = 1
+
+_handles = {}
+_handles_lock = threading.Lock()
+
 
 class CommitException(Exception):
     pass
@@ -17,8 +27,70 @@ class NoChangesException(CommitException):
     pass
 
 
+class RepoHandle(object):
+    """Process-wide handle on a repository.
+
+    The underlying dulwich `Repo` is opened once and re-opened only when
+    the packed refs or the set of packs change, which is checked at most
+    every STAMP_INTERVAL seconds. Reading packs seeks and reads shared
+    files, so object reads and writes go through a lock. Objects are
+    immutable, so decoded objects are kept in a bounded cache keyed by
+    their sha1, and most reads never take the lock.
+    """
+    def __init__(self, path, cache_size = OBJECT_CACHE_SIZE):
+        self.path = path
+        self.objects = LRUCache(cache_size)
+        self._repo = None
+        self._stamp = None
+        self._checked = 0
+        self._lock = threading.RLock()
+
+    def _get_stamp(self):
+        stamp = []
+        for name in ('packed-refs', os.path.join('objects', 'pack')):
+            try:
+                stamp.append(os.stat(os.path.join(self.path, name)).st_mtime)
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    @property
+    def repo(self):
+        with self._lock:
+            now = time.time()
+            if self._repo is None or now - self._checked >= STAMP_INTERVAL:
+                stamp = self._get_stamp()
+                if self._repo is None or stamp != self._stamp:
+                    self._repo = Repo(self.path)
+                    self._stamp = stamp
+                self._checked = now
+            return self._repo
+
+    @property
+    def refs(self):
+        return self.repo.refs
+
+    def get_object(self, sha):
+        obj = self.objects.get(sha)
+        if obj is None:
+            with self._lock:
+                obj = self.repo.get_object(sha)
+            self.objects.put(sha, obj)
+        return obj
+
+    def add_objects(self, objects):
+        with self._lock:
+            self.repo.object_store.add_objects([(obj, None)
+                                                for obj in objects])
+
+
 def config(path):
-    return Repo(os.path.join(path, GIT_CONFIG))
+    path = os.path.join(path, GIT_CONFIG)
+    with _handles_lock:
+        handle = _handles.get(path)
+        if handle is None:
+            handle = _handles[path] = RepoHandle(path)
+    return handle
 
 
 def update_head(repo, name, old_sha1, new_sha1):
@@ -29,14 +101,17 @@ def update_head(repo, name, old_sha1, new_sha1):
         raise CommitException("Ref is not current")
 
 
-def create_commit(repo, files = None, tree = None, parent = None,
-                  author = AUTHOR, message = "No message given"):
-    object_store = repo.object_store
+def build_commit(repo, files = None, tree = None, parent = None,
+                 author = AUTHOR, message = "No message given"):
+    """Like create_commit, but returns (commit, objects) without adding
+    the objects to the object store.
+    """
+    objects = []
     if not tree:
         tree = Tree()
     for f in files:
         blob = Blob.from_string(f[2])
-        object_store.add_object(blob)
+        objects.append(blob)
         tree.add(f[0], f[1], blob.id)
     commit = Commit()
     if parent:
@@ -56,6 +131,13 @@ def create_commit(repo, files = None, tree = None, parent = None,
     commit.encoding = "UTF-8"
     commit.message = message
 
-    object_store.add_object(tree)
-    object_store.add_object(commit)
+    objects.append(tree)
+    objects.append(commit)
+    return commit, objects
+
+
+def create_commit(repo, files = None, tree = None, parent = None,
+                  author = AUTHOR, message = "No message given"):
+    commit, objects = build_commit(repo, files, tree, parent, author, message)
+    repo.add_objects(objects)
     return commit
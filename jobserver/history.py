@@ -0,0 +1,99 @@
+import json
+
+from jobserver.db import KEY_HISTORY, KEY_HISTORY_IDX
+
+# Entries per page, unless asked for otherwise
+HISTORY_LIMIT = 20
+
+
+class RefNotInHistory(Exception):
+    pass
+
+
+def _entry(ref, commit):
+    lines = commit.message.splitlines()
+    return {'ref': ref,
+            'msg': lines[0] if lines else '',
+            'date': commit.commit_time,
+            'by': commit.committer}
+
+
+def update(ctx, branch, head = None):
+    """Extends the append-only history index of `branch` up to `head`
+    (default: the branch head), walking only the commits not yet indexed.
+    """
+    if head is None:
+        try:
+            head = ctx.repo.refs['refs/heads/%s' % branch]
+        except KeyError:
+            return
+    key = KEY_HISTORY % branch
+    idx_key = KEY_HISTORY_IDX % branch
+
+    def extend(pipe):
+        tip = pipe.lindex(key, -1)
+        tip = json.loads(tip)['ref'] if tip else None
+        if tip == head:
+            return
+        base = pipe.llen(key)
+        new = []
+        ref = head
+        while ref and ref != tip:
+            c = ctx.repo.get_object(ref)
+            new.append(_entry(ref, c))
+            ref = c.parents[0] if c.parents else None
+
+        pipe.multi()
+        if ref != tip:
+            # Not a descendant of what we have indexed - start over
+            pipe.delete(key, idx_key)
+            base = 0
+        for i, entry in enumerate(reversed(new)):
+            pipe.rpush(key, json.dumps(entry))
+            pipe.hset(idx_key, entry['ref'], base + i)
+
+    ctx.db.transaction(extend, key)
+
+
+def _position(ctx, branch, ref):
+    pos = ctx.db.hget(KEY_HISTORY_IDX % branch, ref)
+    if pos is None:
+        raise RefNotInHistory(ref)
+    return int(pos)
+
+
+def get_history(ctx, branch, before = None, limit = HISTORY_LIMIT):
+    """Returns (entries, cursor) with the newest entry first.
+
+    Pass the returned cursor as `before` to fetch the next page. It is
+    None when there are no older entries.
+    """
+    update(ctx, branch)
+    key = KEY_HISTORY % branch
+    if before:
+        end = _position(ctx, branch, before) - 1
+    else:
+        end = ctx.db.llen(key) - 1
+    start = max(0, end - limit + 1)
+    if end < 0:
+        return [], None
+    entries = [json.loads(e) for e in ctx.db.lrange(key, start, end)]
+    entries.reverse()
+    cursor = entries[-1]['ref'] if start > 0 and entries else None
+    return entries, cursor
+
+
+def get_changes(ctx, branch, since, until = None):
+    """Returns the entries after `since` up to and including `until`
+    (default: the branch head), newest first.
+    """
+    update(ctx, branch)
+    key = KEY_HISTORY % branch
+    start = _position(ctx, branch, since) + 1
+    if until:
+        end = _position(ctx, branch, until)
+    else:
+        end = -1
+    entries = [json.loads(e) for e in ctx.db.lrange(key, start, end)]
+    entries.reverse()
+    return entries
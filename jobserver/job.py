@@ -1,15 +1,27 @@
 import json
 
-from flask import g
 import yaml
 from jobserver.recipe import Recipe
 from jobserver.db import KEY_JOB, KEY_JOBS, KEY_TAG
 from jobserver.build import KEY_JOB_BUILDS, KEY_BUILD
+from jobserver.build import PRIORITIES, PRIORITY_NORMAL
+from jobserver.agent import parse_resources
+from jobserver.affinity import parse_caches
 from jobserver.gitdb import create_commit, update_head
 from jobserver.gitdb import NoChangesException, CommitException
+import jobserver.history as history
 import jobserver.timers as timers
 from jobserver.cron_parser import CronParser
 
+# Seconds a cached build result is kept by default, see build_cache.py
+CACHE_TTL = 24 * 3600
+
+# What starting a build does when an identical one hasn't started yet,
+# see coalesce.py: return that build, or abort it in favour of the new one
+COALESCE_QUEUED = 'queued'
+COALESCE_SUPERSEDE = 'supersede'
+COALESCE_POLICIES = (COALESCE_QUEUED, COALESCE_SUPERSEDE)
+
 
 class JobParseError(Exception):
     pass
@@ -24,7 +36,8 @@ class JobNotCurrent(Exception):
 
 
 class Job(object):
-    def __init__(self, name, obj, yaml_str = None, ref = None):
+    def __init__(self, ctx, name, obj, yaml_str = None, ref = None):
+        self._ctx = ctx
         self._name = name
         self._obj = obj
         self._yaml_str = yaml_str
@@ -37,7 +50,7 @@ class Job(object):
     @property
     def yaml(self):
         if self._yaml_str is None:
-            self._yaml_str = Job._get_yaml(self._name, self._ref)
+            self._yaml_str = Job._get_yaml(self._ctx, self._name, self._ref)
         return self._yaml_str
 
     @property
@@ -64,99 +77,147 @@ class Job(object):
     def parameters(self):
         return self._obj.get('parameters', {})
 
+    @property
+    def schedules(self):
+        return self._obj.get('schedules', [])
+
+    @property
+    def priority(self):
+        return self._obj.get('priority', PRIORITY_NORMAL)
+
+    @property
+    def share(self):
+        return self._obj.get('share', 1)
+
+    @property
+    def resources(self):
+        return self._obj.get('resources', {})
+
+    @property
+    def caches(self):
+        return self._obj.get('caches', [])
+
+    @property
+    def cache(self):
+        return self._obj.get('cache')
+
+    @property
+    def max_sessions(self):
+        return self._obj.get('max_sessions', 0)
+
+    @property
+    def max_build_sessions(self):
+        return self._obj.get('max_build_sessions', 0)
+
+    @property
+    def coalesce(self):
+        return self._obj.get('coalesce')
+
     @classmethod
-    def set_last_success(self, name, build_id, pipe = None):
-        if not pipe:
-            pipe = g.db
+    def set_last_success(self, name, build_id, pipe):
         pipe.hset(KEY_JOB % name, 'success', build_id)
 
     @property
     def last_success(self):
-        bid = g.db.hget(KEY_JOB % self.name, 'success')
+        bid = self._ctx.db.hget(KEY_JOB % self.name, 'success')
         if not bid:
             return 0
-        return int(g.db.hget(KEY_BUILD % bid, 'number'))
+        return int(self._ctx.db.hget(KEY_BUILD % bid, 'number'))
 
     @property
     def latest_build(self):
-        return g.db.llen(KEY_JOB_BUILDS % self.name) or 0
+        return self._ctx.db.llen(KEY_JOB_BUILDS % self.name) or 0
 
     def save(self, prev_ref = None, message = None):
         message = message or "Updated Job"
+        repo = self._ctx.repo
 
         if self.name == 'private':
             try:
-                prev_ref = g.repo.refs['refs/heads/jobs/private']
+                prev_ref = repo.refs['refs/heads/jobs/private']
             except KeyError:
                 prev_ref = None
 
         try:
-            commit = create_commit(g.repo, [('job.yaml', 0100644, self.yaml)],
+            commit = create_commit(repo, [('job.yaml', 0100644, self.yaml)],
                                    parent = prev_ref,
                                    message = message)
             self._ref = commit.id
         except NoChangesException:
             return
         try:
-            update_head(g.repo, 'refs/heads/jobs/%s' % self.name,
+            update_head(repo, 'refs/heads/jobs/%s' % self.name,
                         prev_ref, commit.id)
         except CommitException:
             if self.name == 'private':
                 return self.save(prev_ref, message)
             raise JobNotCurrent()
         self._update_cache()
+        history.update(self._ctx, 'jobs/%s' % self.name, commit.id)
 
     def _update_cache(self):
         # TODO: Still a race condition if a newer edit updates the cache
         # before an older manages to do it.
         key = KEY_JOB % self.name
 
-        timers_needed = len(self._obj.get('schedules', []))
-        new_timers = timers.allocate(g.db, timers_needed)
+        timers_needed = len(self.schedules)
+        new_timers = timers.allocate(self._ctx.db, timers_needed)
 
         def update(pipe):
             try:
-                prev = Job.load(self.name, pipe = pipe)
+                prev = Job.load(self._ctx, self.name, pipe = pipe)
                 prev_tags = set(prev.tags)
             except JobNotFound:
                 prev_tags = set()
-            cur_tags = set(self.tags)
             cur_timers = pipe.hget(key, 'timers') or ''
             cur_timers = [c for c in cur_timers.split(',') if c != '']
 
             pipe.multi()
-            for tag in prev_tags - cur_tags:
-                pipe.srem(KEY_TAG % tag, 'j' + self.name)
-            for tag in cur_tags - prev_tags:
-                pipe.sadd(KEY_TAG % tag, 'j' + self.name)
-            pipe.hset(key, 'json', json.dumps(self._obj))
-            pipe.hset(key, 'yaml', self.yaml)
-            pipe.hset(key, 'description', self.description)
-            pipe.hset(key, 'tags', ','.join(self.tags))
-            pipe.hset(key, 'sha1', self.ref)
-
-            # Remove old timers
-            for t in cur_timers:
-                timers.kill(pipe, t)
-            # Add new ones
-            pipe.hset(key, 'timers', ','.join([str(a) for a in new_timers]))
-            for idx, sched in enumerate(self._obj.get('schedules', [])):
-                timer_id = new_timers[idx]
-                cron_entry = CronParser.parse(sched['when'])
-                intent = {'type': 'explicit', 'action': 'build',
-                          'extra': {'job': self.name,
-                                    'parameters': sched.get('parameters', {}),
-                                    'description': sched.get('description')}}
-                intent_json = json.dumps(intent)
-                timers.add(pipe, timer_id, cron_entry, intent_json,
-                           sched.get('description'))
-            pipe.sadd(KEY_JOBS, self.name)
-
-        g.db.transaction(update, key)
+            self._write_cache(pipe, prev_tags, cur_timers, new_timers)
+
+        self._ctx.db.transaction(update, key)
+
+    def _write_cache(self, pipe, prev_tags, cur_timers, new_timers):
+        key = KEY_JOB % self.name
+        cur_tags = set(self.tags)
+        for tag in prev_tags - cur_tags:
+            pipe.srem(KEY_TAG % tag, 'j' + self.name)
+        for tag in cur_tags - prev_tags:
+            pipe.sadd(KEY_TAG % tag, 'j' + self.name)
+        pipe.hset(key, 'json', json.dumps(self._obj))
+        pipe.hset(key, 'yaml', self.yaml)
+        pipe.hset(key, 'description', self.description)
+        pipe.hset(key, 'tags', ','.join(self.tags))
+        pipe.hset(key, 'sha1', self.ref)
+
+        # Remove old timers
+        for t in cur_timers:
+            timers.kill(pipe, t)
+        # Add new ones
+        pipe.hset(key, 'timers', ','.join([str(a) for a in new_timers]))
+        for idx, sched in enumerate(self.schedules):
+            timer_id = new_timers[idx]
+            cron_entry = CronParser.parse(sched['when'])
+            intent = {'type': 'explicit', 'action': 'build',
+                      'extra': {'job': self.name,
+                                'parameters': sched.get('parameters', {}),
+                                'description': sched.get('description')}}
+            intent_json = json.dumps(intent)
+            timers.add(pipe, timer_id, cron_entry, intent_json,
+                       sched.get('description'))
+        pipe.sadd(KEY_JOBS, self.name)
+
+    @classmethod
+    def get_edit_history(cls, ctx, name, before = None, limit = 20):
+        return history.get_history(ctx, 'jobs/%s' % name, before, limit)
+
+    @classmethod
+    def get_changes(cls, ctx, name, since, until = None):
+        return history.get_changes(ctx, 'jobs/%s' % name, since, until)
 
     def get_merged_params(self):
         params = {}
-        recipe = Recipe.load(self.recipe, self.recipe_ref)
+        recipe = Recipe.load(self._ctx, self.recipe, self.recipe_ref)
         for k, v in recipe.parameters.iteritems():
             v['name'] = k
             params[k] = v
@@ -168,7 +229,7 @@ class Job(object):
         return params
 
     @classmethod
-    def parse(cls, name, yaml_str, ref = None):
+    def parse(cls, ctx, name, yaml_str, ref = None):
         try:
             obj = yaml.safe_load(yaml_str)
         except:
@@ -185,40 +246,88 @@ class Job(object):
         obj.pop('tags', None)
         if tags:
             obj['tags'] = tags
+        if obj.get('priority', PRIORITY_NORMAL) not in PRIORITIES:
+            raise JobParseError("priority must be one of %s" %
+                                ", ".join(PRIORITIES))
+        try:
+            if int(obj.get('share', 1)) < 1:
+                raise ValueError()
+            obj['share'] = int(obj.get('share', 1))
+        except (TypeError, ValueError):
+            raise JobParseError("share must be a positive integer")
+        try:
+            obj['resources'] = parse_resources(obj.get('resources', {}))
+            obj['caches'] = parse_caches(obj.get('caches', []))
+        except ValueError as e:
+            raise JobParseError(str(e))
+        for limit in ('max_sessions', 'max_build_sessions'):
+            try:
+                if int(obj.get(limit, 0)) < 0:
+                    raise ValueError()
+                obj[limit] = int(obj.get(limit, 0))
+            except (TypeError, ValueError):
+                raise JobParseError("%s must be a positive integer" % limit)
+        obj['cache'] = Job._parse_cache(obj.get('cache'))
+        if obj.get('coalesce') is True:
+            obj['coalesce'] = COALESCE_QUEUED
+        if obj.get('coalesce') not in COALESCE_POLICIES + (None, False):
+            raise JobParseError("coalesce must be one of %s" %
+                                ", ".join(COALESCE_POLICIES))
+        obj['coalesce'] = obj.get('coalesce') or None
         obj['name'] = name
-        return Job(name, obj, yaml_str, ref)
+        return Job(ctx, name, obj, yaml_str, ref)
+
+    @staticmethod
+    def _parse_cache(cache):
+        if not cache:
+            return None
+        if cache is True:
+            cache = {}
+        if not isinstance(cache, dict):
+            raise JobParseError("cache must be true or a mapping")
+        try:
+            ttl = int(cache.get('ttl', CACHE_TTL))
+            if ttl < 1:
+                raise ValueError()
+        except (TypeError, ValueError):
+            raise JobParseError("cache ttl must be a positive integer")
+        inputs = cache.get('inputs', [])
+        if not isinstance(inputs, list):
+            raise JobParseError("cache inputs must be a list")
+        return dict(ttl = ttl, inputs = sorted(unicode(i) for i in inputs))
 
     @classmethod
-    def load(cls, name, ref = None, pipe = None):
+    def load(cls, ctx, name, ref = None, pipe = None):
         if not pipe:
-            pipe = g.db
+            pipe = ctx.db
         job, dbref = pipe.hmget(KEY_JOB % name, ('json', 'sha1'))
         if dbref is None or (ref and ref != dbref):
-            yaml_str, dbref = cls._get_from_archive(name, ref)
+            yaml_str, dbref = cls._get_from_archive(ctx, name, ref)
             if not dbref:
                 raise JobNotFound()
-            return Job.parse(name, yaml_str, dbref)
+            return Job.parse(ctx, name, yaml_str, dbref)
         if not dbref:
             raise JobNotFound()
-        return Job(name, json.loads(job), ref = dbref)
+        return Job(ctx, name, json.loads(job), ref = dbref)
 
     @classmethod
-    def _get_yaml(cls, name, ref):
+    def _get_yaml(cls, ctx, name, ref):
         assert(ref != None)
-        yaml_str, dbref = g.db.hmget(KEY_JOB % name, ('yaml', 'sha1'))
+        yaml_str, dbref = ctx.db.hmget(KEY_JOB % name, ('yaml', 'sha1'))
         if dbref is None or (ref != dbref):
-            yaml_str, dbref = cls._get_from_archive(name, ref)
+            yaml_str, dbref = cls._get_from_archive(ctx, name, ref)
             assert(dbref != None)
         return yaml_str
 
     @classmethod
-    def _get_from_archive(cls, name, ref = None):
+    def _get_from_archive(cls, ctx, name, ref = None):
+        repo = ctx.repo
         if not ref:
             try:
-                ref = g.repo.refs['refs/heads/jobs/%s' % name]
+                ref = repo.refs['refs/heads/jobs/%s' % name]
             except KeyError:
                 return None, None
-        commit = g.repo.get_object(ref)
-        tree = g.repo.get_object(commit.tree)
+        commit = repo.get_object(ref)
+        tree = repo.get_object(commit.tree)
         mode, sha = tree['job.yaml']
-        return g.repo.get_object(sha).data, commit.id
+        return repo.get_object(sha).data, commit.id
@@ -3,6 +3,8 @@ from flask import Blueprint, request, jsonify, abort, g
 from jobserver.db import KEY_JOBS
 from jobserver.build import KEY_JOB_BUILDS
 from jobserver.job import Job, JobNotFound, JobNotCurrent
+from jobserver.history import RefNotInHistory, HISTORY_LIMIT
+from jobserver.build_cache import get_stats as get_cache_stats
 from jobserver.utils import chunks
 
 app = Blueprint('job', __name__)
@@ -10,7 +12,7 @@ app = Blueprint('job', __name__)
 
 @app.route('/<name>/create', methods=['POST'])
 def create_job(name):
-    job = Job.parse(name, "recipe: %s" % request.json.get('recipe'))
+    job = Job.parse(g.ctx, name, "recipe: %s" % request.json.get('recipe'))
     try:
         job.save()
     except JobNotCurrent:
@@ -22,7 +24,7 @@ def create_job(name):
 @app.route('/<name>/raw', methods=['POST'])
 def put_job_raw(name):
     raw = request.json['yaml']
-    job = Job.parse(name, raw)
+    job = Job.parse(g.ctx, name, raw)
     try:
         job.save(prev_ref = request.json.get('old'))
     except JobNotCurrent:
@@ -33,7 +35,7 @@ def put_job_raw(name):
 @app.route('/<name>', methods=['GET'])
 def get_job(name):
     try:
-        job = Job.load(name, ref = request.args.get('ref'))
+        job = Job.load(g.ctx, name, ref = request.args.get('ref'))
     except JobNotFound:
         abort(404)
     blen = job.latest_build
@@ -64,9 +66,31 @@ def get_job(name):
                    history = history,
                    parameters = job.parameters,
                    merged_params = job.get_merged_params(),
+                   cache = get_cache_stats(g.db, name) if job.cache else None,
                    yaml = yaml_str)
 
 
+@app.route('/<name>/history.json', methods=['GET'])
+def get_job_history(name):
+    try:
+        limit = int(request.args.get('limit', HISTORY_LIMIT))
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        abort(400, 'Invalid limit')
+    try:
+        if request.args.get('since'):
+            entries = Job.get_changes(g.ctx, name, request.args['since'],
+                                      request.args.get('until'))
+            return jsonify(entries = entries)
+        entries, cursor = Job.get_edit_history(
+            g.ctx, name, before = request.args.get('before'),
+            limit = limit)
+    except RefNotInHistory:
+        abort(404)
+    return jsonify(entries = entries, next = cursor)
+
+
 @app.route('/', methods=['GET'])
 def list_jobs():
     fields = ('#', 'job:*->tags', 'job:*->description')
@@ -0,0 +1,145 @@
+import redis
+
+import jobserver.db as jdb
+from jobserver.agent import watch_capacity, release, set_capacity_state
+from jobserver.agent import get_free
+from jobserver.build import set_session_queued, get_session_needs
+from jobserver.build import KEY_SESSION, SESSION_STATE_TO_AGENT
+from jobserver.utils import get_ts
+
+# An agent must acknowledge a dispatched session within this time
+LEASE_TTL = 60
+# Backoff before a session that failed to dispatch is tried again
+BACKOFF_BASE = 5
+BACKOFF_MAX = 5 * 60
+# Consecutive dispatch failures before an agent is taken out of rotation
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 5 * 60
+
+
+def grant(pipe, session_id, now = None):
+    pipe.zadd(jdb.KEY_LEASES, (now or get_ts()) + LEASE_TTL, session_id)
+    pipe.hincrby(KEY_SESSION % session_id, 'dispatch_attempts', 1)
+
+
+def ack(pipe, session_id):
+    pipe.zrem(jdb.KEY_LEASES, session_id)
+
+
+def backoff(attempts):
+    return min(BACKOFF_BASE * 2 ** max(attempts - 1, 0), BACKOFF_MAX)
+
+
+def requeue(db, session_id, now = None):
+    """Takes back a dispatched session that was never acknowledged and
+    schedules it to be dispatched again after a backoff.
+
+    Returns the id of the agent it was dispatched to, or None if the
+    session has moved on (e.g. the agent ack'ed it after all).
+    """
+    now = now or get_ts()
+    key = KEY_SESSION % session_id
+    while True:
+        with db.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                state, agent_id, attempts = pipe.hmget(
+                    key, ('state', 'agent', 'dispatch_attempts'))
+                pipe.multi()
+                pipe.zrem(jdb.KEY_LEASES, session_id)
+                if state != SESSION_STATE_TO_AGENT:
+                    pipe.execute()
+                    return None
+                set_session_queued(pipe, session_id)
+                pipe.zadd(jdb.KEY_RETRY, now + backoff(int(attempts or 1)),
+                          session_id)
+                pipe.execute()
+                return agent_id
+            except redis.WatchError:
+                continue
+
+
+def record_success(db, agent_id):
+    db.hset(jdb.KEY_AGENT % agent_id, 'failures', 0)
+
+
+def record_failure(db, agent_id, session_id, now = None):
+    """Counts a failed dispatch against the agent, and gives back the
+    capacity it held for `session_id`. The agent is taken out of rotation
+    for BREAKER_COOLDOWN seconds after BREAKER_THRESHOLD consecutive
+    failures.
+
+    Returns True if the agent is available again.
+    """
+    now = now or get_ts()
+    key = jdb.KEY_AGENT % agent_id
+    needs = get_session_needs(db, session_id)
+    with db.pipeline() as pipe:
+        try:
+            state, free, held = watch_capacity(pipe, agent_id, session_id)
+            failures = int(pipe.hget(key, 'failures') or 0) + 1
+            tripped = failures >= BREAKER_THRESHOLD
+            pipe.multi()
+            pipe.hset(key, 'failures', failures)
+            if not held:
+                pipe.execute()
+                return False
+            release(pipe, agent_id, session_id, needs, free)
+            if tripped:
+                pipe.srem(jdb.KEY_AVAILABLE, agent_id)
+                pipe.zadd(jdb.KEY_TRIPPED, now + BREAKER_COOLDOWN, agent_id)
+                pipe.hset(key, 'state', jdb.AGENT_STATE_TRIPPED)
+            elif state != jdb.AGENT_STATE_TRIPPED:
+                set_capacity_state(pipe, agent_id, free)
+            pipe.execute()
+            return not tripped and state != jdb.AGENT_STATE_TRIPPED
+        except redis.WatchError:
+            return False
+
+
+def _take_due(db, key, now):
+    due = db.zrangebyscore(key, '-inf', now)
+    if not due:
+        return []
+    with db.pipeline() as pipe:
+        for member in due:
+            pipe.zrem(key, member)
+        removed = pipe.execute()
+    # Only hand out what we removed ourselves
+    return [m for m, r in zip(due, removed) if r]
+
+
+def expired_leases(db, now = None):
+    return db.zrangebyscore(jdb.KEY_LEASES, '-inf', now or get_ts())
+
+
+def take_due_retries(db, now = None):
+    return _take_due(db, jdb.KEY_RETRY, now or get_ts())
+
+
+def take_due_affinity(db, now = None):
+    return _take_due(db, jdb.KEY_AFFINITY, now or get_ts())
+
+
+def take_cooled_down(db, now = None):
+    """Lets agents whose cooldown has passed back in, and returns them.
+    The breaker is left half-open: one more failure trips it again.
+    """
+    revived = []
+    for agent_id in _take_due(db, jdb.KEY_TRIPPED, now or get_ts()):
+        key = jdb.KEY_AGENT % agent_id
+        with db.pipeline() as pipe:
+            try:
+                pipe.watch(key, jdb.KEY_AGENT_FREE % agent_id)
+                state = pipe.hget(key, 'state')
+                free = get_free(pipe, agent_id)
+                pipe.multi()
+                pipe.hset(key, 'failures', BREAKER_THRESHOLD - 1)
+                if state == jdb.AGENT_STATE_TRIPPED:
+                    set_capacity_state(pipe, agent_id, free)
+                pipe.execute()
+                if state == jdb.AGENT_STATE_TRIPPED:
+                    revived.append(agent_id)
+            except redis.WatchError:
+                pass
+    return revived
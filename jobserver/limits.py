@@ -0,0 +1,88 @@
+"""Concurrency limits of jobs and builds.
+
+A job can limit how many of its sessions run at a time, over all of its
+builds (max_sessions) and within each build (max_build_sessions). The
+matcher keeps the sessions it dispatches in a set per limited job and
+build, and holds back queued sessions while a set is full. Sessions
+leave the sets as soon as they are no longer with an agent, so that
+finished, requeued or reaped sessions free their place without anyone
+having to account for them.
+
+The main session of a build, and sessions that have started one of their
+own, are left out: they mostly wait for the sessions they started, and
+holding a place while doing so would keep those from ever running.
+"""
+import jobserver.db as jdb
+from jobserver.build import KEY_BUILD, KEY_SESSION
+from jobserver.build import SESSION_STATE_TO_AGENT, SESSION_STATE_RUNNING
+
+
+def get_builds(db, build_ids):
+    """Returns the job name and limits of each build"""
+    build_ids = sorted(set(build_ids))
+    with db.pipeline(transaction = False) as pipe:
+        for build_id in build_ids:
+            pipe.hmget(KEY_BUILD % build_id,
+                       ('job_name', 'max_sessions', 'max_build_sessions'))
+        result = pipe.execute()
+    return dict((build_id, (job_name, int(max_job or 0), int(max_build or 0)))
+                for build_id, (job_name, max_job, max_build)
+                in zip(build_ids, result))
+
+
+def get_limits(builds, session_id):
+    """Returns (running set, limit, name) of each limit on the session"""
+    build_id, num = session_id.split('-')
+    if int(num) == 0:
+        return []
+    job_name, max_job, max_build = builds[build_id]
+    limits = []
+    if max_build:
+        limits.append((jdb.KEY_BUILD_RUNNING % build_id, max_build, 'build'))
+    if max_job:
+        limits.append((jdb.KEY_JOB_RUNNING % job_name, max_job, 'job'))
+    return limits
+
+
+def release_parent(db, session_id):
+    """Stops counting the session, which has started another one"""
+    build_id = session_id.split('-')[0]
+    job_name = db.hget(KEY_BUILD % build_id, 'job_name')
+    with db.pipeline() as pipe:
+        pipe.srem(jdb.KEY_BUILD_RUNNING % build_id, session_id)
+        pipe.srem(jdb.KEY_JOB_RUNNING % job_name, session_id)
+        pipe.execute()
+
+
+def count_running(db, key):
+    """Returns how many sessions in the set are with an agent, dropping
+    the ones that aren't any more"""
+    session_ids = list(db.smembers(key))
+    with db.pipeline(transaction = False) as pipe:
+        for session_id in session_ids:
+            pipe.hget(KEY_SESSION % session_id, 'state')
+        states = pipe.execute()
+    gone = [session_id for session_id, state in zip(session_ids, states)
+            if state not in (SESSION_STATE_TO_AGENT, SESSION_STATE_RUNNING)]
+    if gone:
+        with db.pipeline(transaction = False) as pipe:
+            for session_id in gone:
+                pipe.srem(key, session_id)
+            pipe.execute()
+    return len(session_ids) - len(gone)
+
+
+def snapshot(db, session_ids):
+    """Returns the limits of the builds of the sessions, and how many
+    sessions are running under each limit"""
+    builds = get_builds(db, [s.split('-')[0] for s in session_ids])
+    counts = {}
+    for session_id in session_ids:
+        for key, limit, name in get_limits(builds, session_id):
+            if key not in counts:
+                counts[key] = count_running(db, key)
+    return builds, counts
+
+
+def get_limited(db):
+    return db.hgetall(jdb.KEY_LIMITED)
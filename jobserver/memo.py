@@ -0,0 +1,103 @@
+"""Memoization of session results.
+
+Steps dispatched with `memo` have their result remembered, by a key made
+from the recipe ref of the build, the step name, its arguments and any
+input hashes given as the value of `memo`. A later session with the same
+key, in this build or another, is finished right away with the output
+and artifacts of the earlier one, without going to an agent, unless it
+asks to `rerun`.
+
+The table keeps the MEMO_MAX_ENTRIES most recently used results.
+"""
+import hashlib
+import json
+
+import jobserver.db as jdb
+from jobserver.build import KEY_BUILD, KEY_SESSION, KEY_SESSION_ARTIFACTS
+from jobserver.build import RESULT_SUCCESS
+from jobserver.build import REUSE_MAX_OUTPUT, REUSE_MAX_ARTIFACTS
+from jobserver.build import Build, set_session_done, get_session_artifacts
+from jobserver.slog import add_slog
+from jobserver.utils import get_ts, get_hit_stats
+
+MEMO_MAX_ENTRIES = 10000
+
+
+def memo_key(db, build_id, run_info, inputs):
+    if not isinstance(inputs, dict):
+        raise ValueError("memo must be true or a mapping of input hashes")
+    run_info = run_info or {}
+    recipe_ref = db.hget(KEY_BUILD % build_id, 'recipe_ref')
+    key = [recipe_ref, run_info.get('step_name', 'main'),
+           run_info.get('args', []), inputs]
+    return hashlib.sha1(json.dumps(key, sort_keys = True)).hexdigest()
+
+
+def lookup(db, key):
+    """Returns the memoized result for the key, if any, and counts the
+    hit or miss"""
+    entry = db.hgetall(jdb.KEY_MEMO % key)
+    # Artifacts are added as the log is handled, so only counted now
+    if entry and db.llen(KEY_SESSION_ARTIFACTS % entry['session']) > \
+            REUSE_MAX_ARTIFACTS:
+        entry = None
+    with db.pipeline() as pipe:
+        if entry:
+            pipe.zadd(jdb.KEY_MEMO_LRU, get_ts(), key)
+        pipe.hincrby(jdb.KEY_MEMO_STATS, 'hits' if entry else 'misses', 1)
+        pipe.execute()
+    return entry or None
+
+
+def store(db, session_id, output):
+    """Remembers the output of a successful session that asked for it"""
+    key = db.hget(KEY_SESSION % session_id, 'memo_key')
+    if not key:
+        return False
+    output = json.dumps(output)
+    if len(output) > REUSE_MAX_OUTPUT:
+        return False
+    with db.pipeline() as pipe:
+        pipe.hmset(jdb.KEY_MEMO % key, {'session': session_id,
+                                        'output': output})
+        pipe.zadd(jdb.KEY_MEMO_LRU, get_ts(), key)
+        pipe.execute()
+    evict(db)
+    return True
+
+
+def evict(db):
+    """Drops the least recently used results beyond MEMO_MAX_ENTRIES"""
+    excess = db.zcard(jdb.KEY_MEMO_LRU) - MEMO_MAX_ENTRIES
+    if excess <= 0:
+        return
+    with db.pipeline() as pipe:
+        for key in db.zrange(jdb.KEY_MEMO_LRU, 0, excess - 1):
+            pipe.delete(jdb.KEY_MEMO % key)
+            pipe.zrem(jdb.KEY_MEMO_LRU, key)
+        pipe.execute()
+
+
+def apply(ctx, session_id, entry):
+    """Finishes the session with the memoized result"""
+    build_id = session_id.split('-')[0]
+    artifacts = get_session_artifacts(ctx.db, entry['session'],
+                                      REUSE_MAX_ARTIFACTS)
+    with ctx.db.pipeline() as pipe:
+        set_session_done(pipe, session_id, RESULT_SUCCESS,
+                         json.loads(entry['output']), '')
+        pipe.hset(KEY_SESSION % session_id, 'memo_from', entry['session'])
+        for artifact in artifacts:
+            Build.add_artifact(build_id, artifact, pipe = pipe)
+        add_slog(ctx, session_id,
+                 json.dumps(dict(type = 'session-done',
+                                 params = dict(result = RESULT_SUCCESS,
+                                               memo_from = entry['session']))),
+                 pipe = pipe)
+        pipe.execute()
+
+
+def get_stats(db):
+    stats = get_hit_stats(db, jdb.KEY_MEMO_STATS)
+    stats['entries'] = db.zcard(jdb.KEY_MEMO_LRU)
+    return stats
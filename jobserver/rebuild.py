@@ -0,0 +1,161 @@
+from itertools import imap, islice, izip
+import multiprocessing
+
+from jobserver.db import KEY_JOB, KEY_JOBS, KEY_RECIPE, KEY_RECIPES, KEY_TAG
+from jobserver.db import KEY_REBUILD_STATUS, KEY_REBUILD_LOCK
+from jobserver.bulk import write_caches
+from jobserver.job import Job
+from jobserver.recipe import Recipe
+from jobserver.utils import get_ts, chunks
+import jobserver.timers as timers
+
+# Number of jobs or recipes written per pipeline
+CHUNK_SIZE = 200
+# Parse on a process pool only when there is enough to parse
+POOL_THRESHOLD = 50
+LOCK_TTL = 60 * 60
+
+
+class RebuildInProgress(Exception):
+    pass
+
+
+def _parse_job(source):
+    name, yaml_str, ref = source
+    try:
+        return Job.parse(None, name, yaml_str, ref)._obj
+    except Exception:
+        return None
+
+
+def _parse_recipe(source):
+    name, contents, ref = source
+    try:
+        return Recipe.parse(None, name, contents, ref).metadata
+    except Exception:
+        return None
+
+
+_KINDS = {'jobs': (Job, KEY_JOB, KEY_JOBS, 'j', _parse_job),
+          'recipes': (Recipe, KEY_RECIPE, KEY_RECIPES, 'r', _parse_recipe)}
+
+
+def _split(s):
+    return [v for v in (s or '').split(',') if v]
+
+
+def _batches(iterable, n):
+    iterable = iter(iterable)
+    while True:
+        batch = list(islice(iterable, n))
+        if not batch:
+            return
+        yield batch
+
+
+def _delete_tags(db):
+    keys = list(db.scan_iter(match = KEY_TAG % '*', count = 1000))
+    for chunk in chunks(keys, CHUNK_SIZE):
+        db.delete(*chunk)
+
+
+def _rebuild_kind(ctx, kind, refs, full, processes):
+    db = ctx.db
+    model, key, all_key, tag_prefix, parse = _KINDS[kind]
+    prefix = 'refs/heads/%s/' % kind
+    heads = dict((r[len(prefix):], ctx.repo.refs[r])
+                 for r in refs if r.startswith(prefix))
+
+    cached_names = db.smembers(all_key)
+    names = sorted(set(heads) | cached_names)
+    cached = {}
+    for chunk in chunks(names, CHUNK_SIZE):
+        with db.pipeline(transaction = False) as pipe:
+            for name in chunk:
+                pipe.hmget(key % name, ('sha1', 'tags', 'timers'))
+            cached.update(zip(chunk, pipe.execute()))
+
+    changed = [n for n in sorted(heads) if full or cached[n][0] != heads[n]]
+    removed = [n for n in cached_names if n not in heads]
+    db.hincrby(KEY_REBUILD_STATUS, 'total', len(heads))
+    db.hincrby(KEY_REBUILD_STATUS, 'skipped', len(heads) - len(changed))
+
+    for chunk in chunks(removed, CHUNK_SIZE):
+        with db.pipeline() as pipe:
+            for name in chunk:
+                sha1, tags, cur_timers = cached[name]
+                for tag in _split(tags):
+                    pipe.srem(KEY_TAG % tag, tag_prefix + name)
+                for timer_id in _split(cur_timers):
+                    timers.kill(pipe, timer_id)
+                pipe.delete(key % name)
+                pipe.srem(all_key, name)
+            pipe.execute()
+        db.hincrby(KEY_REBUILD_STATUS, 'removed', len(chunk))
+
+    sources = [(name,) + model._get_from_archive(ctx, name, heads[name])
+               for name in changed]
+    pool = None
+    if len(sources) >= POOL_THRESHOLD:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(parse, sources, 16)
+    else:
+        results = imap(parse, sources)
+    try:
+        for batch in _batches(izip(sources, results), CHUNK_SIZE):
+            items = []
+            for (name, data, ref), obj in batch:
+                if obj is None:
+                    db.hincrby(KEY_REBUILD_STATUS, 'errors', 1)
+                    continue
+                items.append(model(ctx, name, obj, data, ref))
+            # Tags were all dropped up front in a full rebuild
+            write_caches(ctx, items, fresh_tags = full)
+            db.hincrby(KEY_REBUILD_STATUS, 'updated', len(items))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+
+def rebuild(ctx, full = False, processes = None):
+    """Brings the job and recipe caches in line with the config repo.
+
+    Only entries whose branch head differs from the cached 'sha1' are
+    re-parsed, unless `full` is set. Progress is recorded in
+    KEY_REBUILD_STATUS while running.
+    """
+    db = ctx.db
+    if not db.set(KEY_REBUILD_LOCK, get_ts(), nx = True, ex = LOCK_TTL):
+        raise RebuildInProgress()
+    try:
+        db.delete(KEY_REBUILD_STATUS)
+        db.hmset(KEY_REBUILD_STATUS, dict(state = 'running', full = int(full),
+                                          started = get_ts(), ended = 0,
+                                          total = 0, updated = 0, skipped = 0,
+                                          removed = 0, errors = 0))
+        if full:
+            _delete_tags(db)
+        refs = ctx.repo.refs.keys()
+        for kind in ('jobs', 'recipes'):
+            _rebuild_kind(ctx, kind, refs, full, processes)
+        db.hmset(KEY_REBUILD_STATUS, dict(state = 'done', ended = get_ts()))
+    except:
+        db.hmset(KEY_REBUILD_STATUS, dict(state = 'failed', ended = get_ts()))
+        raise
+    finally:
+        db.delete(KEY_REBUILD_LOCK)
+    return get_status(ctx)
+
+
+def is_running(ctx):
+    return bool(ctx.db.exists(KEY_REBUILD_LOCK))
+
+
+def get_status(ctx):
+    status = ctx.db.hgetall(KEY_REBUILD_STATUS)
+    for k in ('full', 'started', 'ended', 'total', 'updated', 'skipped',
+              'removed', 'errors'):
+        if k in status:
+            status[k] = int(status[k])
+    return status
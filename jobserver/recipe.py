@@ -1,11 +1,11 @@
 import json
 
-from flask import g
 import yaml
 
 from jobserver.db import KEY_RECIPE, KEY_RECIPES, KEY_TAG
 from jobserver.gitdb import create_commit, update_head
 from jobserver.gitdb import NoChangesException, CommitException
+import jobserver.history as history
 
 
 class RecipeParseError(Exception):
@@ -21,7 +21,8 @@ class RecipeNotCurrent(Exception):
 
 
 class Recipe(object):
-    def __init__(self, name, metadata, contents = None, ref = None):
+    def __init__(self, ctx, name, metadata, contents = None, ref = None):
+        self._ctx = ctx
         self._name = name
         self._obj = metadata
         self._contents = contents
@@ -57,28 +58,30 @@ class Recipe(object):
 
     def save(self, prev_ref = None, message = None):
         message = message or "Updated Recipe"
+        repo = self._ctx.repo
 
         if self.name == 'private':
             try:
-                prev_ref = g.repo.refs['refs/heads/recipes/private']
+                prev_ref = repo.refs['refs/heads/recipes/private']
             except KeyError:
                 prev_ref = None
 
         try:
-            commit = create_commit(g.repo, [('build.py', 0100644, self.contents)],
+            commit = create_commit(repo, [('build.py', 0100644, self.contents)],
                                    parent = prev_ref,
                                    message = message)
             self._ref = commit.id
         except NoChangesException:
             return
         try:
-            update_head(g.repo, 'refs/heads/recipes/%s' % self.name,
+            update_head(repo, 'refs/heads/recipes/%s' % self.name,
                         prev_ref, commit.id)
         except CommitException:
             if self.name == 'private':
                 return self.save(prev_ref, message)
             raise RecipeNotCurrent()
         self._update_cache()
+        history.update(self._ctx, 'recipes/%s' % self.name, commit.id)
 
     def _update_cache(self):
         # TODO: Still a race condition if a newer edit updates the cache
@@ -87,25 +90,29 @@ class Recipe(object):
 
         def update(pipe):
             try:
-                prev = Recipe.load(self.name, pipe = pipe)
+                prev = Recipe.load(self._ctx, self.name, pipe = pipe)
                 prev_tags = set(prev.tags)
             except RecipeNotFound:
                 prev_tags = set()
-            cur_tags = set(self.tags)
 
             pipe.multi()
-            for tag in prev_tags - cur_tags:
-                pipe.srem(KEY_TAG % tag, 'r' + self.name)
-            for tag in cur_tags - prev_tags:
-                pipe.sadd(KEY_TAG % tag, 'r' + self.name)
-            pipe.hset(key, 'json', json.dumps(self._obj))
-            pipe.hset(key, 'contents', self.contents)
-            pipe.hset(key, 'description', self.description)
-            pipe.hset(key, 'tags', ','.join(self.tags))
-            pipe.hset(key, 'sha1', self.ref)
-            pipe.sadd(KEY_RECIPES, self.name)
-
-        g.db.transaction(update, key)
+            self._write_cache(pipe, prev_tags)
+
+        self._ctx.db.transaction(update, key)
+
+    def _write_cache(self, pipe, prev_tags):
+        key = KEY_RECIPE % self.name
+        cur_tags = set(self.tags)
+        for tag in prev_tags - cur_tags:
+            pipe.srem(KEY_TAG % tag, 'r' + self.name)
+        for tag in cur_tags - prev_tags:
+            pipe.sadd(KEY_TAG % tag, 'r' + self.name)
+        pipe.hset(key, 'json', json.dumps(self._obj))
+        pipe.hset(key, 'contents', self.contents)
+        pipe.hset(key, 'description', self.description)
+        pipe.hset(key, 'tags', ','.join(self.tags))
+        pipe.hset(key, 'sha1', self.ref)
+        pipe.sadd(KEY_RECIPES, self.name)
 
     @classmethod
     def _extract_metadata(cls, contents):
@@ -124,7 +131,7 @@ class Recipe(object):
         return metadata
 
     @classmethod
-    def parse(cls, name, contents, ref = None):
+    def parse(cls, ctx, name, contents, ref = None):
         try:
             obj = Recipe._extract_metadata(contents)
         except Exception as e:
@@ -135,46 +142,39 @@ class Recipe(object):
         obj.pop('Tags', None)
         if tags:
             obj['Tags'] = tags
-        return Recipe(name, obj, contents, ref)
+        return Recipe(ctx, name, obj, contents, ref)
 
     @classmethod
-    def load(cls, name, ref = None, pipe = None):
+    def load(cls, ctx, name, ref = None, pipe = None):
         if not pipe:
-            pipe = g.db
+            pipe = ctx.db
         obj, contents, dbref = pipe.hmget(KEY_RECIPE % name, ('json', 'contents', 'sha1'))
         if dbref is None or (ref and ref != dbref):
-            contents, dbref = cls._get_from_archive(name, ref)
+            contents, dbref = cls._get_from_archive(ctx, name, ref)
             if not dbref:
                 raise RecipeNotFound()
-            return Recipe.parse(name, contents, dbref)
+            return Recipe.parse(ctx, name, contents, dbref)
         if not dbref:
             raise RecipeNotFound()
-        return Recipe(name, json.loads(obj), contents, ref = dbref)
+        return Recipe(ctx, name, json.loads(obj), contents, ref = dbref)
 
     @classmethod
-    def _get_from_archive(cls, name, ref = None):
+    def _get_from_archive(cls, ctx, name, ref = None):
+        repo = ctx.repo
         if not ref:
             try:
-                ref = g.repo.refs['refs/heads/recipes/%s' % name]
+                ref = repo.refs['refs/heads/recipes/%s' % name]
             except KeyError:
                 return None, None
-        commit = g.repo.get_object(ref)
-        tree = g.repo.get_object(commit.tree)
+        commit = repo.get_object(ref)
+        tree = repo.get_object(commit.tree)
         mode, sha = tree['build.py']
-        return g.repo.get_object(sha).data, commit.id
+        return repo.get_object(sha).data, commit.id
 
     @classmethod
-    def get_edit_history(cls, name, limit = 20):
-        entries = []
-        ref = g.repo.refs['refs/heads/recipes/%s' % name]
-        for i in range(limit):
-            c = g.repo.get_object(ref)
-            entries.append({'ref': ref,
-                            'msg': c.message.splitlines()[0],
-                            'date': c.commit_time,
-                            'by': c.committer})
-            try:
-                ref = c.parents[0]
-            except IndexError:
-                break
-        return entries
+    def get_edit_history(cls, ctx, name, before = None, limit = 20):
+        return history.get_history(ctx, 'recipes/%s' % name, before, limit)
+
+    @classmethod
+    def get_changes(cls, ctx, name, since, until = None):
+        return history.get_changes(ctx, 'recipes/%s' % name, since, until)
@@ -2,6 +2,7 @@ from flask import Blueprint, request, abort, jsonify, g
 
 from jobserver.db import KEY_RECIPES
 from jobserver.recipe import Recipe, RecipeNotCurrent, RecipeNotFound
+from jobserver.history import RefNotInHistory, HISTORY_LIMIT
 from jobserver.utils import chunks
 
 app = Blueprint('recipes', __name__)
@@ -22,7 +23,7 @@ def do_post_recipe(name):
     msg = request.json.get('commitmsg', '').encode('utf-8')
     msg = msg or "No message given"
 
-    recipe = Recipe.parse(name, contents)
+    recipe = Recipe.parse(g.ctx, name, contents)
     try:
         recipe.save(prev_ref = request.json.get('old'))
     except RecipeNotCurrent:
@@ -33,7 +34,7 @@ def do_post_recipe(name):
 @app.route('/<name>.json', methods=['GET'])
 def do_get_recipe(name):
     try:
-        recipe = Recipe.load(name, ref = request.args.get('ref'))
+        recipe = Recipe.load(g.ctx, name, ref = request.args.get('ref'))
     except RecipeNotFound:
         abort(404)
     return jsonify(ref = recipe.ref,
@@ -43,4 +44,20 @@ def do_get_recipe(name):
 
 @app.route('/<name>/history.json', methods=['GET'])
 def do_get_recipe_history(name):
-    return jsonify(entries = Recipe.get_edit_history(name))
+    try:
+        limit = int(request.args.get('limit', HISTORY_LIMIT))
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        abort(400, 'Invalid limit')
+    try:
+        if request.args.get('since'):
+            entries = Recipe.get_changes(g.ctx, name, request.args['since'],
+                                         request.args.get('until'))
+            return jsonify(entries = entries)
+        entries, cursor = Recipe.get_edit_history(
+            g.ctx, name, before = request.args.get('before'),
+            limit = limit)
+    except RefNotInHistory:
+        abort(404)
+    return jsonify(entries = entries, next = cursor)
@@ -1,30 +1,50 @@
+"""The build log, or slog, of a build.
+
+Each build has its log in a redis stream, which is only ever appended
+to. The stream ids are monotonic and carry the time the item was added,
+so readers can page through the log, or tail it, from any id.
+
+Items that have side effects on the build (see SLOG_HANDLERS) are also
+added to a global stream, where slogd.py runs the handlers in a consumer
+group, so that whoever adds to the log doesn't have to wait for them.
+
+Builds from before streams have their log in a list under another key.
+Its items are read first, with ids of the form 0-<index>, which sort
+before any stream id.
+"""
 import json
-import time
 import types
 
-from jobserver.build import Build
+from jobserver.build import Build, KEY_SESSION, add_session_artifact
 from jobserver.job import Job
 
-KEY_SLOG = 'slog:%s'
+KEY_SLOG = 'slogs:%s'
+# The log of builds from before streams
+KEY_SLOG_LEGACY = 'slog:%s'
+# Items with side effects, to be handled by slogd
+KEY_SLOG_HANDLERS = 'slog-handlers'
+SLOG_GROUP = 'handlers'
 
-# TODO: Update sessions when and how?
 
+def DoJobDone(ctx, pipe, build_uuid, session_no, li):
+    job_name = Build.get_job_name(ctx, build_uuid)
+    Job.set_last_success(job_name, build_uuid, pipe = pipe)
 
-def DoJobDone(db, build_uuid, session_no, li):
-    job_name = Build.get_job_name(build_uuid)
-    Job.set_last_success(job_name, build_uuid)
 
+def DoSetDescription(ctx, pipe, build_uuid, session_no, li):
+    Build.set_description(build_uuid, li['params']['description'], pipe = pipe)
 
-def DoSetDescription(db, build_uuid, session_no, li):
-    Build.set_description(build_uuid, li['params']['description'], pipe = db)
 
+def DoSetBuildId(ctx, pipe, build_uuid, session_no, li):
+    Build.set_build_id(build_uuid, li['params']['build_id'], pipe = pipe)
 
-def DoSetBuildId(db, build_uuid, session_no, li):
-    Build.set_build_id(build_uuid, li['params']['build_id'], pipe = db)
 
-
-def DoArtifactAdded(db, build_uuid, session_no, li):
-    Build.add_artifact(build_uuid, li['params'])
+def DoArtifactAdded(ctx, pipe, build_uuid, session_no, li):
+    Build.add_artifact(build_uuid, li['params'], pipe = pipe)
+    session_id = '%s-%s' % (build_uuid, session_no)
+    # Memoized sessions keep their own, to hand out again on a hit
+    if ctx.db.hexists(KEY_SESSION % session_id, 'memo_key'):
+        add_session_artifact(pipe, session_id, li['params'])
 
 
 SLOG_HANDLERS = {'job-done': DoJobDone,
@@ -33,18 +53,87 @@ SLOG_HANDLERS = {'job-done': DoJobDone,
                  'set-build-id': DoSetBuildId}
 
 
-def add_slog(db, session_id, item):
+# Only the last of these in a batch needs handling
+COALESCED = ('set-description', 'set-build-id')
+
+
+def add_slogs(ctx, session_id, items, pipe = None):
+    """Adds a batch of items to the log in one go. Each item is a log item,
+    its JSON serialization or an already decoded dict."""
     build_uuid, session_no = session_id.split('-')
-    if not type(item) in types.StringTypes:
-        item = item.serialize()
-
-    li = json.loads(item)
-    li['s'] = int(session_no)
-    li['t'] = int(time.time() * 1000)
-    db.rpush(KEY_SLOG % build_uuid, json.dumps(li))
-    try:
-        handler = SLOG_HANDLERS[li['type']]
-    except KeyError:
-        pass
-    else:
-        handler(db, build_uuid, session_no, li)
+    lis = []
+    for item in items:
+        if isinstance(item, dict):
+            li = dict(item)
+        else:
+            if not type(item) in types.StringTypes:
+                item = item.serialize()
+            li = json.loads(item)
+        li['s'] = int(session_no)
+        lis.append(li)
+
+    last = dict((li['type'], i) for i, li in enumerate(lis)
+                if li['type'] in COALESCED)
+    p = pipe or ctx.db.pipeline()
+    for i, li in enumerate(lis):
+        data = json.dumps(li)
+        p.execute_command('XADD', KEY_SLOG % build_uuid, '*', 'item', data)
+        if li['type'] in SLOG_HANDLERS and last.get(li['type'], i) == i:
+            p.execute_command('XADD', KEY_SLOG_HANDLERS, '*',
+                              'build', build_uuid, 'item', data)
+    if not pipe:
+        p.execute()
+
+
+def add_slog(ctx, session_id, item, pipe = None):
+    add_slogs(ctx, session_id, [item], pipe = pipe)
+
+
+def _parse_entries(entries):
+    items = []
+    for id, fields in entries or []:
+        fields = dict(zip(fields[::2], fields[1::2]))
+        li = json.loads(fields['item'])
+        li['id'] = id
+        li['t'] = int(id.split('-')[0])
+        items.append(li)
+    return items
+
+
+def next_id(id):
+    """Returns the id right after `id`, to continue reading from"""
+    ms, seq = id.split('-')
+    return '%s-%d' % (ms, int(seq) + 1)
+
+
+def get_slog(db, build_uuid, start = '-', count = 1000):
+    """Returns up to `count` items of the log, from the id `start` on.
+    The items have their stream id as 'id', and the time they were added
+    (in ms) as 't'.
+    """
+    items = []
+    if start == '-' or start.startswith('0-'):
+        first = int(start.split('-')[1]) if start != '-' else 0
+        legacy = db.lrange(KEY_SLOG_LEGACY % build_uuid,
+                           first, first + count - 1)
+        for i, data in enumerate(legacy):
+            li = json.loads(data)
+            li['id'] = '0-%d' % (first + i)
+            items.append(li)
+        if len(items) == count:
+            return items
+        start, count = '-', count - len(items)
+    return items + _parse_entries(db.execute_command(
+        'XRANGE', KEY_SLOG % build_uuid, start, '+', 'COUNT', count))
+
+
+def parse_handler_entry(fields):
+    fields = dict(zip(fields[::2], fields[1::2]))
+    return fields['build'], json.loads(fields['item'])
+
+
+def handle(ctx, pipe, build_uuid, li):
+    """Runs the handler of the item, adding its writes to `pipe`"""
+    handler = SLOG_HANDLERS.get(li['type'])
+    if handler:
+        handler(ctx, pipe, build_uuid, str(li['s']), li)
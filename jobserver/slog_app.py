@@ -1,8 +1,8 @@
 import json
 
-from flask import Blueprint, jsonify, request, g
+from flask import Blueprint, jsonify, request, abort, g
 
-from jobserver.slog import add_slog
+from jobserver.slog import add_slog, add_slogs
 
 app = Blueprint('slog', __name__)
 
@@ -10,5 +10,24 @@ app = Blueprint('slog', __name__)
 @app.route('/<build_id>-<session_no>', methods=['POST'])
 def add_log(build_id, session_no):
     data = json.dumps(request.json) if request.json else request.data
-    add_slog(g.db, '%s-%s' % (build_id, session_no), data)
+    add_slog(g.ctx, '%s-%s' % (build_id, session_no), data)
     return jsonify()
+
+
+@app.route('/<build_id>-<session_no>/batch', methods=['POST'])
+def add_logs(build_id, session_no):
+    """Adds many items at once, posted as a JSON array or as
+    newline-delimited JSON"""
+    try:
+        if isinstance(request.json, list):
+            items = request.json
+        else:
+            items = [json.loads(l) for l in request.data.splitlines()
+                     if l.strip()]
+    except ValueError:
+        abort(400, 'Invalid JSON')
+    if [i for i in items if not isinstance(i, dict) or 'type' not in i]:
+        abort(400, 'Items must be objects with a type')
+    if items:
+        add_slogs(g.ctx, '%s-%s' % (build_id, session_no), items)
+    return jsonify(count = len(items))
@@ -1,4 +1,5 @@
-import re, time
+from collections import OrderedDict
+import re, threading, time
 
 re_sha1 = re.compile('^([0-9a-f]{40})$')
 
@@ -11,8 +12,50 @@ def get_ts():
     return int(time.time())
 
 
+def get_hit_stats(db, key):
+    """Returns the hits, misses and hit rate counted in the hash `key`"""
+    stats = db.hgetall(key)
+    hits = int(stats.get('hits', 0))
+    misses = int(stats.get('misses', 0))
+    return dict(hits = hits, misses = misses,
+                hit_rate = float(hits) / (hits + misses) if hits + misses else 0)
+
+
 def chunks(l, n):
     """ Yield successive n-sized chunks from l.
     """
     for i in xrange(0, len(l), n):
         yield l[i:i + n]
+
+
+class LRUCache(object):
+    """ A bounded, thread safe mapping that evicts the least recently
+        used entry when full.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default = None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last = False)
+
+    def __len__(self):
+        return len(self._data)
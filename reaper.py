@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+    sci.reaper
+    ~~~~~~~~~~
+
+    Expires agents that have stopped sending heartbeats, and takes back
+    dispatched sessions that were never acknowledged
+
+    :copyright: (c) 2012 by Victor Boivie
+    :license: Apache License 2.0
+"""
+import logging
+import signal
+import time
+
+import redis
+
+import jobserver.db as jdb
+from jobserver.agent import reap_agents
+from jobserver.lease import expired_leases, requeue, record_failure
+from jobserver.lease import take_due_retries, take_cooled_down
+from jobserver.lease import take_due_affinity
+from jobserver.utils import get_ts
+from async.agent_available import AgentAvailable
+from async.dispatch_session import DispatchSession
+from async.matcher import request_match
+from async.events import post
+
+__version__ = "0.1"
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+REAP_INTERVAL = 5
+
+
+class Reaper(object):
+    def __init__(self, interval = REAP_INTERVAL):
+        self.db = jdb.conn()
+        self.interval = interval
+        self._shutdown = False
+
+    def status(self, s):
+        setproctitle('sci-reaper-%s: %s' % (__version__, s))
+
+    def run(self):
+        self.status("Starting")
+        self.register_signal_handlers()
+        self.work()
+
+    def register_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self.schedule_shutdown)
+        signal.signal(signal.SIGINT, self.schedule_shutdown)
+        signal.signal(signal.SIGQUIT, self.schedule_shutdown)
+
+    def schedule_shutdown(self, signum, frame):
+        logger.info("Shutdown scheduled")
+        self._shutdown = True
+
+    def work(self):
+        while not self._shutdown:
+            try:
+                self.reap()
+                self.sweep()
+            except redis.exceptions.ConnectionError:
+                logger.warning("Connection to redis lost - retrying")
+            self.sleep()
+
+    def reap(self):
+        requeue = reap_agents(self.db)
+        if requeue:
+            logger.info("Requeuing %d sessions from dead agents" % len(requeue))
+            for session_id in requeue:
+                post(self.db, DispatchSession, session_id)
+
+    def sweep(self):
+        now = get_ts()
+        for session_id in expired_leases(self.db, now):
+            agent_id = requeue(self.db, session_id, now)
+            if not agent_id:
+                continue
+            logger.info("Lease on %s expired - %s never ack'ed" %
+                        (session_id, agent_id))
+            if record_failure(self.db, agent_id, session_id, now):
+                post(self.db, AgentAvailable, agent_id)
+        for session_id in take_due_retries(self.db, now):
+            post(self.db, DispatchSession, session_id)
+        # Sessions done waiting for a warm agent may go to any agent now.
+        # A pass is also asked for whenever sessions and free agents are
+        # both around, in case a request got lost.
+        if take_due_affinity(self.db, now) or \
+                (self.db.zcard(jdb.KEY_QUEUED_SESSIONS) and
+                 self.db.scard(jdb.KEY_AVAILABLE)):
+            request_match(self.db)
+        for agent_id in take_cooled_down(self.db, now):
+            logger.info("Agent %s has cooled down" % agent_id)
+            post(self.db, AgentAvailable, agent_id)
+
+    def sleep(self):
+        self.status("Sleeping")
+        end = time.time() + self.interval
+        while not self._shutdown and time.time() < end:
+            time.sleep(1)
+
+
+try:
+    from setproctitle import setproctitle
+    setproctitle  # workaround https://github.com/kevinw/pyflakes/issues/13
+except ImportError:
+    def setproctitle(name):
+        pass
+
+if __name__ == '__main__':
+    Reaper().run()
@@ -25,11 +25,13 @@ class HttpError(Exception):
 
 
 class HttpClient(object):
-    def __init__(self, url):
+    def __init__(self, url, timeout = None):
         self.url = url
+        self.timeout = timeout
 
     def call(self, path, method = None, input = None, raw = False, **kwargs):
-        with HttpRequest(self.url, path, method, input, **kwargs) as f:
+        with HttpRequest(self.url, path, method, input,
+                         timeout = self.timeout, **kwargs) as f:
             data = f.read()
             if raw:
                 return data
@@ -37,7 +39,8 @@ class HttpClient(object):
 
 
 class HttpRequest(object):
-    def __init__(self, url, path, method = None, input = None, **kwargs):
+    def __init__(self, url, path, method = None, input = None, timeout = None,
+                 **kwargs):
         if not method:
             method = "POST" if input else "GET"
         headers = {"Accept": "application/json, text/plain, */*"}
@@ -45,7 +48,11 @@ class HttpRequest(object):
             headers['Content-type'] = 'application/json'
             input = json.dumps(input, cls=APIEncoder)
         u = urlparse.urlparse(url + path)
-        self.c = httplib.HTTPConnection(u.hostname, u.port)
+        if timeout:
+            self.c = httplib.HTTPConnection(u.hostname, u.port,
+                                            timeout = timeout)
+        else:
+            self.c = httplib.HTTPConnection(u.hostname, u.port)
         url = u.path
         if kwargs:
             for n in kwargs.keys():
@@ -15,4 +15,8 @@ SW_SERVER_NAME = 'localhost:5000'
 SW_SERVER_PORT = 5000
 SS_URL = 'http://' + SS_SERVER_NAME
 
+# How agent check-ins and sessions reach the dispatch code: 'events' for
+# dispatcher.py, or 'pyres' for a resque job each, run by backend.py
+DISPATCH_VIA = 'events'
+
 del os
@@ -87,7 +87,14 @@ def show_edit(id):
 
 @app.route('/<id>/edit-history', methods = ['GET'])
 def show_edit_history(id):
-    return "TODO"
+    job = js().call('/job/%s' % id)
+    info = js().call('/job/%s/history.json' % id,
+                     before = request.args.get('before'))
+    return render_template('job_edit_history.html',
+                           id = id,
+                           job = job,
+                           entries = info['entries'],
+                           next = info['next'])
 
 
 @app.route('/<id>/start', methods = ['POST'])
@@ -167,6 +174,21 @@ def show_log(id, build_no):
     return resp
 
 
+@app.route('/<id>/<int:build_no>/console/<int:session_no>', methods = ['GET'])
+def show_console(id, build_no, session_no):
+    job = js().call('/job/%s' % id)
+    info = js().call('/build/%s,%d' % (id, build_no))
+    sessions = info['sessions']
+    if session_no >= len(sessions):
+        abort(404)
+    return render_template('build_console.html',
+                           id = id,
+                           build = info['build'],
+                           session = sessions[session_no],
+                           ss_url = current_app.config['SS_URL'],
+                           job = job)
+
+
 @app.route('/<build_uuid>/progress.json', methods = ['GET'])
 def build_progress(build_uuid):
     start = request.args.get('start')
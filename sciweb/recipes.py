@@ -57,11 +57,13 @@ def show_edit(id):
 
 @app.route('/history/<id>', methods = ['GET'])
 def show_history(id):
-    info = c().call('/recipe/%s/history.json' % id)
+    info = c().call('/recipe/%s/history.json' % id,
+                    before = request.args.get('before'))
 
     return render_template('recipes_history.html',
                            id = id,
-                           entries = info['entries'])
+                           entries = info['entries'],
+                           next = info['next'])
 
 
 @app.route('/show/<id>', methods = ['GET'])
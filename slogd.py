@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+    sci.slogd
+    ~~~~~~~~~
+
+    Runs the side effects of build log items, such as setting the build
+    description or adding artifacts, as a member of a consumer group.
+
+    Items are acknowledged, and deleted, in the same transaction as the
+    writes of their handler, so the stream only holds what is left to do.
+    Items held by a consumer that died are claimed by another one after a
+    while, so every item is handled at least once.
+
+    :copyright: (c) 2012 by Victor Boivie
+    :license: Apache License 2.0
+"""
+import logging
+import os
+import signal
+import socket
+import time
+
+import redis
+
+from jobserver.context import worker_context
+from jobserver.slog import KEY_SLOG_HANDLERS, SLOG_GROUP
+from jobserver.slog import parse_handler_entry, handle
+
+__version__ = "0.1"
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# Items read at a time, and for how long (ms) to block waiting for them
+READ_COUNT = 100
+READ_BLOCK = 1000
+# Items that have been pending this long (ms) are taken over
+CLAIM_IDLE = 60000
+CLAIM_INTERVAL = 30
+# Items that fail this many times are given up on
+MAX_DELIVERIES = 5
+
+
+class SlogDaemon(object):
+    def __init__(self):
+        self.ctx = worker_context()
+        self.db = self.ctx.db
+        self.consumer = '%s-%d' % (socket.gethostname(), os.getpid())
+        self._shutdown = False
+
+    def status(self, s):
+        setproctitle('sci-slogd-%s: %s' % (__version__, s))
+
+    def run(self):
+        self.status("Starting")
+        self.register_signal_handlers()
+        self.create_group()
+        self.work()
+
+    def register_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self.schedule_shutdown)
+        signal.signal(signal.SIGINT, self.schedule_shutdown)
+        signal.signal(signal.SIGQUIT, self.schedule_shutdown)
+
+    def schedule_shutdown(self, signum, frame):
+        logger.info("Shutdown scheduled")
+        self._shutdown = True
+
+    def create_group(self):
+        try:
+            self.db.execute_command('XGROUP', 'CREATE', KEY_SLOG_HANDLERS,
+                                    SLOG_GROUP, '0', 'MKSTREAM')
+        except redis.exceptions.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def work(self):
+        self.status("Waiting for items")
+        last_claim = 0
+        while not self._shutdown:
+            try:
+                if time.time() - last_claim > CLAIM_INTERVAL:
+                    self.claim()
+                    last_claim = time.time()
+                result = self.db.execute_command(
+                    'XREADGROUP', 'GROUP', SLOG_GROUP, self.consumer,
+                    'COUNT', READ_COUNT, 'BLOCK', READ_BLOCK,
+                    'STREAMS', KEY_SLOG_HANDLERS, '>')
+            except redis.exceptions.ConnectionError:
+                logger.warning("Connection to redis lost - retrying in 2")
+                time.sleep(2)
+                continue
+            for stream, entries in result or []:
+                for id, fields in entries:
+                    self.handle(id, fields)
+
+    def claim(self):
+        """Takes over the items that other consumers have been sitting on"""
+        pending = self.db.execute_command('XPENDING', KEY_SLOG_HANDLERS,
+                                          SLOG_GROUP, '-', '+', READ_COUNT)
+        for id, consumer, idle, deliveries in pending or []:
+            if int(idle) < CLAIM_IDLE:
+                continue
+            if int(deliveries) >= MAX_DELIVERIES:
+                logger.error("Giving up on %s after %s attempts" %
+                             (id, deliveries))
+                self.done(self.db.pipeline(), id)
+                continue
+            for claimed, fields in self.db.execute_command(
+                    'XCLAIM', KEY_SLOG_HANDLERS, SLOG_GROUP, self.consumer,
+                    CLAIM_IDLE, id):
+                if fields:
+                    logger.info("Claimed %s from %s" % (claimed, consumer))
+                    self.handle(claimed, fields)
+
+    def done(self, pipe, id):
+        with pipe:
+            pipe.execute_command('XACK', KEY_SLOG_HANDLERS, SLOG_GROUP, id)
+            pipe.execute_command('XDEL', KEY_SLOG_HANDLERS, id)
+            pipe.execute()
+
+    def handle(self, id, fields):
+        try:
+            build_uuid, li = parse_handler_entry(fields)
+            pipe = self.db.pipeline()
+            handle(self.ctx, pipe, build_uuid, li)
+            self.done(pipe, id)
+        except Exception:
+            # Left pending, to be retried when claimed
+            logger.exception("Failed to handle %s" % id)
+
+
+try:
+    from setproctitle import setproctitle
+    setproctitle  # workaround https://github.com/kevinw/pyflakes/issues/13
+except ImportError:
+    def setproctitle(name):
+        pass
+
+if __name__ == '__main__':
+    SlogDaemon().run()
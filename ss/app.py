@@ -9,11 +9,23 @@
     :license: Apache License 2.0
 """
 import os
+import re
+import time
 
 from flask import Flask, jsonify, abort, request, send_file, url_for
+from flask import make_response
+
+from ss import console
 
 app = Flask(__name__)
 
+# Default and max number of bytes of console output returned at a time
+CONSOLE_READ = 64 * 1024
+CONSOLE_READ_MAX = 1024 * 1024
+# Max seconds a reader may wait for more output
+CONSOLE_WAIT_MAX = 30
+CONSOLE_POLL = 0.5
+
 
 def get_spath(build_id):
     return os.path.join(app.config['SS_PATH'], 'ss-files',
@@ -25,6 +37,12 @@ def get_fpath(build_id, filename):
     return fpath
 
 
+def get_cpath(build_id, session_no):
+    return os.path.join(app.config['SS_PATH'], 'ss-console',
+                        build_id[1:3], build_id[3:5], build_id[5:],
+                        str(session_no))
+
+
 def get_url(build_id, filename):
     return url_for('.get_file', build_id=build_id, filename=filename,
                    _external=True)
@@ -90,3 +108,90 @@ def get_file(build_id, filename):
     if not os.path.exists(filename):
         abort(404)
     return send_file(filename)
+
+
+@app.route('/console/<build_id>/<int:session_no>', methods=['POST'])
+def append_console(build_id, session_no):
+    size = console.append(get_cpath(build_id, session_no), request.data)
+    return jsonify(size = size)
+
+
+@app.route('/console/<build_id>/<int:session_no>/done', methods=['POST'])
+def finish_console(build_id, session_no):
+    console.finish(get_cpath(build_id, session_no))
+    return jsonify()
+
+
+def parse_range(header, size):
+    """Returns (offset, length) of a 'bytes=a-b', 'bytes=a-' or
+    'bytes=-n' range"""
+    m = re.match(r'bytes=(\d*)-(\d*)$', header or '')
+    if not m or m.groups() == ('', ''):
+        return None
+    first, last = m.groups()
+    if not first:
+        offset = max(size - int(last), 0)
+        return offset, size - offset
+    offset = int(first)
+    if not last:
+        return offset, size - offset
+    return offset, int(last) - offset + 1
+
+
+def get_arg(name, default, type = int):
+    """Returns a non-negative number argument, or aborts with 400"""
+    if name not in request.args:
+        return default
+    value = request.args.get(name, type = type)
+    if value is None or value < 0:
+        abort(400, 'Invalid %s' % name)
+    return value
+
+
+@app.route('/console/<build_id>/<int:session_no>', methods=['GET'])
+def get_console(build_id, session_no):
+    """Returns console output, selected by a Range header, or by the
+    offset and length arguments. tail=n returns the last n bytes. With
+    wait=s, waits up to s seconds for output past the offset to show up,
+    so that a running session can be followed.
+    """
+    path = get_cpath(build_id, session_no)
+    size = console.size(path)
+    done = console.is_done(path)
+    partial = parse_range(request.headers.get('Range'), size)
+    if partial:
+        offset, length = partial
+    elif 'tail' in request.args:
+        offset = max(size - get_arg('tail', 0), 0)
+        length = size - offset
+    else:
+        offset = get_arg('offset', 0)
+        length = get_arg('length', CONSOLE_READ)
+    length = min(length, CONSOLE_READ_MAX)
+
+    wait = min(get_arg('wait', 0, type = float), CONSOLE_WAIT_MAX)
+    end = time.time() + wait
+    while size <= offset and not done and time.time() < end:
+        time.sleep(CONSOLE_POLL)
+        size = console.size(path)
+        done = console.is_done(path)
+
+    output = console.read(path, offset, length)
+    resp = make_response(output)
+    resp.mimetype = 'text/plain'
+    if partial and not output:
+        resp.status_code = 416
+        resp.headers['Content-Range'] = 'bytes */%d' % size
+    elif partial:
+        resp.status_code = 206
+        resp.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+            offset, offset + len(output) - 1, size)
+    resp.headers['Accept-Ranges'] = 'bytes'
+    resp.headers['X-Console-Offset'] = str(offset)
+    resp.headers['X-Console-End'] = str(offset + len(output))
+    resp.headers['X-Console-Size'] = str(size)
+    resp.headers['X-Console-Done'] = '1' if done else '0'
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    resp.headers['Access-Control-Expose-Headers'] = \
+        'X-Console-Offset, X-Console-End, X-Console-Size, X-Console-Done'
+    return resp
@@ -0,0 +1,249 @@
+"""
+    sci.ss.console
+    ~~~~~~~~~~~~~~
+
+    Append-only store for the console output of sessions
+
+    The output is kept as a series of gzip members in one file, each
+    holding up to CHUNK_SIZE bytes of output, which taken together make
+    a valid gzip file. An index file has a fixed size record per chunk,
+    so any offset can be found with a binary search and read by
+    decompressing only the chunks it spans.
+
+    Output is appended as is to a tail file until there is a full chunk
+    of it, which is then compressed and moved out of the tail, so every
+    byte is compressed once. The tail starts with the offset of its
+    first byte in the output. Whatever of it is also in a chunk, as left
+    by a crash right after the chunk was written, is skipped.
+
+    :copyright: (c) 2012 by Victor Boivie
+    :license: Apache License 2.0
+"""
+import fcntl
+import os
+import struct
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+# Output offset, output length, file offset and file length of a chunk
+INDEX_RECORD = struct.Struct('!QIQI')
+# Output offset of the first byte in the tail
+TAIL_HEADER = struct.Struct('!Q')
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+DATA_FILE = 'console.gz'
+INDEX_FILE = 'console.idx'
+TAIL_FILE = 'console.tail'
+DONE_FILE = 'done'
+
+
+def _compress(data):
+    c = zlib.compressobj(6, zlib.DEFLATED, GZIP_WBITS)
+    return c.compress(data) + c.flush()
+
+
+def _decompress(data):
+    return zlib.decompress(data, GZIP_WBITS)
+
+
+def _record_count(idx):
+    idx.seek(0, os.SEEK_END)
+    return idx.tell() // INDEX_RECORD.size
+
+
+def _record(idx, i):
+    idx.seek(i * INDEX_RECORD.size)
+    return INDEX_RECORD.unpack(idx.read(INDEX_RECORD.size))
+
+
+def _read_chunk(data, record):
+    data.seek(record[2])
+    return _decompress(data.read(record[3]))
+
+
+def _find(idx, n, offset):
+    """Returns the index of the chunk holding `offset`"""
+    lo, hi = 0, n - 1
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if _record(idx, mid)[0] <= offset:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _open(path, name):
+    """Opens the file for writing anywhere in it, creating it if needed"""
+    fd = os.open(os.path.join(path, name), os.O_RDWR | os.O_CREAT, 0644)
+    return os.fdopen(fd, 'r+b')
+
+
+def _write_chunks(data, idx, i, pos, start, chunks):
+    """Writes the chunks at `pos` in the data file, and then their records
+    from the `i`th on, so that a record never points at a chunk that
+    isn't written yet. Returns where the chunks end.
+    """
+    data.seek(pos)
+    data.write(''.join(compressed for _, compressed in chunks))
+    data.flush()
+    idx.seek(i * INDEX_RECORD.size)
+    for length, compressed in chunks:
+        idx.write(INDEX_RECORD.pack(start, length, pos, len(compressed)))
+        start += length
+        pos += len(compressed)
+    idx.flush()
+    return pos
+
+
+def _indexed(idx, n):
+    """Returns the size of the output that is in chunks"""
+    if not n:
+        return 0
+    last = _record(idx, n - 1)
+    return last[0] + last[1]
+
+
+def _tail_state(path):
+    """Returns (offset, length) of the output in the tail, if any"""
+    try:
+        with open(os.path.join(path, TAIL_FILE), 'rb') as tail:
+            header = tail.read(TAIL_HEADER.size)
+            tail.seek(0, os.SEEK_END)
+            length = tail.tell() - TAIL_HEADER.size
+    except IOError:
+        return None
+    if len(header) < TAIL_HEADER.size:
+        return None
+    return TAIL_HEADER.unpack(header)[0], length
+
+
+def _read_tail(path, indexed):
+    """Returns the output after `indexed` that is in the tail"""
+    try:
+        with open(os.path.join(path, TAIL_FILE), 'rb') as tail:
+            data = tail.read()
+    except IOError:
+        return ''
+    if len(data) < TAIL_HEADER.size:
+        return ''
+    start = TAIL_HEADER.unpack(data[:TAIL_HEADER.size])[0]
+    return data[TAIL_HEADER.size + max(indexed - start, 0):]
+
+
+def _write_tail(path, start, output):
+    """Replaces the tail in one go, so that a crash leaves either one"""
+    name = os.path.join(path, TAIL_FILE)
+    with open(name + '.tmp', 'wb') as tail:
+        tail.write(TAIL_HEADER.pack(start) + output)
+    os.rename(name + '.tmp', name)
+
+
+def _write_full(path, idx, n, indexed, output):
+    """Compresses the output, which follows `indexed`, into chunks after
+    the `n` there are"""
+    if not output:
+        return
+    with _open(path, DATA_FILE) as data:
+        pos = 0
+        if n:
+            last = _record(idx, n - 1)
+            pos = last[2] + last[3]
+        # Anything past the last chunk was left by a crash while appending
+        data.truncate(pos)
+        chunks = []
+        for i in xrange(0, len(output), CHUNK_SIZE):
+            chunk = output[i:i + CHUNK_SIZE]
+            chunks.append((len(chunk), _compress(chunk)))
+        _write_chunks(data, idx, n, pos, indexed, chunks)
+
+
+def append(path, output):
+    """Appends to the output. Returns the size of the output."""
+    try:
+        os.makedirs(path)
+    except OSError:
+        pass
+    with _open(path, INDEX_FILE) as idx:
+        fcntl.flock(idx, fcntl.LOCK_EX)
+        n = _record_count(idx)
+        # Anything past the last record was left by a crash while appending
+        idx.truncate(n * INDEX_RECORD.size)
+        indexed = _indexed(idx, n)
+        tail = _tail_state(path)
+        if tail and tail[0] == indexed and \
+                tail[1] + len(output) < CHUNK_SIZE:
+            with open(os.path.join(path, TAIL_FILE), 'ab') as f:
+                f.write(output)
+            return indexed + tail[1] + len(output)
+        output = _read_tail(path, indexed) + output
+        full = len(output) - len(output) % CHUNK_SIZE
+        _write_full(path, idx, n, indexed, output[:full])
+        _write_tail(path, indexed + full, output[full:])
+        return indexed + len(output)
+
+
+def size(path):
+    try:
+        with open(os.path.join(path, INDEX_FILE), 'rb') as idx:
+            fcntl.flock(idx, fcntl.LOCK_SH)
+            indexed = _indexed(idx, _record_count(idx))
+            tail = _tail_state(path)
+            if tail:
+                return max(indexed, tail[0] + tail[1])
+            return indexed
+    except IOError:
+        return 0
+
+
+def read(path, offset, length):
+    """Returns up to `length` bytes of output from `offset` on"""
+    try:
+        idx = open(os.path.join(path, INDEX_FILE), 'rb')
+    except IOError:
+        return ''
+    with idx:
+        fcntl.flock(idx, fcntl.LOCK_SH)
+        if length <= 0:
+            return ''
+        n = _record_count(idx)
+        indexed = _indexed(idx, n)
+        end = offset + length
+        parts = []
+        if n and offset < indexed:
+            with open(os.path.join(path, DATA_FILE), 'rb') as data:
+                i = _find(idx, n, offset)
+                while i < n:
+                    record = _record(idx, i)
+                    if record[0] >= end:
+                        break
+                    chunk = _read_chunk(data, record)
+                    parts.append(chunk[max(offset - record[0], 0):
+                                       end - record[0]])
+                    i += 1
+        if end > indexed:
+            parts.append(_read_tail(path, indexed)[max(offset - indexed, 0):
+                                                   end - indexed])
+        return ''.join(parts)
+
+
+def finish(path):
+    """Marks the output as complete, moving what is left in the tail to a
+    last chunk"""
+    try:
+        os.makedirs(path)
+    except OSError:
+        pass
+    with _open(path, INDEX_FILE) as idx:
+        fcntl.flock(idx, fcntl.LOCK_EX)
+        n = _record_count(idx)
+        idx.truncate(n * INDEX_RECORD.size)
+        indexed = _indexed(idx, n)
+        output = _read_tail(path, indexed)
+        _write_full(path, idx, n, indexed, output)
+        _write_tail(path, indexed + len(output), '')
+        open(os.path.join(path, DONE_FILE), 'w').close()
+
+
+def is_done(path):
+    return os.path.exists(os.path.join(path, DONE_FILE))